@@ -0,0 +1,38 @@
+'''
+Compare converting raw readings one at a time (usb_temper.convert) with
+converting them in bulk (usb_temper.convert_many). Run from the top of the
+source tree:
+
+    $ python3 -m bench.convert --readings 100000
+'''
+
+import argparse
+import random
+import struct
+import time
+
+from temper_exporter import temper
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readings', type=int, default=100000, help='Number of readings to convert')
+    args = parser.parse_args()
+
+    raw = [(random.randint(-32768, 32767), random.randint(0, 4000)) for i in range(args.readings)]
+    buf = b''.join(struct.pack('>hh', *r) for r in raw)
+    print('numpy: {}'.format('yes' if temper.load_numpy() is not None else 'no'))
+    print('{:>12} {:>12} {:>12}'.format('model', 'convert ms', 'batch ms'))
+    for cls in temper.temper2, temper.temper2hum:
+        start = time.perf_counter()
+        for r in raw:
+            list(cls.convert(r))
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cls.convert_many(temper.unpack_words(buf))
+        batch = time.perf_counter() - start
+
+        print('{:>12} {:>12.1f} {:>12.1f}'.format(cls.__name__, single * 1000, batch * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''
+Compare rendering the exporter's metrics with prometheus_client's
+generate_latest() and with exposition.Writer, as the number of devices grows.
+Run from the top of the source tree:
+
+    $ python3 -m bench.exposition --devices 1,10,100,1000
+'''
+
+import argparse
+import time
+
+import prometheus_client
+
+from temper_exporter import exporter
+from temper_exporter import exposition
+
+class FakeDevice:
+    action = None
+
+    def __init__(self, index):
+        self.sys_path = '/sys/devices/bench/hidraw{}'.format(index)
+
+class FakeTemper:
+    version = 'TEMPer2_M12_V1.3'
+
+    def __init__(self, device):
+        self.__phy = 'usb-bench-{}/input1'.format(device.sys_path.rsplit('hidraw', 1)[1])
+
+    def phy(self):
+        return self.__phy
+
+    def read_sensor(self):
+        return [('temp', 'internal', 21.625), ('temp', 'external', 20.625)]
+
+    def close(self):
+        pass
+
+class BenchCollector(exporter.Collector):
+    def class_for_device(self, device):
+        return FakeTemper
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', default='1,10,100,1000', help='Comma-separated list of device counts')
+    parser.add_argument('--iterations', type=int, default=200, help='Number of times to render for each device count')
+    args = parser.parse_args()
+
+    print('{:>7} {:>9} {:>14} {:>14}'.format('devices', 'bytes', 'generate ms', 'writer ms'))
+    for count in (int(c) for c in args.devices.split(',')):
+        collector = BenchCollector(max_age=3600)
+        collector.coldplug_scan([FakeDevice(i) for i in range(count)])
+        collector.sample()
+        registry = prometheus_client.CollectorRegistry()
+        registry.register(collector)
+        writer = exposition.Writer()
+        assert writer.render(registry) == prometheus_client.generate_latest(registry)
+
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            body = prometheus_client.generate_latest(registry)
+        generate = (time.perf_counter() - start) / args.iterations
+
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            writer.render(registry)
+        write = (time.perf_counter() - start) / args.iterations
+
+        print('{:>7} {:>9} {:>14.3f} {:>14.3f}'.format(count, len(body), generate * 1000, write * 1000), flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import heapq
+import itertools
+import os
+import random
+import selectors
+import struct
+import threading
+import time
+import tty
+
+from temper_exporter import temper
+
+modaliases = {
+    'temper2': 'usb:v0C45p7401d0001dc00dsc00dp00ic03isc01ip02in01',
+    'temper2hum': 'usb:v0C45p7402d0001dc00dsc00dp00ic03isc01ip02in01',
+}
+
+class FakeUdevDevice:
+    '''
+    Just enough of pyudev.Device for temper.matcher and temper.usb_temper.
+    '''
+    action = None
+
+    def __init__(self, index, device_node, model):
+        self.sys_path = '/sys/devices/bench/hidraw{}'.format(index)
+        self.device_path = self.sys_path[4:]
+        self.device_node = device_node
+        self.__interface = {b'MODALIAS': modaliases[model]}
+        self.__hid = FakeHidDevice('bench-{}/input1'.format(index))
+
+    def __hash__(self):
+        return hash(self.sys_path)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUdevDevice) and self.sys_path == other.sys_path
+
+    def __repr__(self):
+        return '<FakeUdevDevice({!r})>'.format(self.sys_path)
+
+    def find_parent(self, subsystem, device_type=None):
+        if subsystem == b'usb' and device_type == b'usb_interface':
+            return self.__interface
+        elif subsystem == b'hid':
+            return self.__hid
+        return None
+
+class FakeHidDevice:
+    def __init__(self, phys):
+        self.properties = {'HID_PHYS': phys}
+
+class DeviceFarm(threading.Thread):
+    '''
+    Simulates a number of TEMPer devices, each backed by a pseudo-terminal in
+    raw mode, whose slave side stands in for the hidraw node.
+
+    Every response is delayed by latency seconds (plus up to jitter seconds).
+    A fraction error_rate of responses are garbage.
+    '''
+    def __init__(self, count, model='temper2', latency=0.001, jitter=0, error_rate=0):
+        super().__init__(name='farm', daemon=True)
+        self.__model = model
+        self.__seq = itertools.count()
+        self.__latency = latency
+        self.__jitter = jitter
+        self.__error_rate = error_rate
+        self.__selector = selectors.DefaultSelector()
+        self.__pending = []
+        self.__fds = []
+        self.devices = []
+        for i in range(count):
+            master, slave = os.openpty()
+            tty.setraw(slave)
+            os.set_blocking(master, False)
+            # Keep the slave side open, so the pty doesn't hang up between
+            # the exporter closing and reopening it.
+            self.__fds += [master, slave]
+            self.__selector.register(master, selectors.EVENT_READ, bytearray())
+            self.devices.append(FakeUdevDevice(i, os.ttyname(slave), model))
+        self.__wake_r, self.__wake_w = os.pipe()
+        self.__selector.register(self.__wake_r, selectors.EVENT_READ, None)
+        self.__stopping = False
+
+    def close(self):
+        self.__stopping = True
+        os.write(self.__wake_w, b'\0')
+        self.join()
+        self.__selector.close()
+        for fd in self.__fds + [self.__wake_r, self.__wake_w]:
+            os.close(fd)
+
+    def run(self):
+        while not self.__stopping:
+            timeout = None
+            if self.__pending:
+                timeout = max(0, self.__pending[0][0] - time.monotonic())
+            for key, events in self.__selector.select(timeout):
+                if key.data is None:
+                    os.read(key.fd, 64)
+                    continue
+                self.__receive(key.fd, key.data)
+            now = time.monotonic()
+            while self.__pending and self.__pending[0][0] <= now:
+                due, seq, fd, reports = heapq.heappop(self.__pending)
+                for report in reports:
+                    os.write(fd, report)
+
+    def __receive(self, fd, buf):
+        try:
+            buf += os.read(fd, 4096)
+        except BlockingIOError:
+            return
+        # Each write to a hidraw node is a 9 byte report: report number,
+        # then the command.
+        while len(buf) >= 9:
+            cmd = bytes(buf[1:9])
+            del buf[:9]
+            due = time.monotonic() + self.__latency + random.uniform(0, self.__jitter)
+            heapq.heappush(self.__pending, (due, next(self.__seq), fd, self.__respond(cmd)))
+
+    def __respond(self, cmd):
+        if random.random() < self.__error_rate:
+            return [b'\xff' * 8]
+        if cmd == temper.cmd_get_version:
+            return [b'TEMPer2_', b'M12_V1.3']
+        elif cmd == temper.cmd_read_temper:
+            return [b'\x80\x04' + struct.pack('>hh', random.randint(5000, 6000), random.randint(5000, 6000)) + b'\0\0']
+        elif cmd == temper.cmd_get_calibration:
+            if self.__model == 'temper2':
+                return [b'\x82\x02\0\0\0\0\0\0']
+            return [b'\x82\x04\0\0\0\0\0\0']
+        return [bytes([cmd[1]]) + b'\0' * 7]
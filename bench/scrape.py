@@ -0,0 +1,172 @@
+'''
+Measure scrape latency, CPU and memory usage as the number of devices grows.
+
+Each step runs the full exporter (temper_exporter.main) in a child process,
+with udev replaced by a farm of simulated devices, and scrapes it from
+several threads at once. Run from the top of the source tree:
+
+    $ python3 -m bench.scrape --devices 1,10,100,500 -- --sample-interval 5
+'''
+
+import argparse
+import http.client
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', default='1,10,50,100,500', help='Comma-separated list of device counts')
+    parser.add_argument('--model', choices=['temper2', 'temper2hum'], default='temper2', help='Model of device to simulate')
+    parser.add_argument('--latency', type=float, default=0.001, help='Time each simulated device takes to respond, in seconds')
+    parser.add_argument('--jitter', type=float, default=0, help='Random extra response time, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of responses that are garbage')
+    parser.add_argument('--scrapers', type=int, default=4, help='Number of concurrent scrapers')
+    parser.add_argument('--duration', type=float, default=10, help='Time to spend on each device count, in seconds')
+    parser.add_argument('--port', type=int, default=19204, help='Port for the exporter to listen on')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('exporter_args', nargs='*', help='Extra arguments for the exporter (put them after --)')
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    print('{:>7} {:>8} {:>9} {:>9} {:>9} {:>7} {:>8}'.format('devices', 'scrapes', 'req/s', 'p50 ms', 'p99 ms', 'cpu %', 'rss MiB'))
+    for count in (int(c) for c in args.devices.split(',')):
+        result = step(args, count)
+        print('{:>7} {:>8} {:>9.1f} {:>9.2f} {:>9.2f} {:>7.1f} {:>8.1f}'.format(count, *result), flush=True)
+
+def step(args, count):
+    cmd = [sys.executable, '-m', 'bench.scrape', '--child',
+        '--devices', str(count), '--model', args.model,
+        '--latency', str(args.latency), '--jitter', str(args.jitter),
+        '--error-rate', str(args.error_rate), '--port', str(args.port),
+        '--', '--bind-address', '127.0.0.1', '--bind-port', str(args.port)] + args.exporter_args
+    p = subprocess.Popen(cmd)
+    try:
+        wait_until_ready(args.port, count)
+        cpu_before = cpu_seconds(p.pid)
+        latencies = []
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=scraper, args=(args.port, deadline, latencies)) for i in range(args.scrapers)]
+        start = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - start
+        cpu = cpu_seconds(p.pid) - cpu_before
+        rss = rss_bytes(p.pid)
+    finally:
+        p.send_signal(signal.SIGTERM)
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+
+    latencies.sort()
+    return (
+        len(latencies),
+        len(latencies) / elapsed,
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        cpu / elapsed * 100,
+        rss / 2**20,
+    )
+
+def wait_until_ready(port, count, timeout=60):
+    '''
+    Wait until the exporter reports readings from every device.
+    '''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            body = scrape(port)
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.1)
+            continue
+        if body.count(b'\ntemper_temperature_celsius{') >= count:
+            return
+        time.sleep(0.1)
+    raise Exception('Exporter did not become ready')
+
+def scrape(port, conn=None):
+    c = conn or http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        c.request('GET', '/metrics')
+        r = c.getresponse()
+        body = r.read()
+        if r.status != 200:
+            raise http.client.HTTPException(r.status)
+        return body
+    finally:
+        if conn is None:
+            c.close()
+
+def scraper(port, deadline, latencies):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            scrape(port, conn)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            continue
+        latencies.append(time.monotonic() - start)
+    conn.close()
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def cpu_seconds(pid):
+    with open('/proc/{}/stat'.format(pid)) as f:
+        # The command name may contain spaces, but is followed by ') '
+        fields = f.read().rsplit(') ', 1)[1].split()
+    # utime and stime are fields 14 and 15 (counting from 1, including the
+    # pid and command name)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def rss_bytes(pid):
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def child(args):
+    '''
+    Run the exporter, with udev replaced by a device farm.
+    '''
+    import temper_exporter
+    from temper_exporter import temper
+
+    from .farm import DeviceFarm
+
+    farm = DeviceFarm(int(args.devices), args.model, args.latency, args.jitter, args.error_rate)
+    farm.start()
+
+    class IdleMonitor:
+        '''
+        A pyudev.Monitor that never receives any events.
+        '''
+        def start(self):
+            pass
+        def poll(self, timeout=None):
+            time.sleep(timeout)
+            return None
+
+    temper.list_devices = lambda ctx: farm.devices
+    temper.monitor = lambda ctx: IdleMonitor()
+
+    sys.argv = ['temper-exporter'] + args.exporter_args
+    temper_exporter.main()
+
+if __name__ == '__main__':
+    main()
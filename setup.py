@@ -32,13 +32,14 @@ setup(
         'Environment :: No Input/Output (Daemon)',
         'Operating System :: POSIX :: Linux',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.5',
         'Topic :: System :: Monitoring',
     ],
     keywords = 'prometheus monitoring temperature sensor temper',
     packages = ['temper_exporter'],
+    python_requires = '>=3.5.3',
     install_requires = [
-        'prometheus_client',
+        'prometheus_client >= 0.4',
         'pyudev',
         'setuptools',
     ],
@@ -52,6 +53,7 @@ setup(
     entry_points = {
         'console_scripts': [
             'temper-exporter = temper_exporter:main',
+            'temper-exporter-journal = temper_exporter.journal:main',
         ],
     },
 )
@@ -1,4 +1,5 @@
 import argparse
+import configparser
 import ipaddress
 import functools
 import os
@@ -7,14 +8,20 @@ import sys
 import threading
 import wsgiref.simple_server
 
-import prometheus_client
 import prometheus_client.core as core
 import pyudev
 
 from . import exporter
+from . import exposition
+from . import health
+from . import hotplug
 from . import temper
 from . import wsgiext
 
+# Modules for optional features (aggregate, aioserver, devcache, gateway,
+# history, journal, push, sampler) are imported only when they are used,
+# so that startup isn't slowed down by importing asyncio and so on.
+
 def main():
     '''
     You are here.
@@ -24,49 +31,236 @@ def main():
     parser.add_argument('--bind-port', type=int, default=9204, help='Port to listen on')
     parser.add_argument('--bind-v6only', type=int, choices=[0, 1], help='If 1, prevent IPv6 sockets from accepting IPv4 connections; if 0, allow; if unspecified, use OS default')
     parser.add_argument('--thread-count', type=int, help='Number of request-handling threads to spawn')
+    parser.add_argument('--http-server', choices=['threaded', 'asyncio'], default='threaded', help='threaded: one thread per connection, HTTP/1.0; asyncio: an event loop handles all connections, with HTTP/1.1 keep-alive')
+    parser.add_argument('--read-threads', type=int, default=8, help='Number of threads to use for reading from devices')
+    parser.add_argument('--read-timeout', type=float, default=5, help='Give up waiting for a device to respond after this many seconds')
+    parser.add_argument('--unhealthy-after', type=int, default=5, help='Exit once a device has failed to open or read this many times in a row (failed devices are reopened with exponential backoff); 0 to keep retrying forever')
+    parser.add_argument('--coalesce-window', type=float, default=0, help='Unless sampling in the background, serve scrapes that arrive within this many seconds of the last read from the devices from that read\'s results; concurrent scrapes always share one read')
+    parser.add_argument('--scrape-timeout-margin', type=float, default=0.5, help='Unless sampling in the background, stop waiting for devices this many seconds before the scrape timeout sent by Prometheus, and respond with the readings that have arrived')
+    parser.add_argument('--sample-interval', type=float, help='If specified, read from devices every SAMPLE_INTERVAL seconds in the background, rather than when scraped')
+    parser.add_argument('--stale-intervals', type=int, default=3, help='When sampling in the background, drop readings older than this many sample intervals')
+    parser.add_argument('--poll-interval', type=poll_rule, action='append', default=[], metavar='PATTERN=SECONDS', help='When sampling in the background, read from devices whose phy or model (e.g., temper2hum) matches PATTERN every SECONDS seconds, instead of every SAMPLE_INTERVAL seconds; may be repeated')
+    parser.add_argument('--poll-jitter', type=float, default=0.1, help='When sampling in the background, randomly shift each read by up to this fraction of the interval')
+    parser.add_argument('--history-size', type=int, default=0, help='Keep this many of the most recent readings from each sensor in memory, and serve them at /history; 0 to disable')
+    parser.add_argument('--aggregate-window', type=float, help='If specified, also export the minimum, maximum and mean of the readings taken during the previous AGGREGATE_WINDOW seconds; use with a short --sample-interval')
+    parser.add_argument('--journal', metavar='FILE', help='If specified, record readings in FILE, and load --history-size readings from it at startup')
+    parser.add_argument('--journal-size', type=int, default=100000, help='Number of readings to keep in the journal')
+    parser.add_argument('--push-url', metavar='URL', help='If specified, push every reading to URL (e.g., a Prometheus remote-write receiver)')
+    parser.add_argument('--push-format', choices=['remote-write', 'openmetrics'], default='remote-write', help='remote-write: snappy-compressed protobuf; openmetrics: OpenMetrics text')
+    parser.add_argument('--push-batch-size', type=int, default=500, help='Push as soon as this many samples are queued')
+    parser.add_argument('--push-interval', type=float, default=5, help='Push queued samples at least this often (in seconds)')
+    parser.add_argument('--push-queue-size', type=int, default=100000, help='If the push endpoint is unavailable, keep at most this many samples queued; older samples are dropped')
+    parser.add_argument('--calibration-file', metavar='FILE', help='Load calibration offsets from FILE (see temper.load_calibration), overriding those reported by the devices')
+    parser.add_argument('--models-file', metavar='FILE', help='Load additional models from FILE (see temper.load_models)')
+    parser.add_argument('--cache-file', metavar='FILE', help='Remember the version and calibration of each device in FILE, so that they needn\'t be read from the devices again when the exporter restarts')
+    parser.add_argument('--hotplug-debounce', type=float, default=0.5, help='Wait until a device has been quiet for this many seconds before handling its udev events')
+    parser.add_argument('--hotplug-threads', type=int, default=4, help='Number of threads to use for opening newly plugged-in devices')
+    parser.add_argument('--gateway-upstream', type=gateway_upstream, action='append', default=[], metavar='[INSTANCE=]URL', help='Run as a gateway: instead of reading from devices, scrape the exporter at URL, and serve its metrics with an instance label of INSTANCE (by default, the host and port from URL); may be repeated')
+    parser.add_argument('--gateway-interval', type=float, default=15, help='In gateway mode, scrape upstream exporters this often (in seconds)')
+    parser.add_argument('--gateway-timeout', type=float, default=5, help='In gateway mode, give up on an upstream exporter that takes longer than this many seconds to respond')
+    parser.add_argument('--gateway-stale-intervals', type=int, default=3, help='In gateway mode, drop metrics from an upstream exporter that has not been scraped successfully for this many intervals')
     args = parser.parse_args()
 
+    if args.models_file is not None:
+        try:
+            temper.load_models(args.models_file)
+        except (OSError, ValueError, configparser.Error) as e:
+            parser.error(str(e))
+    if args.calibration_file is not None:
+        try:
+            temper.load_calibration(args.calibration_file)
+        except (OSError, ValueError, configparser.Error) as e:
+            parser.error(str(e))
+
+    instances = [u.instance for u in args.gateway_upstream]
+    for instance in sorted(set(instances)):
+        if instances.count(instance) > 1:
+            # Their metrics would clash
+            parser.error('more than one --gateway-upstream with instance {!r}'.format(instance))
+
+    if args.journal is not None and not args.gateway_upstream:
+        from . import journal
+        try:
+            jrnl = journal.Journal(args.journal, args.journal_size)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+
+    if args.cache_file is not None:
+        from . import devcache
+        temper.device_cache = devcache.DeviceCache(args.cache_file)
+
+    if args.http_server == 'asyncio':
+        from . import aioserver
+        server = aioserver.AsyncServer((str(args.bind_address), args.bind_port), max_threads=args.thread_count, bind_v6only=args.bind_v6only)
+    else:
+        server = wsgiext.Server((str(args.bind_address), args.bind_port), max_threads=args.thread_count, bind_v6only=args.bind_v6only)
+
+    if args.gateway_upstream:
+        return gateway_main(args, server)
+
     class MyCollector(exporter.Collector):
         def class_for_device(self, device):
             return temper.matcher.match(device)
-    collector = MyCollector()
+    if args.sample_interval is None:
+        max_age = None
+    else:
+        max_age = args.sample_interval * args.stale_intervals
+    collector = MyCollector(max_age=max_age, read_threads=args.read_threads, read_timeout=args.read_timeout, unhealthy_after=args.unhealthy_after or None, coalesce_window=args.coalesce_window)
     core.REGISTRY.register(collector)
+    if args.aggregate_window is not None:
+        from . import aggregate
+        aggregator = aggregate.Aggregator(args.aggregate_window)
+        collector.add_listener(aggregator.record)
+        core.REGISTRY.register(aggregator)
+
+    if args.sample_interval is None:
+        app = exposition.Exposition()
+    else:
+        app = exposition.CachedExposition(collector)
+    if args.history_size > 0:
+        from . import history
+        hist = history.History(args.history_size)
+        if args.journal is not None:
+            jrnl.replay(hist.record)
+        collector.add_listener(hist.record)
+        app = wsgiext.dispatch({'/history': history.HistoryApp(hist)}, app)
+    if args.journal is not None:
+        collector.add_listener(jrnl.record)
+    wsgi_thread = threading.Thread(target=functools.partial(server.serve_forever, poll_interval=server.heartbeat_interval), name='wsgi')
 
-    server = wsgiext.Server((str(args.bind_address), args.bind_port), max_threads=args.thread_count, bind_v6only=args.bind_v6only)
-    server.set_app(prometheus_client.make_wsgi_app())
-    wsgi_thread = threading.Thread(target=functools.partial(server.serve_forever, poll_interval=86400), name='wsgi')
+    # Commands are sent to the devices from this thread's event loop, so that
+    # a device that stops responding can't hang the threads reading from it.
+    from . import aiotemper
+    reactor_thread = aiotemper.Reactor(args.read_timeout)
+    temper.reactor = reactor_thread
 
     ctx = pyudev.Context()
     mon = temper.monitor(ctx)
-    observer_thread = pyudev.MonitorObserver(mon, name='monitor', callback=collector.handle_device_event)
+    hotplug_thread = hotplug.Hotplug(collector, debounce=args.hotplug_debounce, workers=args.hotplug_threads)
+    observer_thread = hotplug.Monitor(mon, hotplug_thread.enqueue)
+
+    threads = [reactor_thread, wsgi_thread, hotplug_thread, observer_thread]
+    components = {'collector': collector, 'server': server, 'hotplug': hotplug_thread, 'monitor': observer_thread, 'reactor': reactor_thread}
+    if args.push_url is not None:
+        from . import push
+        push_thread = push.Pusher(args.push_url, format=args.push_format, batch_size=args.push_batch_size, interval=args.push_interval, max_queue=args.push_queue_size)
+        collector.add_listener(push_thread.record)
+        threads.append(push_thread)
+        components['push'] = push_thread
+    if args.sample_interval is not None:
+        from . import sampler
+        sampler_thread = sampler.Sampler(collector, args.sample_interval, rules=args.poll_interval, stale_intervals=args.stale_intervals, jitter=args.poll_jitter)
+        threads.append(sampler_thread)
+        components['sampler'] = sampler_thread
+
+    # Set once the devices that were already plugged in have been opened
+    ready = threading.Event()
+    app = wsgiext.dispatch({
+        '/healthz': health.HealthApp(components),
+        '/readyz': health.HealthApp(components, ready),
+    }, app)
+    server.set_app(wsgiext.scrape_timeout(app, args.scrape_timeout_margin))
 
-    health_thread = Health([collector, server], 30)
+    health_thread = Health(components.values(), 30)
+    threads.append(health_thread)
 
     def handle_sigterm(signum, frame):
+        health.sd_notify('STOPPING=1')
         health_thread.send_stop()
         server.send_stop()
         observer_thread.send_stop()
+        hotplug_thread.send_stop()
+        if args.sample_interval is not None:
+            sampler_thread.send_stop()
+        if args.push_url is not None:
+            push_thread.send_stop()
+        reactor_thread.send_stop()
     signal.signal(signal.SIGTERM, handle_sigterm)
 
-    wsgi_thread.start()
-    observer_thread.start()
-    health_thread.start()
+    for thread in threads:
+        thread.start()
+
+    # A wedged device mustn't stop us from ever becoming ready: systemd would
+    # kill us for not starting up in time.
+    collector.coldplug_scan(temper.list_devices(ctx), timeout=30)
+    ready.set()
+    health.sd_notify('READY=1')
+
+    for thread in threads:
+        thread.join()
+
+    server.server_close()
+    if args.journal is not None:
+        jrnl.close()
+
+    sys.exit(health_thread.exit_status)
+
+def gateway_main(args, server):
+    '''
+    Scrape other exporters, instead of reading from devices.
+    '''
+    from . import gateway
+    gateway_thread = gateway.Gateway(args.gateway_upstream, interval=args.gateway_interval, timeout=args.gateway_timeout, max_age=args.gateway_interval * args.gateway_stale_intervals)
+    # The upstreams' process metrics and so on are passed through, so our own
+    # would clash with them.
+    registry = core.CollectorRegistry()
+    registry.register(gateway_thread)
+    components = {'gateway': gateway_thread, 'server': server}
+    server.set_app(wsgiext.dispatch({
+        '/healthz': health.HealthApp(components),
+        '/readyz': health.HealthApp(components),
+    }, exposition.CachedExposition(gateway_thread, registry)))
+    wsgi_thread = threading.Thread(target=functools.partial(server.serve_forever, poll_interval=server.heartbeat_interval), name='wsgi')
 
-    collector.coldplug_scan(temper.list_devices(ctx))
+    health_thread = Health(components.values(), 30)
+    threads = [wsgi_thread, gateway_thread, health_thread]
 
-    wsgi_thread.join()
-    observer_thread.join()
-    health_thread.join()
+    def handle_sigterm(signum, frame):
+        health.sd_notify('STOPPING=1')
+        health_thread.send_stop()
+        server.send_stop()
+        gateway_thread.send_stop()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    for thread in threads:
+        thread.start()
+    health.sd_notify('READY=1')
+
+    for thread in threads:
+        thread.join()
 
     server.server_close()
 
     sys.exit(health_thread.exit_status)
 
+def gateway_upstream(value):
+    '''
+    Parses [INSTANCE=]URL; see gateway.upstream().
+    '''
+    from . import gateway
+    return gateway.upstream(value)
+
+def poll_rule(value):
+    '''
+    Parses PATTERN=SECONDS.
+    '''
+    pattern, sep, interval = value.rpartition('=')
+    if not sep or not pattern:
+        raise argparse.ArgumentTypeError('expected PATTERN=SECONDS')
+    try:
+        return pattern, float(interval)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid interval {!r}'.format(interval))
+
 class Health(threading.Thread):
     def __init__(self, components, interval):
         super().__init__(name='health')
-        self.__components = (component for component in components)
-        self.__interval = interval
+        self.__components = list(components)
+        # If systemd's watchdog is enabled, we must check in with it more
+        # often than it expects.
+        watchdog = health.watchdog_interval()
+        self.__watchdog = watchdog is not None
+        self.__interval = interval if watchdog is None else min(interval, watchdog)
         self.__event = threading.Event()
         self.exit_status = 0
 
@@ -82,7 +276,8 @@ class Health(threading.Thread):
 
         If something fails, sends SIGTERM to the process. The signal handler
         (which always runs in the main thread) will shut down the components
-        and then the process will exit.
+        and then the process will exit. Otherwise, pats systemd's watchdog
+        (if it is enabled).
 
         We don't have to provide detailed error messages, since the component
         that failed should already have logged something useful.
@@ -92,6 +287,8 @@ class Health(threading.Thread):
                 if not self.__healthy():
                     self.exit_status = 1
                     return
+                if self.__watchdog:
+                    health.sd_notify('WATCHDOG=1')
         finally:
             if self.exit_status != 0:
                 os.kill(os.getpid(), signal.SIGTERM)
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import prometheus_client.core as core
+
+metric_names = {
+    'temp': 'temper_temperature_celsius',
+    'humid': 'temper_humidity_rh',
+}
+
+class Window:
+    '''
+    Running minimum, maximum, sum and count of the readings taken during one
+    window; index is the number of whole windows between the epoch and the
+    start of the window.
+    '''
+    __slots__ = ('index', 'min', 'max', 'sum', 'count')
+
+    def __init__(self, index, value):
+        self.index = index
+        self.min = value
+        self.max = value
+        self.sum = value
+        self.count = 1
+
+    def add(self, value):
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+
+class Aggregator:
+    '''
+    A collector that summarises readings over fixed windows of window seconds
+    (aligned to multiples of window since the epoch), so that a device can be
+    read many times between scrapes without losing short-lived spikes.
+
+    For each sensor, the minimum, maximum, mean and number of readings from
+    the most recently completed window are exported. Nothing is exported for
+    a sensor that was not read during the previous window.
+
+    Register record() as a listener with an exporter.Collector to feed it.
+    '''
+    def __init__(self, window):
+        self.__window = window
+        # (type, name, phy, version) -> [current Window, previous Window]
+        self.__windows = {}
+        self.__lock = threading.Lock()
+
+    def record(self, timestamp, phy, version, readings):
+        index = int(timestamp // self.__window)
+        with self.__lock:
+            for type_, name, value in readings:
+                key = (type_, name, phy, version)
+                windows = self.__windows.get(key)
+                if windows is None:
+                    self.__windows[key] = [Window(index, value), None]
+                elif windows[0].index == index:
+                    windows[0].add(value)
+                elif windows[0].index < index:
+                    windows[1] = windows[0]
+                    windows[0] = Window(index, value)
+                # Otherwise the clock went backwards; drop the reading.
+
+    def collect(self):
+        previous = int(time.time() // self.__window) - 1
+        families = {}
+        for type_, metric in metric_names.items():
+            labels = ['name', 'phy', 'version']
+            families[type_] = (
+                core.GaugeMetricFamily(metric + '_min', 'Minimum reading during the previous aggregation window', labels=labels),
+                core.GaugeMetricFamily(metric + '_max', 'Maximum reading during the previous aggregation window', labels=labels),
+                core.GaugeMetricFamily(metric + '_avg', 'Mean reading during the previous aggregation window', labels=labels),
+                core.GaugeMetricFamily(metric + '_samples', 'Number of readings taken during the previous aggregation window', labels=labels),
+            )
+
+        with self.__lock:
+            items = [(key, list(windows)) for key, windows in self.__windows.items()]
+        for (type_, name, phy, version), windows in items:
+            if type_ not in families:
+                continue
+            # If nothing has been read since the previous window ended, the
+            # current window is the previous one.
+            for w in windows:
+                if w is not None and w.index == previous:
+                    break
+            else:
+                continue
+            min_, max_, avg, samples = families[type_]
+            labelvalues = [name, phy, version]
+            min_.add_metric(labelvalues, w.min)
+            max_.add_metric(labelvalues, w.max)
+            avg.add_metric(labelvalues, w.sum / w.count)
+            samples.add_metric(labelvalues, w.count)
+
+        for type_ in metric_names:
+            yield from families[type_]
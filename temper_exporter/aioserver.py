@@ -0,0 +1,258 @@
+import asyncio
+import concurrent.futures
+from contextlib import suppress
+import email.utils
+import io
+import socket
+import sys
+import time
+import traceback
+import urllib.parse
+
+from . import wsgiext
+
+class AsyncServer(wsgiext.HealthCheck):
+    '''
+    An HTTP/1.1 server for a WSGI app, built on asyncio.
+
+    Connections are handled by an event loop running in the thread that calls
+    serve_forever(), so idle keep-alive connections cost almost nothing.
+    Requests on a connection (including pipelined requests) are answered in
+    order. The app itself is called from a pool of up to max_threads threads,
+    since collecting metrics may block.
+
+    Request bodies larger than max_body_size bytes are refused.
+
+    The interface mirrors that of wsgiext.Server.
+    '''
+    def __init__(self, server_address, max_threads=None, bind_v6only=None, keepalive_timeout=75, max_body_size=65536):
+        super().__init__()
+        self.socket = socket.socket(wsgiext.address_family(server_address[0]), socket.SOCK_STREAM)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            wsgiext.prepare_listening_socket(self.socket, bind_v6only)
+            self.socket.bind(server_address)
+            self.socket.listen(128)
+        except Exception:
+            self.socket.close()
+            raise
+        self.server_address = self.socket.getsockname()[:2]
+        self.__keepalive_timeout = keepalive_timeout
+        self.__max_body_size = max_body_size
+        self.__app = None
+        self.__ex = concurrent.futures.ThreadPoolExecutor(max_threads)
+        self.__loop = asyncio.new_event_loop()
+        self.__stop = None
+        self.__stopping = False
+        self.__connections = {}
+
+    def set_app(self, app):
+        self.__app = app
+
+    def serve_forever(self, poll_interval=None):
+        '''
+        poll_interval is ignored; send_stop() takes effect immediately.
+        '''
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_until_complete(self.__serve())
+
+    def send_stop(self):
+        '''
+        Cause serve_forever() to return. May be called from any thread
+        (including from a signal handler).
+        '''
+        self.__loop.call_soon_threadsafe(self.__request_stop)
+
+    def server_close(self):
+        self.socket.close()
+        self.__ex.shutdown()
+        self.__loop.close()
+
+    def __request_stop(self):
+        self.__stopping = True
+        if self.__stop is not None and not self.__stop.done():
+            self.__stop.set_result(None)
+
+    async def __serve(self):
+        self.__stop = self.__loop.create_future()
+        if self.__stopping:
+            self.__stop.set_result(None)
+        server = await asyncio.start_server(self.__accept, sock=self.socket)
+        heartbeat = self.__loop.create_task(self.__heartbeat())
+        try:
+            await self.__stop
+        finally:
+            heartbeat.cancel()
+            server.close()
+            # Idle keep-alive connections would otherwise hold us up
+            for writer in self.__connections:
+                writer.close()
+            if self.__connections:
+                await asyncio.wait(list(self.__connections.values()))
+            await server.wait_closed()
+
+    async def __heartbeat(self):
+        while True:
+            self.heartbeat.beat()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def __accept(self, reader, writer):
+        # Keep hold of the task, so that __serve can wait for it to finish
+        # when stopping. (asyncio.current_task() would do, but needs Python
+        # 3.7.)
+        self.__connections[writer] = self.__loop.create_task(self.__handle_connection(reader, writer))
+
+    async def __handle_connection(self, reader, writer):
+        try:
+            while not self.__stopping:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.__keepalive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.__respond_error(writer, '431 Request Header Fields Too Large')
+                    break
+                if not await self.__handle_request(head, reader, writer):
+                    break
+        finally:
+            del self.__connections[writer]
+            writer.close()
+
+    async def __handle_request(self, head, reader, writer):
+        '''
+        Returns True if the connection should be kept alive.
+        '''
+        client_address = writer.get_extra_info('peername')
+        lines = head.decode('iso-8859-1').split('\r\n')
+        requestline = lines[0]
+        try:
+            method, target, version = requestline.split()
+            if not version.startswith('HTTP/1.'):
+                raise ValueError
+            headers = [line.split(':', 1) for line in lines[1:] if line]
+            headers = [(name.strip().lower(), value.strip()) for name, value in headers]
+        except ValueError:
+            await self.__respond_error(writer, '400 Bad Request', client_address, requestline)
+            return False
+
+        header_dict = {}
+        for name, value in headers:
+            if name in header_dict:
+                header_dict[name] += ',' + value
+            else:
+                header_dict[name] = value
+
+        connection = header_dict.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = 'keep-alive' in connection
+        else:
+            keep_alive = 'close' not in connection
+
+        if 'transfer-encoding' in header_dict:
+            await self.__respond_error(writer, '501 Not Implemented', client_address, requestline)
+            return False
+        try:
+            content_length = int(header_dict.get('content-length', 0))
+            if content_length < 0:
+                raise ValueError
+        except ValueError:
+            await self.__respond_error(writer, '400 Bad Request', client_address, requestline)
+            return False
+        if content_length > self.__max_body_size:
+            await self.__respond_error(writer, '413 Payload Too Large', client_address, requestline)
+            return False
+        try:
+            body = await reader.readexactly(content_length)
+        except asyncio.IncompleteReadError:
+            return False
+
+        path, _, query = target.partition('?')
+        host, port = self.server_address[:2]
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote(path, 'iso-8859-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': host,
+            'SERVER_PORT': str(port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': client_address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in header_dict.items():
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'content-length':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+        try:
+            status, response_headers, body = await self.__loop.run_in_executor(self.__ex, self.__call_app, environ)
+        except Exception:
+            traceback.print_exc()
+            await self.__respond_error(writer, '500 Internal Server Error', client_address, requestline)
+            return False
+
+        if method == 'HEAD':
+            body = b''
+        if not any(name.lower() == 'content-length' for name, value in response_headers):
+            response_headers.append(('Content-Length', str(len(body))))
+        response_headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+        self.__log_request(client_address, requestline, status, len(body))
+        await self.__write_response(writer, status, response_headers, body)
+        return keep_alive
+
+    def __call_app(self, environ):
+        '''
+        Runs in a thread from the pool. Returns (status, headers, body).
+        '''
+        response = []
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, list(headers)]
+        result = self.__app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response[0], response[1], body
+
+    async def __write_response(self, writer, status, headers, body):
+        head = ['HTTP/1.1 {}'.format(status)]
+        head.append('Date: {}'.format(email.utils.formatdate(usegmt=True)))
+        head.extend('{}: {}'.format(name, value) for name, value in headers)
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('iso-8859-1') + body)
+        with suppress(ConnectionError):
+            await writer.drain()
+
+    async def __respond_error(self, writer, status, client_address=None, requestline=''):
+        body = status.encode('ascii') + b'\r\n'
+        if client_address is not None:
+            self.__log_request(client_address, requestline, status, len(body))
+        await self.__write_response(writer, status, [('Content-Type', 'text/plain'), ('Content-Length', str(len(body))), ('Connection', 'close')], body)
+
+    def __log_request(self, client_address, requestline, status, size):
+        '''
+        Like wsgiext.SilentRequestHandler, only log unsuccessful requests.
+        '''
+        code = status.split(' ', 1)[0]
+        if code < '4':
+            return
+        sys.stderr.write('{} - - [{}] "{}" {} {}\n'.format(client_address[0], log_date_time_string(), requestline, code, size))
+
+def log_date_time_string():
+    '''
+    Same format as http.server.BaseHTTPRequestHandler.log_date_time_string.
+    '''
+    year, month, day, hh, mm, ss, x, y, z = time.localtime()
+    monthname = [None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+    return '%02d/%3s/%04d %02d:%02d:%02d' % (day, monthname[month], year, hh, mm, ss)
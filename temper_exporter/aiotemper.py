@@ -0,0 +1,267 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import os
+import sys
+import threading
+import time
+
+from . import health
+from . import temper
+
+class async_usb_temper:
+    '''
+    Like temper.usb_temper, but the hidraw node is opened in non-blocking
+    mode and reports are received via the event loop, so a single thread can
+    service many devices, and a device that stops responding can't hang
+    anything: every command has a timeout.
+    '''
+    def __init__(self, udev_device, model, timeout=1):
+        '''
+        Don't call this directly; use open() instead, which must be called
+        from a coroutine running in the event loop that will service the
+        device.
+
+        model is a temper.usb_temper subclass (as returned by
+        temper.matcher.match) whose sensor_format and convert() are used to
+        decode sensor readings.
+        '''
+        self.__udev_device = udev_device
+        self.__model = model
+        self.timeout = timeout
+        self.__loop = asyncio.get_event_loop()
+        self.__reports = collections.deque()
+        self.__waiter = None
+        self.calibration = {}
+        self.__fd = os.open(udev_device.device_node, os.O_RDWR | os.O_NONBLOCK)
+        self.__loop.add_reader(self.__fd, self.__readable)
+
+    @classmethod
+    async def open(cls, udev_device, model, timeout=1):
+        '''
+        Open a device and read its version string and calibration.
+        '''
+        t = cls(udev_device, model, timeout)
+        try:
+            t.version = await t.read_version()
+            t.calibration = await t.read_calibration_offsets()
+        except Exception:
+            t.close()
+            raise
+        return t
+
+    def __del__(self):
+        with contextlib.suppress(Exception):
+            self.close()
+
+    def __repr__(self):
+        return '<{}({!r}, {})>'.format(self.__class__.__name__, self.__udev_device.sys_path, self.__model.__name__)
+
+    def __readable(self):
+        # Each read() of a hidraw node returns a single report.
+        while True:
+            try:
+                buf = os.read(self.__fd, 8)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                # Wake up the waiting command, which will raise the error.
+                buf = e
+            self.__reports.append(buf)
+            if isinstance(buf, OSError):
+                break
+        if self.__waiter is not None and not self.__waiter.done():
+            self.__waiter.set_result(None)
+
+    async def read8(self, timeout=None):
+        '''
+        Wait for the next report from the device.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        if not self.__reports:
+            self.__waiter = self.__loop.create_future()
+            try:
+                await asyncio.wait_for(self.__waiter, timeout)
+            except asyncio.TimeoutError:
+                raise IOError('Timed out waiting for response from {}'.format(self.__udev_device.device_node))
+            finally:
+                self.__waiter = None
+        buf = self.__reports.popleft()
+        if isinstance(buf, OSError):
+            raise buf
+        return buf
+
+    def write(self, data):
+        # Discard any reports left over from commands that timed out, so that
+        # they are not mistaken for the response to this one.
+        self.__reports.clear()
+        # First byte is report number, or 0 if the device does not use numbered reports
+        buf = b'\x00' + data
+        nbytes = os.write(self.__fd, buf)
+        if nbytes != len(buf):
+            raise IOError('Short write ({}/{})'.format(nbytes, len(buf)))
+
+    async def send(self, cmd, fmt, timeout=None):
+        '''
+        Issue a command, check and decode the response.
+        '''
+        assert len(cmd) == 8
+        start = time.perf_counter()
+        self.write(cmd)
+        buf = await self.read8(timeout)
+        temper.observe_command(cmd, start)
+        return temper.decode_response(cmd, fmt, buf)
+
+    async def send_many(self, commands, timeout=None):
+        '''
+        Like temper.usb_temper.send_many().
+        '''
+        start = time.perf_counter()
+        # No reports are received between these writes, so none of the
+        # responses are discarded
+        for cmd, fmt in commands:
+            assert len(cmd) == 8
+            self.write(cmd)
+        responses = []
+        for cmd, fmt in commands:
+            buf = await self.read8(timeout)
+            if cmd == temper.cmd_get_version:
+                buf += await self.read8(timeout)
+            temper.observe_command(cmd, start)
+            responses.append(buf)
+        return [temper.decode_version(buf) if cmd == temper.cmd_get_version else temper.decode_response(cmd, fmt, buf) for (cmd, fmt), buf in zip(commands, responses)]
+
+    async def read_version(self, timeout=None):
+        start = time.perf_counter()
+        self.write(temper.cmd_get_version)
+        buf = await self.read8(timeout) + await self.read8(timeout)
+        temper.observe_command(temper.cmd_get_version, start)
+        return temper.decode_version(buf)
+
+    async def read_calibration_offsets(self, timeout=None):
+        '''
+        Like temper.usb_temper.read_calibration_offsets().
+        '''
+        return temper.override_calibration(self.__model, self.phy(), await self.read_device_offsets(timeout))
+
+    async def read_device_offsets(self, timeout=None):
+        '''
+        Like temper.usb_temper.read_device_offsets().
+        '''
+        phy = self.phy()
+        devnum, offsets = temper.cached_calibration(self.__model, self.__udev_device, phy)
+        if offsets is None:
+            try:
+                offsets = self.__model.offsets(await self.send(temper.cmd_get_calibration, self.__model.calibration_format, timeout))
+            except IOError as e:
+                print('Error reading calibration from {}: {}'.format(phy, e), file=sys.stderr)
+                offsets = {}
+            else:
+                temper.cache_calibration(phy, devnum, offsets)
+        return offsets
+
+    async def read_sensor(self, timeout=None):
+        '''
+        Returns a list of (type, name, value) tuples, as described in
+        temper.usb_temper.convert(), with the device's calibration applied.
+        '''
+        if self.__model.sensor_format is None:
+            raise IOError('Not implemented')
+        return list(temper.calibrate(self.__model.convert(await self.send(temper.cmd_read_temper, self.__model.sensor_format, timeout)), self.calibration))
+
+    def close(self):
+        if self.__fd is None:
+            return
+        self.__loop.remove_reader(self.__fd)
+        os.close(self.__fd)
+        self.__fd = None
+
+    def phy(self):
+        '''
+        Same as returned by the HIDIOCGRAWPHYS ioctl.
+        '''
+        hid = self.__udev_device.find_parent(subsystem=b'hid')
+        return hid.properties.get('HID_PHYS')
+
+class Reactor(threading.Thread):
+    '''
+    Runs an event loop in its own thread, through which temper.usb_temper
+    sends its commands when temper.reactor is set. Every command gives up
+    after timeout seconds, so a device that stops responding can't hang the
+    thread that is reading from it.
+    '''
+    def __init__(self, timeout=1):
+        super().__init__(name='reactor')
+        self.timeout = timeout
+        self.__loop = asyncio.new_event_loop()
+        # The loop below wakes up once a second
+        self.heartbeat = health.Heartbeat(30)
+
+    def run(self):
+        asyncio.set_event_loop(self.__loop)
+        self.__beat()
+        try:
+            self.__loop.run_forever()
+        finally:
+            self.__loop.close()
+
+    def __beat(self):
+        self.heartbeat.beat()
+        self.__loop.call_later(1, self.__beat)
+
+    def send_stop(self):
+        '''
+        Cause the thread to exit. Commands in progress fail with IOError.
+        '''
+        with contextlib.suppress(RuntimeError):
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+
+    def healthy(self):
+        return self.is_alive() and self.heartbeat.healthy()
+
+    def call(self, coro):
+        '''
+        Runs a coroutine in the event loop, and returns its result.
+        '''
+        try:
+            future = asyncio.run_coroutine_threadsafe(coro, self.__loop)
+        except RuntimeError:
+            coro.close()
+            raise IOError('Event loop is closed')
+        try:
+            # Each command has its own timeout, and none needs more than two
+            # reports; this is only in case the loop itself is stuck.
+            return future.result(self.timeout * 3 + 1)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise IOError('Timed out waiting for event loop')
+        except concurrent.futures.CancelledError:
+            raise IOError('Event loop stopped')
+
+    def open(self, udev_device, model):
+        '''
+        Returns an async_usb_temper for a device, serviced by the event loop.
+        '''
+        async def open_():
+            return async_usb_temper(udev_device, model, self.timeout)
+        return self.call(open_())
+
+    def close(self, t):
+        '''
+        Closes an async_usb_temper returned by open(), without waiting.
+        '''
+        try:
+            self.__loop.call_soon_threadsafe(t.close)
+        except RuntimeError:
+            # The loop is closed, so nothing else is using the device
+            t.close()
+
+async def read_sensors(devices, timeout=None):
+    '''
+    Read from several devices concurrently. Returns a list containing, for
+    each device, either its readings or the exception that was raised while
+    reading from it.
+    '''
+    return await asyncio.gather(*(t.read_sensor(timeout) for t in devices), return_exceptions=True)
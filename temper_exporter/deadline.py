@@ -0,0 +1,33 @@
+'''
+Keeps track of how long the request being handled by the current thread has
+left before the client gives up on it.
+'''
+
+import contextlib
+import threading
+import time
+
+local = threading.local()
+
+def remaining():
+    '''
+    Returns the number of seconds left until the current thread's deadline
+    (which may be negative), or None if it has no deadline.
+    '''
+    deadline = getattr(local, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+@contextlib.contextmanager
+def within(seconds):
+    '''
+    Sets the current thread's deadline to seconds from now, for the duration
+    of the with block.
+    '''
+    previous = getattr(local, 'deadline', None)
+    local.deadline = time.monotonic() + seconds
+    try:
+        yield
+    finally:
+        local.deadline = previous
@@ -0,0 +1,94 @@
+'''
+A cache of each device's static information, kept in a JSON file, so that
+when the exporter restarts it doesn't have to ask every device for it again.
+'''
+
+import json
+import os
+import sys
+import threading
+
+FORMAT_VERSION = 1
+
+class DeviceCache:
+    '''
+    Maps the sysfs path of a device's hidraw node to its version string, phy
+    and calibration offsets (as returned by usb_temper.offsets()).
+
+    An entry is only used if the USB device's serial number and device
+    number are the same as when it was stored, so a device that has been
+    plugged in again (or replaced with another) is probed again.
+
+    The file is rewritten whenever an entry changes. If it can't be read, it
+    is ignored.
+    '''
+    def __init__(self, path):
+        self.__path = path
+        self.__lock = threading.Lock()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('format') != FORMAT_VERSION:
+                raise ValueError('Unknown format {!r}'.format(data.get('format')))
+            self.__entries = dict(data['devices'])
+        except FileNotFoundError:
+            self.__entries = {}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            print('Ignoring device cache {}: {}'.format(path, e), file=sys.stderr)
+            self.__entries = {}
+
+    @staticmethod
+    def identity(udev_device):
+        '''
+        Returns [serial, devnum] for the USB device that udev_device belongs
+        to, or None if it isn't a USB device.
+        '''
+        usb = udev_device.find_parent(subsystem=b'usb', device_type=b'usb_device')
+        if usb is None:
+            return None
+        return [usb.properties.get('ID_SERIAL'), usb.properties.get('DEVNUM')]
+
+    def get(self, udev_device):
+        '''
+        Returns (version, phy, offsets) for a device, or None if it is not
+        in the cache.
+        '''
+        identity = self.identity(udev_device)
+        if identity is None:
+            return None
+        with self.__lock:
+            entry = self.__entries.get(udev_device.sys_path)
+        if entry is None or entry.get('identity') != identity:
+            return None
+        try:
+            return entry['version'], entry['phy'], {(type_, name): float(offset) for type_, name, offset in entry['calibration']}
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def put(self, udev_device, version, phy, offsets):
+        identity = self.identity(udev_device)
+        if identity is None:
+            return
+        entry = {
+            'identity': identity,
+            'version': version,
+            'phy': phy,
+            'calibration': sorted([type_, name, offset] for (type_, name), offset in offsets.items()),
+        }
+        with self.__lock:
+            if self.__entries.get(udev_device.sys_path) == entry:
+                return
+            self.__entries[udev_device.sys_path] = entry
+            self.__save()
+
+    def __save(self):
+        '''
+        Call with __lock held.
+        '''
+        tmp = self.__path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'format': FORMAT_VERSION, 'devices': self.__entries}, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.__path)
+        except OSError as e:
+            print('Error saving device cache {}: {}'.format(self.__path, e), file=sys.stderr)
@@ -1,76 +1,411 @@
+import concurrent.futures
 from contextlib import suppress
 import sys
 import threading
+import time
 
 import prometheus_client
-import prometheus_client.core as core
+
+from . import deadline
+from . import exposition
+from . import instrument
+from . import registry
+
+collect_duration = instrument.Histogram('temper_exporter_collect_duration_seconds', 'Time taken to collect readings')
+read_errors = instrument.Counter('temper_exporter_read_errors', 'Number of errors reading from devices', ['phy'])
+device_event_duration = instrument.Histogram('temper_exporter_device_event_duration_seconds', 'Time taken to handle a udev event', ['action'])
+scrapes_coalesced = instrument.Counter('temper_exporter_scrapes_coalesced', 'Number of scrapes that shared another scrape\'s readings instead of reading from the devices')
+coldplug_duration = instrument.Gauge('temper_exporter_coldplug_duration_seconds', 'Time taken by the coldplug scan at startup')
+
+class Failure:
+    '''
+    Tracks a device that could not be opened or read, and when to next try to
+    reopen it.
+    '''
+    def __init__(self, phy, version):
+        self.phy = phy
+        self.version = version
+        self.count = 0
+        self.retry_at = 0
+        self.retrying = False
 
 class Collector:
 
-    def __init__(self):
-        self.__sensors = {}
-        self.__read_lock = threading.Lock()
+    def __init__(self, max_age=None, read_threads=8, read_timeout=5, retry_interval=1, max_retry_interval=300, unhealthy_after=1, coalesce_window=0):
+        '''
+        If max_age is None, every device is read each time the collector is
+        scraped. Otherwise, something else (usually a sampler.Sampler thread)
+        is expected to call sample() periodically; collect() then renders the
+        most recent readings, dropping any that are older than max_age
+        seconds.
+
+        If max_age is None, a scrape that arrives while another is reading
+        from the devices waits for it to finish and then uses its readings,
+        rather than reading from the devices again; so does a scrape that
+        arrives within coalesce_window seconds of the last read finishing.
+        If the scrape has a deadline (see the deadline module), devices that
+        haven't responded by then are left out, and reported as stale.
+
+        Devices are read concurrently by up to read_threads threads. A device
+        that takes longer than read_timeout seconds to respond is left
+        behind, and counted in the temper_read_timeouts_total metric; if it
+        still hasn't responded the next time it is due to be read, it is
+        treated as having failed.
+
+        A device that fails is closed, and reopened by recover() after
+        retry_interval seconds, doubling after each further failure up to
+        max_retry_interval. The collector reports itself unhealthy once a
+        device has failed unhealthy_after times in a row (or never, if
+        unhealthy_after is None); a reopened device's failures are only
+        forgotten once it has been read successfully.
+        '''
+        # The rest of the state of each open device is kept in its
+        # registry.Entry
+        self.__registry = registry.Registry()
+        # device -> Failure, for devices that are waiting to be reopened.
+        # Replaced rather than changed, so that collect() can iterate over it
+        # without copying it.
+        self.__failed = {}
+        self.__max_age = max_age
+        self.__reader = concurrent.futures.ThreadPoolExecutor(read_threads)
+        self.__read_timeout = read_timeout
+        self.__retry_interval = retry_interval
+        self.__max_retry_interval = max_retry_interval
+        self.__unhealthy_after = unhealthy_after
         self.__write_lock = threading.Lock()
-        self.__healthy = True
+        self.__generation = 0
+        self.__listeners = []
+        self.__coalesce_window = coalesce_window
+        self.__flight_lock = threading.Lock()
+        # Set when the read in progress finishes; None if no read is in
+        # progress
+        self.__flight = None
+        # The devices that the read in progress is reading from
+        self.__flight_devices = frozenset()
+        self.__last_flight = None
+        # Devices that didn't respond in time during the last read
+        self.__stale = frozenset()
 
 
     def collect(self):
-        temp = core.GaugeMetricFamily('temper_temperature_celsius', 'Temperature reading', labels=['name', 'phy', 'version'])
-        humid = core.GaugeMetricFamily('temper_humidity_rh', 'Relative humidity reading', labels=['name', 'phy', 'version'])
-
-        # Prevent two threads from reading from a device at the same time.
-        # Heavy handed, but easier than a lock for each device.
-        with self.__read_lock:
-            # Copy the dict so we can modify it during iteration
-            for device, t in self.__sensors.copy().items():
-                try:
-                    readings = list(t.read_sensor())
-                except IOError:
-                    print('Error reading from {}'.format(device), file=sys.stderr)
-                    self.__healthy = False
-                    with suppress(IOError):
-                        t.close()
-                    with self.__write_lock:
-                        del self.__sensors[device]
-                    continue
-
-                for type_, name, value in readings:
+        start = time.perf_counter()
+        stale_devices = self.__sample_once() if self.__max_age is None else ()
+
+        temp = exposition.GaugeMetricFamily('temper_temperature_celsius', 'Temperature reading', labels=['name', 'phy', 'version'])
+        humid = exposition.GaugeMetricFamily('temper_humidity_rh', 'Relative humidity reading', labels=['name', 'phy', 'version'])
+        timeouts = exposition.CounterMetricFamily('temper_read_timeouts', 'Number of times a device failed to respond in time', labels=['phy', 'version'])
+        up = exposition.GaugeMetricFamily('temper_device_up', 'Whether a device is working (1), or has failed and is being retried (0)', labels=['phy', 'version'])
+        failures = exposition.GaugeMetricFamily('temper_device_consecutive_failures', 'Number of times in a row that a device has failed to open or read', labels=['phy', 'version'])
+        stale = exposition.GaugeMetricFamily('temper_device_stale', 'Whether a working device\'s readings are missing, because it did not respond in time', labels=['phy', 'version'])
+        first_reading = exposition.GaugeMetricFamily('temper_device_time_to_first_reading_seconds', 'Time between a device being plugged in and its first successful read', labels=['phy', 'version'])
+
+        now = time.monotonic()
+        for entry in self.__registry.snapshot().entries.values():
+            labels = [entry.phy, entry.version]
+            reading = entry.reading
+            # If the reading is stale, presumably the device is wedged.
+            # Better to have a gap in the data than to pretend the reading is
+            # current.
+            fresh = reading is not None and now <= reading[0] and entry.device not in stale_devices
+            if fresh:
+                for type_, name, value in reading[1]:
                     if type_ == 'temp':
-                        temp.add_metric([name, t.phy(), t.version], value)
+                        temp.add_metric(entry.labels(name), value, prefix=entry.prefix('temper_temperature_celsius', name))
                     elif type_ == 'humid':
-                        humid.add_metric([name, t.phy(), t.version], value)
+                        humid.add_metric(entry.labels(name), value, prefix=entry.prefix('temper_humidity_rh', name))
                     else:
                         print('Unknown sensor type <{}>'.format(type_), file=sys.stderr)
+            if entry.timeouts:
+                timeouts.add_metric(labels, entry.timeouts, prefix=entry.prefix('temper_read_timeouts_total'))
+            up.add_metric(labels, 1, prefix=entry.prefix('temper_device_up'))
+            stale.add_metric(labels, 0 if fresh else 1, prefix=entry.prefix('temper_device_stale'))
+            if entry.first_reading is not None:
+                first_reading.add_metric(labels, entry.first_reading, prefix=entry.prefix('temper_device_time_to_first_reading_seconds'))
+            f = entry.failure
+            if f is not None:
+                failures.add_metric([f.phy, f.version], f.count)
+        for f in self.__failed.values():
+            up.add_metric([f.phy, f.version], 0)
+            failures.add_metric([f.phy, f.version], f.count)
 
+        collect_duration.observe(time.perf_counter() - start)
         yield temp
         yield humid
+        yield timeouts
+        yield up
+        yield failures
+        yield stale
+        yield first_reading
+
+
+    def __sample_once(self):
+        '''
+        Read from every device, unless another thread is already doing so
+        (in which case, wait for it to finish), or finished doing so less than
+        coalesce_window seconds ago.
+
+        Returns the devices whose readings are stale: those that didn't
+        respond in time.
+        '''
+        with self.__flight_lock:
+            flight = self.__flight
+            if flight is None:
+                if self.__last_flight is not None and time.monotonic() - self.__last_flight < self.__coalesce_window:
+                    scrapes_coalesced.inc()
+                    return self.__stale
+                self.__flight = threading.Event()
+                devices = self.devices()
+                self.__flight_devices = frozenset(device for device, t in devices)
+            flight_devices = self.__flight_devices
+        if flight is not None:
+            scrapes_coalesced.inc()
+            if not flight.wait(deadline.remaining()):
+                # Our deadline passed before the read finished, so we only
+                # have the previous read's readings for these devices
+                return flight_devices
+            return self.__stale
+
+        try:
+            self.recover()
+            timeout = self.__read_timeout
+            remaining = deadline.remaining()
+            if remaining is not None:
+                timeout = max(0, min(timeout, remaining))
+            results = self.sample(devices, timeout=timeout)
+            self.__stale = frozenset(device for device, ok in results.items() if not ok)
+            return self.__stale
+        finally:
+            with self.__flight_lock:
+                flight, self.__flight = self.__flight, None
+                self.__last_flight = time.monotonic()
+            flight.set()
+
+
+    def add_listener(self, fn):
+        '''
+        Arrange for fn(timestamp, phy, version, readings) to be called after
+        each successful read from a device. timestamp is from time.time();
+        readings is a list of (type, name, value) tuples, as yielded by
+        temper.usb_temper.read_sensor().
+
+        fn is called from a reader thread, so it should be quick.
+        '''
+        self.__listeners.append(fn)
+
+
+    def devices(self):
+        '''
+        Returns a list of (pyudev.Device, temper.usb_temper) pairs, one for
+        each device currently known.
+        '''
+        return [(entry.device, entry.t) for entry in self.__registry]
+
+
+    def entries(self):
+        '''
+        Returns a list of registry.Entry objects, one for each device
+        currently known.
+        '''
+        return list(self.__registry)
+
+
+    def sample(self, devices=None, max_age=None, timeout=None):
+        '''
+        Read from devices (a list of pairs, as returned by devices(); by
+        default, every device), storing the readings for collect() to render.
+        The readings are dropped after max_age seconds (by default, the
+        max_age passed to the constructor).
+
+        Returns once every device has been read, or after timeout seconds (by
+        default, read_timeout), whichever is sooner. Reads that are still in progress will store their
+        readings when they complete.
+
+        Returns a dict mapping each device to True if it was read
+        successfully, or False if it failed or timed out.
+        '''
+        if devices is None:
+            devices = self.devices()
+        futures = {self.submit(device, t, max_age): device for device, t in devices}
+        done, not_done = concurrent.futures.wait(futures, timeout=self.__read_timeout if timeout is None else timeout)
+        results = {futures[future]: not future.cancelled() and future.result() for future in done}
+        for future in not_done:
+            device = futures[future]
+            results[device] = False
+            # Don't leave reads queued up behind a wedged device; a read that
+            # has already started carries on in the background.
+            future.cancel()
+            self.count_timeout(device)
+        return results
+
+
+    def submit(self, device, t, max_age=None):
+        '''
+        Start reading from a device (one of the pairs returned by devices())
+        in the background, storing the reading as sample() does.
+
+        Returns a concurrent.futures.Future, whose result is True if the
+        device was read successfully, or False if it failed. If the read takes
+        longer than read_timeout() seconds, the caller should give up on it
+        and call count_timeout().
+
+        If the device is already being read, returns the Future for that read
+        rather than queueing another one, so that a wedged device can't fill
+        up the queue.
+        '''
+        if max_age is None:
+            max_age = self.__max_age
+        with self.__write_lock:
+            entry = self.__registry.get(device)
+            if entry is None or entry.t is not t:
+                # The device was removed (or replaced)
+                future = concurrent.futures.Future()
+                future.set_result(False)
+                return future
+            if entry.in_flight is not None and not entry.in_flight[0].done():
+                return entry.in_flight[0]
+            future = self.__reader.submit(self.__sample_device, entry, max_age)
+            entry.in_flight = [future, None, False]
+        # Outside the lock, since the callback runs right away if the read
+        # has already finished
+        future.add_done_callback(lambda future: self.__read_done(entry, future))
+        return future
+
+
+    def __read_done(self, entry, future):
+        with self.__write_lock:
+            if entry.in_flight is not None and entry.in_flight[0] is future:
+                entry.in_flight = None
+
+
+    def count_timeout(self, device):
+        '''
+        Record that a device didn't respond in time.
+
+        If the read that timed out had already timed out before, and has been
+        in progress for at least read_timeout() seconds, the device is
+        treated as having failed: it is forgotten (and closed once the read
+        returns), and reopened by recover().
+        '''
+        print('Timed out reading from {}'.format(device), file=sys.stderr)
+        with self.__write_lock:
+            entry = self.__registry.get(device)
+            if entry is None:
+                return
+            entry.timeouts += 1
+            self.__generation += 1
+            in_flight = entry.in_flight
+            if in_flight is None or in_flight[1] is None:
+                return
+            if in_flight[2] and time.monotonic() - in_flight[1] >= self.__read_timeout:
+                print('Giving up on {}'.format(device), file=sys.stderr)
+                self.__fail_entry(device, entry)
+            in_flight[2] = True
+
+
+    def read_timeout(self):
+        return self.__read_timeout
+
+
+    def __sample_device(self, entry, max_age):
+        device, t = entry.device, entry.t
+        if self.__registry.get(device) is not entry:
+            # The device was removed (or replaced) before we got to it
+            return False
+        # submit() makes sure that a device is only read by one thread at a
+        # time.
+        with self.__write_lock:
+            if entry.in_flight is not None:
+                entry.in_flight[1] = time.monotonic()
+        try:
+            readings = list(t.read_sensor())
+        except IOError:
+            print('Error reading from {}'.format(device), file=sys.stderr)
+            read_errors.inc((entry.phy,))
+            with suppress(IOError):
+                t.close()
+            with self.__write_lock:
+                if self.__registry.get(device) is entry:
+                    self.__fail_entry(device, entry)
+            return False
+
+        now = time.monotonic()
+        expires = float('inf') if max_age is None else now + max_age
+        with self.__write_lock:
+            # The device may have been removed while we were reading it, or
+            # given up on by count_timeout()
+            gone = self.__registry.get(device) is not entry
+            if not gone:
+                entry.reading = (expires, readings)
+                entry.failure = None
+                self.__generation += 1
+                if entry.added is not None:
+                    entry.first_reading = now - entry.added
+                    entry.added = None
+        if gone:
+            # If count_timeout() gave up on it, nothing else will close it
+            with suppress(IOError):
+                t.close()
+            return True
+
+        if self.__listeners:
+            timestamp = time.time()
+            for fn in self.__listeners:
+                try:
+                    fn(timestamp, entry.phy, entry.version, readings)
+                except Exception as e:
+                    print('Error in listener {!r}: {}'.format(fn, e), file=sys.stderr)
+        return True
 
 
-    def coldplug_scan(self, devices):
+    def coldplug_scan(self, devices, timeout=None):
         '''
         Call this from the main thread, after the device-event handling thread
         has started. That way, there's no chance of missed events between the
         time of the coldplug scan and the time that the netlink socket starts
         receiving events.
+
+        Devices are opened in parallel, by the threads that read from them.
+        Returns once they have all been opened, or after timeout seconds,
+        whichever is sooner; a device that is still being opened then is left
+        to finish in the background.
         '''
-        for device in devices:
-            self.handle_device_event(device)
+        start = time.perf_counter()
+        futures = {self.__reader.submit(self.handle_device_event, device): device for device in devices}
+        done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        for future in not_done:
+            print('Still opening {}'.format(futures[future]), file=sys.stderr)
+        coldplug_duration.set(time.perf_counter() - start)
+        # Raise any exceptions here
+        for future in done:
+            future.result()
 
 
-    def handle_device_event(self, device):
+    def handle_device_event(self, device, since=None):
+        '''
+        Handle a udev event. since is the time.monotonic() at which the
+        event was received, if it was queued before being handled; it is used
+        to work out how long a new device took to give its first reading.
+        '''
+        start = time.perf_counter()
+        try:
+            self.__handle_device_event(device, time.monotonic() if since is None else since)
+        finally:
+            device_event_duration.observe(time.perf_counter() - start, (device.action or 'coldplug',))
+
+
+    def __handle_device_event(self, device, since):
         if device.action == 'add' or device.action is None:
             # If device.action is None then this is a coldplug event, which
             # can be handled as normal, since if a hotplug event for the
             # device already occurred then an entry for it will already be
-            # in __sensors.
-            self.__handle_device_add(device)
+            # in __registry.
+            self.__handle_device_add(device, since)
         elif device.action == 'remove':
             self.__handle_device_remove(device)
 
 
-    def __handle_device_add(self, device):
-        t = self.__sensors.get(device)
-        if t is not None:
+    def __handle_device_add(self, device, since):
+        if self.__registry.get(device) is not None:
             return
 
         cls = self.class_for_device(device)
@@ -81,20 +416,147 @@ class Collector:
             t = cls(device)
         except IOError:
             print('Error reading from {}'.format(device), file=sys.stderr)
-            self.__healthy = False
+            with self.__write_lock:
+                # Another thread may have opened the device meanwhile
+                if self.__registry.get(device) is None:
+                    self.__fail(device, self.__udev_phy(device), '')
             return
 
         with self.__write_lock:
-            self.__sensors[device] = t
+            # The coldplug scan and a hotplug event may have raced to open
+            # the device
+            duplicate = self.__registry.get(device) is not None
+            if not duplicate:
+                self.__pop_failed(device)
+                self.__registry.add(device, t).added = since
+                self.__generation += 1
+        if duplicate:
+            t.close()
+
+
+    def recover(self):
+        '''
+        Start reopening any failed devices that are due to be retried. The
+        attempts are made in the background, so this returns immediately.
+        '''
+        now = time.monotonic()
+        with self.__write_lock:
+            due = [device for device, f in self.__failed.items() if not f.retrying and f.retry_at <= now]
+            for device in due:
+                self.__failed[device].retrying = True
+        for device in due:
+            self.__reader.submit(self.__reopen, device)
+
+
+    def __reopen(self, device):
+        try:
+            cls = self.class_for_device(device)
+            t = cls(device) if cls is not None else None
+        except IOError:
+            print('Error reopening {}'.format(device), file=sys.stderr)
+            with self.__write_lock:
+                f = self.__failed.get(device)
+                if f is not None:
+                    f.retrying = False
+                    self.__fail(device, f.phy, f.version)
+            return
+
+        with self.__write_lock:
+            f = self.__pop_failed(device)
+            # The device may have been removed while we were reopening it,
+            # or opened again by a udev event
+            duplicate = self.__registry.get(device) is not None
+            if f is not None and t is not None and not duplicate:
+                # Forgotten once the device has been read successfully; a
+                # device that opens but can't be read keeps its count of
+                # failures (and its backoff)
+                f.retrying = False
+                self.__registry.add(device, t).failure = f
+            self.__generation += 1
+        if t is not None and (f is None or duplicate):
+            t.close()
+        elif t is not None:
+            print('Recovered {}'.format(device), file=sys.stderr)
+
+
+    def __fail_entry(self, device, entry):
+        '''
+        Forget a device that has been opened, and schedule it to be reopened.
+        Call with __write_lock held.
+        '''
+        # A device that never read successfully since it was reopened keeps
+        # its count of failures
+        self.__forget(device)
+        if entry.failure is not None:
+            self.__set_failed(device, entry.failure)
+        self.__fail(device, entry.phy, entry.version)
+
+
+    def __fail(self, device, phy, version):
+        '''
+        Record that a device failed, and schedule an attempt to reopen it.
+        Call with __write_lock held.
+        '''
+        f = self.__failed.get(device)
+        if f is None:
+            f = Failure(phy, version)
+            self.__set_failed(device, f)
+        f.count += 1
+        f.retry_at = time.monotonic() + min(self.__retry_interval * 2 ** (f.count - 1), self.__max_retry_interval)
+        self.__generation += 1
 
 
     def __handle_device_remove(self, device):
         with self.__write_lock:
-            t = self.__sensors.pop(device, None)
+            t = self.__forget(device)
         if t is not None:
             t.close()
 
 
+    def __forget(self, device):
+        '''
+        Remove all state associated with a device. Call with __write_lock held.
+        '''
+        self.__generation += 1
+        self.__pop_failed(device)
+        entry = self.__registry.remove(device)
+        return entry.t if entry is not None else None
+
+
+    def __set_failed(self, device, f):
+        '''
+        Call with __write_lock held.
+        '''
+        failed = dict(self.__failed)
+        failed[device] = f
+        self.__failed = failed
+
+
+    def __pop_failed(self, device):
+        '''
+        Returns the Failure for a device, and removes it from __failed; or
+        None. Call with __write_lock held.
+        '''
+        f = self.__failed.get(device)
+        if f is not None:
+            failed = dict(self.__failed)
+            del failed[device]
+            self.__failed = failed
+        return f
+
+
+    @staticmethod
+    def __udev_phy(device):
+        '''
+        Returns the phy of a device that couldn't be opened, or an empty
+        string if it can't be determined.
+        '''
+        try:
+            return str(device.find_parent(subsystem=b'hid').properties.get('HID_PHYS'))
+        except Exception:
+            return ''
+
+
     def class_for_device(self, device):
         '''
         Override this method. Given a pyudev.Device, it should return a
@@ -102,5 +564,15 @@ class Collector:
         '''
         raise NotImplementedError
 
+    def generation(self):
+        '''
+        Returns a number that changes whenever the output of collect() might
+        have changed (because a reading was taken, or a device was added or
+        removed).
+        '''
+        return self.__generation
+
     def healthy(self):
-        return self.__healthy
+        if self.__unhealthy_after is None:
+            return True
+        return all(f.count < self.__unhealthy_after for f in self.__failed.copy().values())
@@ -0,0 +1,219 @@
+import gzip
+import random
+import threading
+
+import prometheus_client
+import prometheus_client.core as core
+from prometheus_client.utils import floatToGoString
+
+def escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def sample_prefix(name, labels):
+    '''
+    Returns the start of a sample's line in the text exposition format, up
+    to and including the space before its value. labels is a sequence of
+    (name, value) pairs, which must be sorted by name.
+    '''
+    if not labels:
+        return '{} '.format(name).encode('utf-8')
+    labelstr = ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels)
+    return '{}{{{}}} '.format(name, labelstr).encode('utf-8')
+
+class PrefixedFamily:
+    '''
+    Mixed in to a metric family class, allows add_metric() to be given the
+    sample's prefix (see sample_prefix), so that Writer doesn't have to
+    format its name and labels. The family can still be consumed by anything
+    else that understands metric families.
+    '''
+    def __init__(self, *args, **kwargs):
+        # Sample index -> prefix
+        self.prefixes = {}
+        super().__init__(*args, **kwargs)
+
+    def add_metric(self, labels, value, *args, prefix=None, **kwargs):
+        if prefix is not None:
+            self.prefixes[len(self.samples)] = prefix
+        super().add_metric(labels, value, *args, **kwargs)
+
+class GaugeMetricFamily(PrefixedFamily, core.GaugeMetricFamily):
+    pass
+
+class CounterMetricFamily(PrefixedFamily, core.CounterMetricFamily):
+    pass
+
+# Samples with these suffixes are moved into gauges of their own, after the
+# family they belong to, as prometheus_client.generate_latest() does.
+om_suffixes = ('_created', '_gsum', '_gcount')
+
+class Writer:
+    '''
+    Renders metric families in the text exposition format, producing the
+    same output as prometheus_client.generate_latest(), but streaming into a
+    reusable buffer (one per thread) rather than joining strings.
+
+    The HELP and TYPE lines for each family, and the name and labels of each
+    sample, are encoded once and cached; families made with
+    PrefixedFamily supply them ready-made. Up to max_prefixes sample
+    prefixes are cached; the cache is emptied when it fills up, which
+    forgets the labels of devices that have gone away.
+    '''
+    def __init__(self, max_prefixes=10000):
+        self.__local = threading.local()
+        self.__headers = {}
+        self.__prefixes = {}
+        self.__max_prefixes = max_prefixes
+
+    def render(self, registry=prometheus_client.REGISTRY):
+        '''
+        Returns the exposition of everything in registry, as bytes.
+        '''
+        buf = getattr(self.__local, 'buf', None)
+        if buf is None:
+            buf = self.__local.buf = bytearray()
+        # Overwrite the buffer in place; truncating it would give its memory
+        # back.
+        pos = 0
+        for family in registry.collect():
+            for chunk in self.__family(family):
+                end = pos + len(chunk)
+                buf[pos:end] = chunk
+                pos = end
+        with memoryview(buf) as view:
+            return bytes(view[:pos])
+
+    def __family(self, family):
+        name = family.name
+        prefixes = getattr(family, 'prefixes', {})
+        yield self.__header(name, family.documentation, family.type)
+        om_samples = {}
+        for i, s in enumerate(family.samples):
+            if s.name != name and s.name.startswith(name) and s.name[len(name):] in om_suffixes:
+                om_samples.setdefault(s.name[len(name):], []).append(s)
+                continue
+            yield prefixes.get(i) or self.__prefix(s)
+            yield self.__value(s)
+        for suffix, samples in sorted(om_samples.items()):
+            yield self.__header(name + suffix, family.documentation, 'gauge')
+            for s in samples:
+                yield self.__prefix(s)
+                yield self.__value(s)
+
+    def __header(self, name, documentation, type_):
+        key = (name, documentation, type_)
+        header = self.__headers.get(key)
+        if header is None:
+            if type_ == 'counter':
+                name += '_total'
+            elif type_ == 'info':
+                name += '_info'
+                type_ = 'gauge'
+            elif type_ == 'stateset':
+                type_ = 'gauge'
+            elif type_ == 'gaugehistogram':
+                type_ = 'histogram'
+            elif type_ == 'unknown':
+                type_ = 'untyped'
+            documentation = documentation.replace('\\', r'\\').replace('\n', r'\n')
+            header = self.__headers[key] = '# HELP {0} {1}\n# TYPE {0} {2}\n'.format(name, documentation, type_).encode('utf-8')
+        return header
+
+    def __prefix(self, sample):
+        key = (sample.name, tuple(sample.labels.items()))
+        prefix = self.__prefixes.get(key)
+        if prefix is None:
+            if len(self.__prefixes) >= self.__max_prefixes:
+                self.__prefixes.clear()
+            prefix = self.__prefixes[key] = sample_prefix(sample.name, sorted(sample.labels.items()))
+        return prefix
+
+    @staticmethod
+    def __value(sample):
+        if sample.timestamp is None:
+            return (floatToGoString(sample.value) + '\n').encode('ascii')
+        return '{} {:d}\n'.format(floatToGoString(sample.value), int(float(sample.timestamp) * 1000)).encode('ascii')
+
+class Exposition:
+    '''
+    A WSGI app that serves metrics in the text exposition format, like
+    prometheus_client.make_wsgi_app(), but rendered by a Writer.
+    '''
+    def __init__(self, registry=prometheus_client.REGISTRY):
+        self.__registry = registry
+        self.__writer = Writer()
+
+    def __call__(self, environ, start_response):
+        body = self.__writer.render(self.__registry)
+        headers = [
+            ('Content-Type', prometheus_client.CONTENT_TYPE_LATEST),
+            ('Vary', 'Accept-Encoding'),
+        ]
+        if 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''):
+            body = gzip.compress(body)
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [body]
+
+class CachedExposition:
+    '''
+    A WSGI app that serves metrics in the text exposition format, like
+    prometheus_client.make_wsgi_app(), except that the response body is only
+    re-rendered when the collector's generation() changes. Clients that send
+    If-None-Match with the current ETag get a 304 response.
+
+    This only makes sense if the collector is sampled in the background;
+    otherwise its generation only changes when it is collected, i.e., never.
+    Other collectors in the registry (process metrics and so on) are only
+    refreshed along with the collector.
+    '''
+    def __init__(self, collector, registry=prometheus_client.REGISTRY):
+        self.__collector = collector
+        self.__registry = registry
+        self.__writer = Writer()
+        # Distinguishes our ETags from those of a previous process, whose
+        # generation counter started from the same place.
+        self.__instance = random.getrandbits(32)
+        self.__lock = threading.Lock()
+        self.__generation = None
+        self.__etag = None
+        self.__body = None
+        self.__body_gzip = None
+
+    def __render(self):
+        '''
+        Returns (etag, body, body_gzip), re-rendering if necessary.
+        '''
+        with self.__lock:
+            generation = self.__collector.generation()
+            if generation != self.__generation:
+                body = self.__writer.render(self.__registry)
+                self.__body = body
+                self.__body_gzip = gzip.compress(body)
+                self.__etag = '"{:08x}-{}"'.format(self.__instance, generation)
+                self.__generation = generation
+            return self.__etag, self.__body, self.__body_gzip
+
+    def __call__(self, environ, start_response):
+        etag, body, body_gzip = self.__render()
+        headers = [
+            ('ETag', etag),
+            ('Vary', 'Accept-Encoding'),
+        ]
+
+        if etag in (tag.strip() for tag in environ.get('HTTP_IF_NONE_MATCH', '').split(',')):
+            start_response('304 Not Modified', headers)
+            return []
+
+        headers.append(('Content-Type', prometheus_client.CONTENT_TYPE_LATEST))
+        if 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''):
+            body = body_gzip
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [body]
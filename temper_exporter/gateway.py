@@ -0,0 +1,289 @@
+'''
+Gateway mode: scrape many other temper-exporter instances, and serve their
+metrics as one, so that a central Prometheus server only has to scrape the
+gateway.
+'''
+
+import asyncio
+import collections
+import contextlib
+import gzip
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+import prometheus_client.core as core
+from prometheus_client.parser import text_string_to_metric_families
+
+class Upstream:
+    '''
+    An exporter to be scraped. Its metrics are given an instance label with
+    the value instance (by default, the host and port from url).
+    '''
+    def __init__(self, url, instance=None):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError('Unsupported URL scheme {!r}'.format(parts.scheme))
+        if parts.hostname is None:
+            raise ValueError('No host in URL {!r}'.format(url))
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        self.instance = instance if instance is not None else parts.netloc
+        # Updated by Gateway
+        self.families = []
+        self.etag = None
+        self.body = None
+        self.fetched_at = None
+        self.up = False
+        self.duration = 0.0
+
+    def __repr__(self):
+        return '<{}({!r})>'.format(self.__class__.__name__, self.url)
+
+def upstream(value):
+    '''
+    Parses [INSTANCE=]URL.
+    '''
+    instance, sep, url = value.partition('=')
+    if not sep or '://' in instance:
+        instance, url = None, value
+    return Upstream(url, instance)
+
+class ConnectionPool:
+    '''
+    An HTTP/1.1 client that keeps up to max_idle connections to each host
+    open between requests. Must be used from a single event loop.
+    '''
+    def __init__(self, max_idle=2):
+        self.__max_idle = max_idle
+        # (host, port) -> list of (reader, writer)
+        self.__idle = collections.defaultdict(list)
+
+    async def get(self, host, port, path, headers=()):
+        '''
+        Returns (status, headers, body); header names are lower-cased.
+        '''
+        idle = self.__idle[host, port]
+        while idle:
+            reader, writer = idle.pop()
+            try:
+                return await self.__request(host, port, reader, writer, path, headers)
+            except (ConnectionError, asyncio.IncompleteReadError, EmptyResponse):
+                # The server probably closed the connection while it was
+                # idle; try the next one.
+                writer.close()
+        reader, writer = await asyncio.open_connection(host, port)
+        return await self.__request(host, port, reader, writer, path, headers)
+
+    async def __request(self, host, port, reader, writer, path, headers):
+        try:
+            lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}:{}'.format(host, port)]
+            lines += ['{}: {}'.format(k, v) for k, v in headers]
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            status, response_headers, body, keep_alive = await read_response(reader)
+        except BaseException:
+            writer.close()
+            raise
+        idle = self.__idle[host, port]
+        if keep_alive and len(idle) < self.__max_idle:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, response_headers, body
+
+    def close(self):
+        for idle in self.__idle.values():
+            for reader, writer in idle:
+                writer.close()
+        self.__idle.clear()
+
+class EmptyResponse(Exception):
+    pass
+
+async def read_response(reader):
+    '''
+    Reads an HTTP response. Returns (status, headers, body, keep_alive).
+    '''
+    status_line = await reader.readline()
+    if not status_line:
+        raise EmptyResponse()
+    version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+    status = int(status)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n'):
+            break
+        if not line:
+            raise asyncio.IncompleteReadError(b'', None)
+        name, sep, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    if status in (204, 304) or 100 <= status < 200:
+        body = b''
+    elif 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # Skip any trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        keep_alive = False
+    return status, headers, body, keep_alive
+
+class Gateway(threading.Thread):
+    '''
+    A thread that scrapes upstreams (a list of Upstream objects) every
+    interval seconds, concurrently, giving up on any that take longer than
+    timeout seconds; and a collector that yields the metric families from
+    all of them, with an instance label added to each sample.
+
+    An upstream's metrics are dropped if it hasn't been scraped successfully
+    for max_age seconds (by default, three intervals).
+
+    Families with the same name from different upstreams are merged. If two
+    upstreams disagree about the type of a family, the first one wins.
+    '''
+    def __init__(self, upstreams, interval=15, timeout=5, max_age=None):
+        super().__init__(name='gateway')
+        self.__upstreams = list(upstreams)
+        self.__interval = interval
+        self.__timeout = timeout
+        self.__max_age = max_age if max_age is not None else 3 * interval
+        self.__generation = 0
+        self.__loop = None
+        self.__stop = None
+        # Set by send_stop(), which may be called before the loop is running
+        self.__stopping = False
+
+    def run(self):
+        self.__loop = asyncio.new_event_loop()
+        try:
+            self.__loop.run_until_complete(self.__main())
+        finally:
+            self.__loop.close()
+
+    async def __main(self):
+        self.__stop = asyncio.Event()
+        # After creating __stop, so that if send_stop() is called between
+        # here and there, one or the other sees it
+        if self.__stopping:
+            return
+        pool = ConnectionPool()
+        try:
+            while not self.__stop.is_set():
+                start = time.monotonic()
+                results = await asyncio.gather(*(self.__scrape(pool, u) for u in self.__upstreams), return_exceptions=True)
+                for u, result in zip(self.__upstreams, results):
+                    if isinstance(result, Exception):
+                        # Whatever went wrong, it mustn't stop us from
+                        # scraping the other upstreams
+                        print('Error scraping {}: {!r}'.format(u.url, result), file=sys.stderr)
+                        u.up = False
+                self.__generation += 1
+                timeout = max(0, start + self.__interval - time.monotonic())
+                try:
+                    await asyncio.wait_for(self.__stop.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            pool.close()
+
+    def send_stop(self):
+        '''
+        Cause the thread to exit. Doesn't block, so it is safe to call from a
+        signal handler, even if the thread hasn't started (in which case it
+        exits as soon as it does) or has already exited.
+        '''
+        self.__stopping = True
+        stop = self.__stop
+        if stop is not None:
+            with contextlib.suppress(RuntimeError):
+                # The loop is already closed
+                self.__loop.call_soon_threadsafe(stop.set)
+
+    async def __scrape(self, pool, u):
+        headers = [('Accept-Encoding', 'gzip')]
+        if u.etag is not None:
+            headers.append(('If-None-Match', u.etag))
+        start = time.perf_counter()
+        try:
+            status, response_headers, body = await asyncio.wait_for(pool.get(u.host, u.port, u.path, headers), self.__timeout)
+            if status == 304 and u.body is not None:
+                pass
+            elif status == 200:
+                if response_headers.get('content-encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                u.families = self.__parse(u, body.decode('utf-8'))
+                u.body = body
+                u.etag = response_headers.get('etag')
+            else:
+                raise IOError('HTTP status {}'.format(status))
+        except (OSError, EOFError, zlib.error, asyncio.TimeoutError, asyncio.IncompleteReadError, EmptyResponse, ValueError) as e:
+            print('Error scraping {}: {!r}'.format(u.url, e), file=sys.stderr)
+            u.up = False
+        else:
+            u.up = True
+            u.fetched_at = time.monotonic()
+        finally:
+            u.duration = time.perf_counter() - start
+
+    @staticmethod
+    def __parse(u, text):
+        families = []
+        for family in text_string_to_metric_families(text):
+            family.samples = [s._replace(labels=dict(s.labels, instance=u.instance)) for s in family.samples]
+            families.append(family)
+        return families
+
+    def generation(self):
+        '''
+        Returns a number that changes whenever the output of collect() might
+        have changed.
+        '''
+        return self.__generation
+
+    def collect(self):
+        up = core.GaugeMetricFamily('temper_gateway_upstream_up', 'Whether the last scrape of an upstream exporter succeeded', labels=['instance'])
+        duration = core.GaugeMetricFamily('temper_gateway_upstream_scrape_duration_seconds', 'Time taken by the last scrape of an upstream exporter', labels=['instance'])
+        age = core.GaugeMetricFamily('temper_gateway_upstream_age_seconds', 'Time since an upstream exporter was last scraped successfully', labels=['instance'])
+
+        merged = collections.OrderedDict()
+        now = time.monotonic()
+        for u in self.__upstreams:
+            up.add_metric([u.instance], 1 if u.up else 0)
+            duration.add_metric([u.instance], u.duration)
+            if u.fetched_at is None:
+                continue
+            age.add_metric([u.instance], now - u.fetched_at)
+            if now - u.fetched_at > self.__max_age:
+                continue
+            for family in u.families:
+                m = merged.get(family.name)
+                if m is None:
+                    m = merged[family.name] = core.Metric(family.name, family.documentation, family.type)
+                elif m.type != family.type:
+                    continue
+                m.samples.extend(family.samples)
+
+        yield up
+        yield duration
+        yield age
+        yield from merged.values()
+
+    def healthy(self):
+        return self.is_alive()
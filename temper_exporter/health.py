@@ -0,0 +1,98 @@
+'''
+Cheap health checks: threads that should wake up regularly record a
+heartbeat each time they do, and the checks only look at how long ago that
+was, rather than (say) scraping the exporter over HTTP.
+'''
+
+import os
+import socket
+import time
+
+class Heartbeat:
+    '''
+    Records when a thread last showed signs of life. A thread that wakes up
+    every so often calls beat() each time; it is healthy if it has done so
+    within the last max_age seconds.
+    '''
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.last = time.monotonic()
+
+    def beat(self):
+        self.last = time.monotonic()
+
+    def age(self):
+        return time.monotonic() - self.last
+
+    def healthy(self):
+        return self.age() <= self.max_age
+
+class HealthApp:
+    '''
+    A WSGI app that responds 200 if every one of components (a dict mapping
+    names to objects with a healthy() method) is healthy, and 503 otherwise.
+
+    If ready (a threading.Event) is given, it also responds 503 until ready
+    is set; so an instance with ready is suitable for /readyz, and one
+    without for /healthz.
+    '''
+    def __init__(self, components, ready=None):
+        self.__components = dict(components)
+        self.__ready = ready
+
+    def __call__(self, environ, start_response):
+        lines = []
+        ok = True
+        if self.__ready is not None and not self.__ready.is_set():
+            lines.append('starting')
+            ok = False
+        for name, component in sorted(self.__components.items()):
+            try:
+                healthy = component.healthy()
+            except Exception:
+                healthy = False
+            lines.append('{}: {}'.format(name, 'ok' if healthy else 'unhealthy'))
+            ok = ok and healthy
+        body = ''.join(line + '\n' for line in lines).encode('utf-8')
+        start_response('200 OK' if ok else '503 Service Unavailable', [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-store'),
+        ])
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [body]
+
+def sd_notify(state):
+    '''
+    Sends state (e.g., 'READY=1') to systemd, if it started us with
+    Type=notify. Returns True if the message was sent.
+    '''
+    path = os.environ.get('NOTIFY_SOCKET')
+    if not path:
+        return False
+    if path[0] == '@':
+        # Abstract namespace
+        path = '\0' + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.connect(path)
+            s.sendall(state.encode('utf-8'))
+    except OSError:
+        return False
+    return True
+
+def watchdog_interval():
+    '''
+    Returns how often (in seconds) systemd's watchdog should be sent
+    WATCHDOG=1, which is half of the service's WatchdogSec; or None if the
+    watchdog is not enabled for this process.
+    '''
+    usec = os.environ.get('WATCHDOG_USEC')
+    pid = os.environ.get('WATCHDOG_PID')
+    try:
+        if not usec or (pid and int(pid) != os.getpid()):
+            return None
+        return int(usec) / 2e6
+    except ValueError:
+        return None
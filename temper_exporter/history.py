@@ -0,0 +1,164 @@
+import array
+import math
+import sys
+import threading
+import urllib.parse
+
+class RingBuffer:
+    '''
+    Holds the most recent capacity (timestamp, value) pairs, in two arrays of
+    doubles; memory use is fixed when the buffer is created.
+
+    Timestamps are expected to be appended in order.
+    '''
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.__times = array.array('d', bytes(8 * capacity))
+        self.__values = array.array('d', bytes(8 * capacity))
+        self.__capacity = capacity
+        # Index of the next slot to be written
+        self.__next = 0
+        self.__len = 0
+
+    def __len__(self):
+        return self.__len
+
+    def append(self, timestamp, value):
+        self.__times[self.__next] = timestamp
+        self.__values[self.__next] = value
+        self.__next = (self.__next + 1) % self.__capacity
+        self.__len = min(self.__len + 1, self.__capacity)
+
+    def __slot(self, i):
+        '''
+        Returns the array index of the i'th oldest sample.
+        '''
+        return (self.__next - self.__len + i) % self.__capacity
+
+    def __bisect(self, timestamp):
+        '''
+        Returns the position (oldest first) of the first sample taken at or
+        after timestamp.
+        '''
+        lo, hi = 0, self.__len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__times[self.__slot(mid)] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start=-math.inf, end=math.inf):
+        '''
+        Returns an array of doubles containing alternating timestamps and
+        values, for each sample taken between start and end (inclusive),
+        oldest first.
+        '''
+        result = array.array('d')
+        for i in range(self.__bisect(start), self.__len):
+            slot = self.__slot(i)
+            if self.__times[slot] > end:
+                break
+            result.append(self.__times[slot])
+            result.append(self.__values[slot])
+        return result
+
+class History:
+    '''
+    Keeps a RingBuffer of recent readings for each sensor, identified by
+    (phy, type, name), where type and name are as yielded by
+    temper.usb_temper.read_sensor().
+
+    Register record() as a listener with an exporter.Collector to feed it.
+    '''
+    def __init__(self, capacity):
+        self.__capacity = capacity
+        self.__buffers = {}
+        self.__lock = threading.Lock()
+
+    def record(self, timestamp, phy, version, readings):
+        with self.__lock:
+            for type_, name, value in readings:
+                key = (phy, type_, name)
+                buf = self.__buffers.get(key)
+                if buf is None:
+                    buf = self.__buffers[key] = RingBuffer(self.__capacity)
+                buf.append(timestamp, value)
+
+    def sensors(self):
+        '''
+        Returns a list of (phy, type, name) tuples, one for each sensor with
+        recorded readings.
+        '''
+        with self.__lock:
+            return list(self.__buffers)
+
+    def query(self, phy, type_, name, start=-math.inf, end=math.inf):
+        '''
+        Returns readings from a sensor, as described in RingBuffer.range(), or
+        None if the sensor is not known.
+        '''
+        with self.__lock:
+            buf = self.__buffers.get((phy, type_, name))
+            if buf is None:
+                return None
+            return buf.range(start, end)
+
+class HistoryApp:
+    '''
+    A WSGI app that returns a range of readings from a History.
+
+    Query parameters:
+
+      phy:    the device's phy (required)
+      type:   'temp' (the default) or 'humid'
+      name:   the sensor's name (default: empty)
+      start:  Unix timestamp of the earliest reading to return
+      end:    Unix timestamp of the latest reading to return
+      format: 'csv' (the default): 'timestamp,value' lines; or 'binary':
+              little-endian IEEE 754 doubles, alternating timestamp and value
+    '''
+    def __init__(self, history):
+        self.__history = history
+
+    def __call__(self, environ, start_response):
+        params = urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+        def param(name, default=None):
+            return params.get(name, [default])[0]
+
+        phy = param('phy')
+        fmt = param('format', 'csv')
+        if phy is None:
+            return self.__error(start_response, '400 Bad Request', 'phy is required')
+        if fmt not in ('csv', 'binary'):
+            return self.__error(start_response, '400 Bad Request', 'unknown format {!r}'.format(fmt))
+        try:
+            start = float(param('start', '-inf'))
+            end = float(param('end', 'inf'))
+        except ValueError:
+            return self.__error(start_response, '400 Bad Request', 'start and end must be numbers')
+
+        samples = self.__history.query(phy, param('type', 'temp'), param('name', ''), start, end)
+        if samples is None:
+            return self.__error(start_response, '404 Not Found', 'no such sensor')
+
+        if fmt == 'binary':
+            if sys.byteorder != 'little':
+                samples.byteswap()
+            body = samples.tobytes()
+            content_type = 'application/octet-stream'
+        else:
+            body = ''.join('{!r},{!r}\n'.format(samples[i], samples[i+1]) for i in range(0, len(samples), 2)).encode('ascii')
+            content_type = 'text/csv; charset=us-ascii'
+        start_response('200 OK', [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [body]
+
+    @staticmethod
+    def __error(start_response, status, message):
+        body = (message + '\n').encode('utf-8')
+        start_response(status, [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))])
+        return [body]
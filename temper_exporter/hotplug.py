@@ -0,0 +1,157 @@
+import collections
+import concurrent.futures
+import sys
+import threading
+import time
+
+import prometheus_client.core as core
+
+from . import health
+from . import instrument
+
+events_received = instrument.Counter('temper_exporter_hotplug_events_received', 'Number of udev events queued')
+events_coalesced = instrument.Counter('temper_exporter_hotplug_events_coalesced', 'Number of udev events merged with an earlier event for the same device')
+
+class Pending:
+    '''
+    The udev events received for one device (identified by its sysfs path)
+    that have not yet been handled.
+    '''
+    __slots__ = ('device', 'removed', 'first_seen', 'since', 'due')
+
+    def __init__(self, now):
+        # The most recent event
+        self.device = None
+        # The most recent remove event, if any
+        self.removed = None
+        self.first_seen = now
+        # When the most recent add event was received
+        self.since = None
+        self.due = None
+
+class Monitor(threading.Thread):
+    '''
+    Like pyudev.MonitorObserver: calls callback with each device received
+    from a pyudev.Monitor. It wakes up every interval seconds, even if
+    there are no events, to beat its heartbeat and to check whether it
+    should stop.
+    '''
+    def __init__(self, monitor, callback, interval=1):
+        super().__init__(name='monitor')
+        self.__monitor = monitor
+        self.__callback = callback
+        self.__interval = interval
+        self.__stop = threading.Event()
+        self.heartbeat = health.Heartbeat(30)
+
+    def send_stop(self):
+        '''
+        Cause the thread to exit, within interval seconds.
+        '''
+        self.__stop.set()
+
+    def run(self):
+        self.__monitor.start()
+        while not self.__stop.is_set():
+            self.heartbeat.beat()
+            device = self.__monitor.poll(timeout=self.__interval)
+            if device is not None:
+                self.__callback(device)
+
+    def healthy(self):
+        return self.is_alive() and self.heartbeat.healthy()
+
+class Hotplug(threading.Thread):
+    '''
+    Feeds udev events to a collector's handle_device_event() through a queue;
+    use enqueue() as the callback of a Monitor.
+
+    Events for the same device are coalesced: each device is handled once
+    debounce seconds have passed without another event for it (or max_delay
+    seconds after the first event, if it keeps flapping), and only the last
+    event counts, except that a device that was removed and then added again
+    is closed before it is reopened.
+
+    Devices are handled by up to workers threads at once, so opening a batch
+    of devices (say, after a USB hub is reset) isn't held up by each one's
+    slow startup commands. Events for any one device are always handled in
+    order.
+    '''
+    def __init__(self, collector, debounce=0.5, max_delay=5, workers=4, registry=core.REGISTRY):
+        super().__init__(name='hotplug')
+        self.__collector = collector
+        self.__debounce = debounce
+        self.__max_delay = max_delay
+        self.__workers = concurrent.futures.ThreadPoolExecutor(workers)
+        self.__cond = threading.Condition()
+        # sys_path -> Pending
+        self.__pending = collections.OrderedDict()
+        # sys_paths of devices that a worker is handling
+        self.__busy = set()
+        self.__stop = False
+        instrument.CallbackGauge('temper_exporter_hotplug_queue_length', 'Number of devices with udev events waiting to be handled', lambda: len(self.__pending), registry=registry)
+
+    def enqueue(self, device):
+        now = time.monotonic()
+        events_received.inc()
+        with self.__cond:
+            p = self.__pending.get(device.sys_path)
+            if p is None:
+                p = self.__pending[device.sys_path] = Pending(now)
+            else:
+                events_coalesced.inc()
+            p.device = device
+            if device.action == 'remove':
+                p.removed = device
+                p.since = None
+            elif p.since is None:
+                p.since = now
+            p.due = min(now + self.__debounce, p.first_seen + self.__max_delay)
+            self.__cond.notify()
+
+    def send_stop(self):
+        '''
+        Cause the thread to exit, once the events that are being handled
+        are done with. Events still in the queue are discarded.
+        '''
+        with self.__cond:
+            self.__stop = True
+            self.__cond.notify()
+
+    def run(self):
+        try:
+            while True:
+                with self.__cond:
+                    while True:
+                        if self.__stop:
+                            return
+                        now = time.monotonic()
+                        waiting = [(sys_path, p) for sys_path, p in self.__pending.items() if sys_path not in self.__busy]
+                        due = [(sys_path, p) for sys_path, p in waiting if p.due <= now]
+                        if due:
+                            break
+                        timeout = min(p.due for sys_path, p in waiting) - now if waiting else None
+                        self.__cond.wait(timeout)
+                    for sys_path, p in due:
+                        del self.__pending[sys_path]
+                        self.__busy.add(sys_path)
+                for sys_path, p in due:
+                    self.__workers.submit(self.__handle, sys_path, p)
+        finally:
+            self.__workers.shutdown()
+
+    def __handle(self, sys_path, p):
+        try:
+            if p.removed is not None and p.removed is not p.device:
+                self.__collector.handle_device_event(p.removed)
+            self.__collector.handle_device_event(p.device, since=p.since)
+        except Exception as e:
+            print('Error handling event for {}: {!r}'.format(p.device, e), file=sys.stderr)
+        finally:
+            with self.__cond:
+                self.__busy.discard(sys_path)
+                # Further events for the device may be waiting for us
+                self.__cond.notify()
+
+    def healthy(self):
+        return self.is_alive()
@@ -0,0 +1,135 @@
+import bisect
+import threading
+
+import prometheus_client.core as core
+from prometheus_client.utils import floatToGoString
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf'))
+
+class PerThread:
+    '''
+    Per-thread storage that can be enumerated from any thread.
+
+    Each thread gets its own dict of cells, which only that thread modifies,
+    so updating a cell doesn't need a lock. A lock is only taken the first
+    time a thread touches the storage, and when the storage is enumerated.
+    '''
+    def __init__(self):
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__all = []
+
+    def cells(self):
+        try:
+            return self.__local.cells
+        except AttributeError:
+            cells = self.__local.cells = {}
+            with self.__lock:
+                self.__all.append(cells)
+            return cells
+
+    def snapshot(self):
+        '''
+        Returns a copy of every thread's cells. Cells belonging to threads
+        that have exited are retained, so that counts never go backwards.
+        '''
+        with self.__lock:
+            all_ = list(self.__all)
+        # dict.copy is atomic with respect to other threads' updates
+        return [cells.copy() for cells in all_]
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=(), registry=core.REGISTRY):
+        self.__name = name
+        self.__documentation = documentation
+        self.__labelnames = list(labelnames)
+        self.__storage = PerThread()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, labelvalues=(), amount=1):
+        cells = self.__storage.cells()
+        try:
+            cells[labelvalues][0] += amount
+        except KeyError:
+            cells[labelvalues] = [amount]
+
+    def value(self, labelvalues=()):
+        return sum(cells[labelvalues][0] for cells in self.__storage.snapshot() if labelvalues in cells)
+
+    def collect(self):
+        totals = {}
+        for cells in self.__storage.snapshot():
+            for labelvalues, cell in cells.items():
+                totals[labelvalues] = totals.get(labelvalues, 0) + cell[0]
+        family = core.CounterMetricFamily(self.__name, self.__documentation, labels=self.__labelnames)
+        for labelvalues, total in totals.items():
+            family.add_metric(list(labelvalues), total)
+        yield family
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=core.REGISTRY):
+        self.__name = name
+        self.__documentation = documentation
+        self.__labelnames = list(labelnames)
+        self.__buckets = tuple(buckets)
+        assert self.__buckets[-1] == float('inf')
+        self.__storage = PerThread()
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, labelvalues=()):
+        cells = self.__storage.cells()
+        try:
+            cell = cells[labelvalues]
+        except KeyError:
+            # One count per bucket, then the sum and the count
+            cell = cells[labelvalues] = [0] * (len(self.__buckets) + 2)
+        cell[bisect.bisect_left(self.__buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def collect(self):
+        totals = {}
+        for cells in self.__storage.snapshot():
+            for labelvalues, cell in cells.items():
+                total = totals.setdefault(labelvalues, [0] * len(cell))
+                for i, x in enumerate(cell):
+                    total[i] += x
+        family = core.HistogramMetricFamily(self.__name, self.__documentation, labels=self.__labelnames)
+        for labelvalues, total in totals.items():
+            buckets = []
+            cumulative = 0
+            for bound, count in zip(self.__buckets, total):
+                cumulative += count
+                buckets.append((floatToGoString(bound), cumulative))
+            family.add_metric(list(labelvalues), buckets, total[-2])
+        yield family
+
+class CallbackGauge:
+    '''
+    A gauge whose value is computed by calling fn when collected.
+    '''
+    def __init__(self, name, documentation, fn, registry=core.REGISTRY):
+        self.__name = name
+        self.__documentation = documentation
+        self.__fn = fn
+        if registry is not None:
+            registry.register(self)
+
+    def collect(self):
+        yield core.GaugeMetricFamily(self.__name, self.__documentation, value=self.__fn())
+
+class Gauge:
+    def __init__(self, name, documentation, registry=core.REGISTRY):
+        self.__name = name
+        self.__documentation = documentation
+        self.__value = 0
+        if registry is not None:
+            registry.register(self)
+
+    def set(self, value):
+        self.__value = value
+
+    def collect(self):
+        yield core.GaugeMetricFamily(self.__name, self.__documentation, value=self.__value)
@@ -0,0 +1,245 @@
+'''
+A journal of readings, kept in a memory-mapped file so that history survives
+a restart.
+
+The file consists of a header, a dictionary section and a record section.
+
+The dictionary section holds the labels that identify devices (phy and
+version) and sensors (type and name); each entry is a kind byte (0 for a
+device, 1 for a sensor), followed by its two labels, each a 16-bit length and
+that many bytes of UTF-8. Devices and sensors are numbered separately, in the
+order in which they appear.
+
+The record section holds a fixed number of fixed-size records: a timestamp,
+a device number, a sensor number, and a value. Once it is full, the oldest
+records are overwritten.
+
+All numbers are little-endian.
+'''
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from .aggregate import metric_names
+from .exposition import escape
+
+MAGIC = b'TEMPJRNL'
+FORMAT_VERSION = 1
+
+# magic, format version, dictionary size, dictionary bytes used, capacity
+# (records), index of next record to write, records written
+header = struct.Struct('<8sIIIxxxxQQQ')
+entry_header = struct.Struct('<BHH')
+record = struct.Struct('<dHHxxxxd')
+
+DEVICE = 0
+SENSOR = 1
+
+class JournalFull(Exception):
+    pass
+
+class Journal:
+    '''
+    Opens (or creates) a journal file with room for capacity records, and
+    dictionary_size bytes of labels. If an existing journal was created with
+    a different capacity or dictionary size, or is incomplete, it is
+    discarded; but ValueError is raised if an existing file that isn't
+    empty is not a journal at all, rather than overwriting it.
+
+    If capacity is None, an existing journal is opened read-only, whatever
+    its size; ValueError is raised if the file is not a journal.
+
+    Register record() as a listener with an exporter.Collector to feed it.
+    '''
+    def __init__(self, path, capacity=None, dictionary_size=65536):
+        self.__lock = threading.Lock()
+
+        self.__readonly = capacity is None
+        fd = os.open(path, os.O_RDONLY if self.__readonly else os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = self.__read_header(fd)
+            if capacity is None:
+                if existing is None:
+                    raise ValueError('{}: not a journal'.format(path))
+                dictionary_size, capacity = existing[0], existing[2]
+            elif existing is None:
+                if os.pread(fd, len(MAGIC), 0) not in (b'', MAGIC):
+                    raise ValueError('{}: not a journal; refusing to overwrite it'.format(path))
+            elif (existing[0], existing[2]) != (dictionary_size, capacity):
+                print('Discarding journal with a different size', file=sys.stderr)
+                existing = None
+
+            self.__capacity = capacity
+            self.__dictionary_size = dictionary_size
+            self.__records_offset = header.size + dictionary_size
+            size = self.__records_offset + capacity * record.size
+            if existing is None:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.__map = mmap.mmap(fd, size, access=mmap.ACCESS_READ if self.__readonly else mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+
+        if existing is None:
+            self.__used = 0
+            self.__next = 0
+            self.__count = 0
+            self.__write_header()
+        else:
+            dictionary_size, self.__used, capacity, self.__next, self.__count = existing
+
+        self.__devices = []
+        self.__sensors = []
+        for kind, labels in self.__read_dictionary():
+            (self.__devices if kind == DEVICE else self.__sensors).append(labels)
+        self.__device_index = {labels: i for i, labels in enumerate(self.__devices)}
+        self.__sensor_index = {labels: i for i, labels in enumerate(self.__sensors)}
+
+    @staticmethod
+    def __read_header(fd):
+        '''
+        Returns (dictionary size, dictionary bytes used, capacity, next,
+        count) from the header of the journal open on fd, or None if it is
+        not a (complete) journal.
+        '''
+        buf = os.pread(fd, header.size, 0)
+        if len(buf) < header.size:
+            return None
+        magic, version, dictionary_size, used, capacity, next_, count = header.unpack(buf)
+        if (magic, version) != (MAGIC, FORMAT_VERSION):
+            return None
+        if os.fstat(fd).st_size < header.size + dictionary_size + capacity * record.size:
+            return None
+        return dictionary_size, used, capacity, next_, count
+
+    def __write_header(self):
+        header.pack_into(self.__map, 0, MAGIC, FORMAT_VERSION, self.__dictionary_size, self.__used, self.__capacity, self.__next, self.__count)
+
+    def __read_dictionary(self):
+        offset = header.size
+        end = header.size + self.__used
+        while offset < end:
+            kind, length0, length1 = entry_header.unpack_from(self.__map, offset)
+            offset += entry_header.size
+            labels = []
+            for length in length0, length1:
+                labels.append(bytes(self.__map[offset:offset+length]).decode('utf-8'))
+                offset += length
+            yield kind, tuple(labels)
+
+    def __index(self, kind, labels):
+        '''
+        Returns the number of a device or sensor, adding it to the dictionary
+        if necessary. Call with __lock held.
+        '''
+        entries, index = (self.__devices, self.__device_index) if kind == DEVICE else (self.__sensors, self.__sensor_index)
+        i = index.get(labels)
+        if i is not None:
+            return i
+        encoded = [label.encode('utf-8') for label in labels]
+        data = b''.join(encoded)
+        offset = header.size + self.__used
+        if self.__used + entry_header.size + len(data) > self.__dictionary_size or len(entries) > 0xffff:
+            raise JournalFull('No room in the dictionary for {!r}'.format(labels))
+        entry_header.pack_into(self.__map, offset, kind, len(encoded[0]), len(encoded[1]))
+        self.__map[offset+entry_header.size:offset+entry_header.size+len(data)] = data
+        self.__used += entry_header.size + len(data)
+        i = index[labels] = len(entries)
+        entries.append(labels)
+        return i
+
+    def record(self, timestamp, phy, version, readings):
+        with self.__lock:
+            try:
+                device = self.__index(DEVICE, (phy, version))
+                for type_, name, value in readings:
+                    sensor = self.__index(SENSOR, (type_, name))
+                    record.pack_into(self.__map, self.__records_offset + self.__next * record.size, timestamp, device, sensor, value)
+                    self.__next = (self.__next + 1) % self.__capacity
+                    self.__count = min(self.__count + 1, self.__capacity)
+            except JournalFull as e:
+                print(e, file=sys.stderr)
+            # Update the header after writing the records, so that (until the
+            # journal wraps around) it never covers an incomplete record.
+            self.__write_header()
+
+    def __len__(self):
+        return self.__count
+
+    def __iter__(self):
+        '''
+        Yields (timestamp, phy, version, type, name, value) for each record,
+        oldest first.
+        '''
+        with self.__lock:
+            start = (self.__next - self.__count) % self.__capacity
+            count = self.__count
+        for i in range(count):
+            offset = self.__records_offset + (start + i) % self.__capacity * record.size
+            timestamp, device, sensor, value = record.unpack_from(self.__map, offset)
+            phy, version = self.__devices[device]
+            type_, name = self.__sensors[sensor]
+            yield timestamp, phy, version, type_, name, value
+
+    def replay(self, fn):
+        '''
+        Pass each record to fn, as if it were a listener registered with an
+        exporter.Collector.
+        '''
+        for timestamp, phy, version, type_, name, value in self:
+            fn(timestamp, phy, version, [(type_, name, value)])
+
+    def flush(self):
+        if not self.__readonly:
+            self.__map.flush()
+
+    def close(self):
+        with self.__lock:
+            self.flush()
+            self.__map.close()
+
+def openmetrics(journal):
+    '''
+    Yields lines of text in the OpenMetrics format, with a timestamp for
+    each sample; suitable for 'promtool tsdb create-blocks-from openmetrics'.
+
+    journal may be a Journal, or any other re-iterable of rows in the same
+    format.
+    '''
+    # Samples for each metric must be grouped together, so make a pass over
+    # the journal for each one.
+    for type_, metric in sorted(metric_names.items()):
+        yield '# TYPE {} gauge\n'.format(metric)
+        for timestamp, phy, version, t, name, value in journal:
+            if t == type_:
+                yield '{}{{name="{}",phy="{}",version="{}"}} {!r} {!r}\n'.format(metric, escape(name), escape(phy), escape(version), value, timestamp)
+    yield '# EOF\n'
+
+def main(argv=None):
+    '''
+    Dump the contents of a journal, or replay it as OpenMetrics text.
+    '''
+    parser = argparse.ArgumentParser(prog='temper-exporter-journal', description=main.__doc__)
+    parser.add_argument('command', choices=['dump', 'replay'], help='dump: tab-separated timestamp, phy, version, type, name, value; replay: OpenMetrics')
+    parser.add_argument('journal', help='Journal file')
+    args = parser.parse_args(argv)
+
+    try:
+        journal = Journal(args.journal)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    try:
+        if args.command == 'dump':
+            for row in journal:
+                sys.stdout.write('\t'.join(str(field) for field in row) + '\n')
+        else:
+            sys.stdout.writelines(openmetrics(journal))
+    finally:
+        journal.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+'''
+Pushes readings to a Prometheus remote-write endpoint (or anything that
+accepts OpenMetrics text), so that they can be stored at a higher resolution
+than the scrape interval.
+'''
+
+import collections
+import http.client
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+import prometheus_client.core as core
+
+from . import instrument
+from .aggregate import metric_names
+from .journal import openmetrics
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+samples_sent = instrument.Counter('temper_exporter_push_samples_sent', 'Number of samples accepted by the push endpoint')
+samples_dropped = instrument.Counter('temper_exporter_push_samples_dropped', 'Number of samples that were not pushed', ['reason'])
+push_duration = instrument.Histogram('temper_exporter_push_duration_seconds', 'Time taken to push a batch of samples')
+
+def varint(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+def field(number, wire_type, payload):
+    '''
+    Encodes a protobuf field; payload is already encoded, except that its
+    length is prepended if wire_type is 2 (length-delimited).
+    '''
+    key = varint(number << 3 | wire_type)
+    if wire_type == 2:
+        return key + varint(len(payload)) + payload
+    return key + payload
+
+def encode_write_request(series):
+    '''
+    Encodes a prometheus.WriteRequest message. series is a list of (labels,
+    samples) pairs; labels is a list of (name, value) pairs, which must
+    include __name__ and be sorted by name; samples is a list of (value,
+    timestamp in milliseconds) pairs.
+    '''
+    out = bytearray()
+    for labels, samples in series:
+        ts = bytearray()
+        for name, value in labels:
+            ts += field(1, 2, field(1, 2, name.encode('utf-8')) + field(2, 2, value.encode('utf-8')))
+        for value, timestamp in samples:
+            ts += field(2, 2, field(1, 1, struct.pack('<d', value)) + field(2, 0, varint(timestamp)))
+        out += field(1, 2, bytes(ts))
+    return bytes(out)
+
+def snappy_compress(data):
+    '''
+    Compresses data in the snappy block format. If the snappy module is not
+    installed, the data is encoded as literals, without any compression; the
+    result is still valid for any snappy decoder.
+    '''
+    if snappy is not None:
+        return snappy.compress(data)
+    out = bytearray(varint(len(data)))
+    for i in range(0, len(data), 65536):
+        chunk = data[i:i+65536]
+        n = len(chunk) - 1
+        if n < 60:
+            out.append(n << 2)
+        elif n < 0x100:
+            out.append(60 << 2)
+            out.append(n)
+        else:
+            out.append(61 << 2)
+            out += struct.pack('<H', n)
+        out += chunk
+    return bytes(out)
+
+class Pusher(threading.Thread):
+    '''
+    Queues readings, and pushes them to url in batches of up to batch_size
+    samples, at least every interval seconds.
+
+    format is 'remote-write' (snappy-compressed protobuf, as understood by
+    Prometheus's remote-write receiver) or 'openmetrics' (text).
+
+    If a push fails, it is retried with exponential backoff (up to
+    max_backoff seconds), while new readings continue to be queued; once
+    max_queue samples are queued, the oldest are dropped.
+
+    Register record() as a listener with an exporter.Collector to feed it.
+    '''
+    def __init__(self, url, format='remote-write', batch_size=500, interval=5, max_queue=100000, timeout=10, max_backoff=60, registry=core.REGISTRY):
+        super().__init__(name='push')
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL scheme {!r}'.format(parts.scheme))
+        if not parts.hostname:
+            raise ValueError('No host in URL {!r}'.format(url))
+        # Raises ValueError if the port is not a number
+        parts.port
+        self.__connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.__netloc = parts.netloc
+        self.__path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        self.__format = format
+        self.__batch_size = batch_size
+        self.__interval = interval
+        self.__max_backoff = max_backoff
+        self.__timeout = timeout
+        self.__connection = None
+        # Of (timestamp, phy, version, type, name, value), as yielded by
+        # iterating over a journal.Journal
+        self.__queue = collections.deque()
+        self.__max_queue = max_queue
+        self.__cond = threading.Condition()
+        self.__stop = False
+        instrument.CallbackGauge('temper_exporter_push_queue_length', 'Number of samples waiting to be pushed', lambda: len(self.__queue), registry=registry)
+
+    def record(self, timestamp, phy, version, readings):
+        with self.__cond:
+            for type_, name, value in readings:
+                if len(self.__queue) >= self.__max_queue:
+                    self.__queue.popleft()
+                    samples_dropped.inc(('queue_full',))
+                self.__queue.append((timestamp, phy, version, type_, name, value))
+            if len(self.__queue) >= self.__batch_size:
+                self.__cond.notify()
+
+    def send_stop(self):
+        '''
+        Cause the thread to exit, after trying once to push whatever is
+        queued.
+        '''
+        with self.__cond:
+            self.__stop = True
+            self.__cond.notify()
+
+    def run(self):
+        backoff = 0
+        deadline = time.monotonic() + self.__interval
+        while True:
+            with self.__cond:
+                # Push as soon as a batch is full, unless we're backing off
+                while not self.__stop and (backoff or len(self.__queue) < self.__batch_size):
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.__cond.wait(timeout)
+                stop = self.__stop
+                batch = [self.__queue[i] for i in range(min(len(self.__queue), self.__batch_size))]
+
+            sent = True
+            if batch:
+                sent = self.__push(batch)
+            if batch and sent:
+                with self.__cond:
+                    # Some of the batch may have been dropped from the queue
+                    # (to make room for new samples) while we were pushing.
+                    for sample in batch:
+                        if self.__queue and self.__queue[0] is sample:
+                            self.__queue.popleft()
+
+            if stop:
+                if self.__connection is not None:
+                    self.__connection.close()
+                return
+            if sent:
+                backoff = 0
+                deadline = time.monotonic() + self.__interval
+            else:
+                backoff = min(max(1, backoff * 2), self.__max_backoff)
+                deadline = time.monotonic() + backoff
+
+    def __push(self, batch):
+        '''
+        Returns True if the batch was dealt with (sent, or rejected as
+        invalid); False if it should be retried.
+        '''
+        if self.__format == 'openmetrics':
+            body = ''.join(openmetrics(batch)).encode('utf-8')
+            headers = {'Content-Type': 'application/openmetrics-text; version=1.0.0; charset=utf-8'}
+        else:
+            body = snappy_compress(self.encode_remote_write(batch))
+            headers = {
+                'Content-Type': 'application/x-protobuf',
+                'Content-Encoding': 'snappy',
+                'X-Prometheus-Remote-Write-Version': '0.1.0',
+            }
+
+        start = time.perf_counter()
+        try:
+            if self.__connection is None:
+                self.__connection = self.__connection_class(self.__netloc, timeout=self.__timeout)
+            self.__connection.request('POST', self.__path, body, headers)
+            with self.__connection.getresponse() as r:
+                r.read()
+                status = r.status
+                reason = r.reason
+        except (OSError, http.client.HTTPException) as e:
+            print('Error pushing samples: {}'.format(e), file=sys.stderr)
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+            return False
+        finally:
+            push_duration.observe(time.perf_counter() - start)
+
+        if 200 <= status < 300:
+            samples_sent.inc(amount=len(batch))
+            return True
+        print('Error pushing samples: {} {}'.format(status, reason), file=sys.stderr)
+        if 400 <= status < 500 and status != 429:
+            # The receiver won't accept the samples however many times we try
+            samples_dropped.inc(('rejected',), len(batch))
+            return True
+        return False
+
+    @staticmethod
+    def encode_remote_write(batch):
+        series = collections.OrderedDict()
+        for timestamp, phy, version, type_, name, value in batch:
+            metric = metric_names.get(type_)
+            if metric is None:
+                continue
+            labels = (('__name__', metric), ('name', name), ('phy', phy), ('version', version))
+            series.setdefault(labels, []).append((value, int(timestamp * 1000)))
+        return encode_write_request(list(series.items()))
+
+    def healthy(self):
+        return self.is_alive()
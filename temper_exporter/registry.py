@@ -0,0 +1,130 @@
+import threading
+
+from .exposition import sample_prefix
+
+class Entry:
+    '''
+    A device known to a Registry, with the labels that identify it, which are
+    worked out once when the device is added.
+
+    An Entry also holds the collector's state for the device. It is changed
+    in place (with the collector's lock held), so that a scrape can render
+    it straight from a Snapshot, without taking a lock or copying anything.
+    '''
+    __slots__ = ('device', 't', 'phy', 'version', 'model', 'sys_path', 'reading', 'timeouts', 'added', 'first_reading', 'failure', 'in_flight', '__labels', '__prefixes')
+
+    def __init__(self, device, t):
+        self.device = device
+        self.t = t
+        try:
+            self.phy = str(t.phy())
+        except Exception:
+            # Perhaps the device has gone away already
+            self.phy = ''
+        self.version = t.version
+        self.model = t.__class__.__name__
+        self.sys_path = getattr(device, 'sys_path', None)
+        # (expires, readings) from the last successful read, or None
+        self.reading = None
+        # Number of times the device didn't respond in time
+        self.timeouts = 0
+        # time.monotonic() when the device was plugged in, until it has been
+        # read successfully; then first_reading is the seconds in between
+        self.added = None
+        self.first_reading = None
+        # The exporter.Failure of a device that has been reopened, until it
+        # has been read successfully
+        self.failure = None
+        # [Future, time.monotonic() when the read started (or None if it
+        # hasn't), whether it has timed out], while a read is in progress
+        self.in_flight = None
+        self.__labels = {}
+        self.__prefixes = {}
+
+    def labels(self, name):
+        '''
+        Returns the label values (name, phy, version) for one of the device's
+        sensors.
+        '''
+        labels = self.__labels.get(name)
+        if labels is None:
+            labels = self.__labels[name] = (name, self.phy, self.version)
+        return labels
+
+    def prefix(self, sample, name=None):
+        '''
+        Returns the exposition prefix (see exposition.sample_prefix) for a
+        sample of one of the device's sensors, or, if name is None, of the
+        device itself.
+        '''
+        key = (sample, name)
+        prefix = self.__prefixes.get(key)
+        if prefix is None:
+            labels = [('phy', self.phy), ('version', self.version)]
+            if name is not None:
+                labels.insert(0, ('name', name))
+            prefix = self.__prefixes[key] = sample_prefix(sample, labels)
+        return prefix
+
+class Snapshot:
+    '''
+    An immutable view of a Registry's contents at some point in time.
+    '''
+    __slots__ = ('entries',)
+
+    def __init__(self, entries):
+        self.entries = entries
+
+class Registry:
+    '''
+    Keeps track of open devices (pyudev.Device -> temper.usb_temper).
+
+    Devices are added and removed rarely, but the registry is read on every
+    scrape and every sample, so it is copy-on-write: each change builds a
+    new Snapshot, which readers can then use without taking a lock or
+    copying anything.
+    '''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__snapshot = Snapshot({})
+
+    def snapshot(self):
+        return self.__snapshot
+
+    def __len__(self):
+        return len(self.__snapshot.entries)
+
+    def __iter__(self):
+        '''
+        Iterate over the Entry for each device.
+        '''
+        return iter(self.__snapshot.entries.values())
+
+    def get(self, device):
+        '''
+        Returns the Entry for a device, or None.
+        '''
+        return self.__snapshot.entries.get(device)
+
+    def add(self, device, t):
+        '''
+        Add (or replace) a device; returns its Entry.
+        '''
+        entry = Entry(device, t)
+        with self.__lock:
+            entries = dict(self.__snapshot.entries)
+            entries[device] = entry
+            self.__snapshot = Snapshot(entries)
+        return entry
+
+    def remove(self, device):
+        '''
+        Remove a device; returns its Entry, or None if it was not present.
+        '''
+        with self.__lock:
+            entry = self.__snapshot.entries.get(device)
+            if entry is not None:
+                entries = dict(self.__snapshot.entries)
+                del entries[device]
+                self.__snapshot = Snapshot(entries)
+        return entry
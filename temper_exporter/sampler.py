@@ -0,0 +1,156 @@
+import fnmatch
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from . import health
+
+class Sampler(threading.Thread):
+    '''
+    Reads from each of a collector's devices on its own schedule, so that
+    scrapes never have to wait for the hardware.
+
+    Each device is polled every interval seconds, unless it matches one of
+    rules: a list of (pattern, interval) pairs. A pattern is matched (with
+    fnmatch) against the device's phy and the name of its class (e.g.,
+    'temper2hum'); the first matching rule wins.
+
+    Readings are dropped stale_intervals poll intervals after they were taken.
+
+    Each poll is shifted by up to jitter * interval seconds either way, so
+    that devices with the same interval don't all hit the USB bus at once. A
+    device that can't be read (or doesn't respond within the collector's
+    read_timeout) is retried after an exponentially increasing delay, up to
+    max_backoff seconds.
+
+    Devices are read in the background, so a slow device doesn't hold up
+    any other device's schedule.
+    '''
+    def __init__(self, collector, interval, rules=(), stale_intervals=3, jitter=0.1, max_backoff=300):
+        super().__init__(name='sampler')
+        self.__collector = collector
+        self.__interval = interval
+        self.__rules = list(rules)
+        self.__stale_intervals = stale_intervals
+        self.__jitter = jitter
+        self.__max_backoff = max_backoff
+        self.__stop = False
+        # Set to wake the thread up, when stopping or when a read finishes
+        self.__wake = threading.Event()
+        # Heap of (due, seq, device); seq breaks ties, since devices can't be
+        # compared.
+        self.__schedule = []
+        self.__seq = itertools.count()
+        # device -> [usb_temper, interval, consecutive failures]
+        self.__state = {}
+        # device -> (when the poll was due, when it started, Future), for
+        # reads in progress
+        self.__reading = {}
+        # The loop below wakes up at least once a second
+        self.heartbeat = health.Heartbeat(30)
+
+    def send_stop(self):
+        '''
+        Cause the thread to exit. Reads in progress are left to finish in the
+        background.
+        '''
+        self.__stop = True
+        self.__wake.set()
+
+    def run(self):
+        read_timeout = self.__collector.read_timeout()
+        while not self.__stop:
+            self.__wake.clear()
+            self.heartbeat.beat()
+            self.__collector.recover()
+            now = time.monotonic()
+            self.__update_devices(now)
+            self.__reap(now, read_timeout)
+            while self.__schedule and self.__schedule[0][0] <= now:
+                when, seq, device = heapq.heappop(self.__schedule)
+                if device in self.__state:
+                    self.__poll(when, device)
+
+            # Wake up at least once a second to pick up new (or recovered)
+            # devices.
+            timeout = 1
+            if self.__schedule:
+                timeout = min(timeout, self.__schedule[0][0] - now)
+            for when, started, future in self.__reading.values():
+                timeout = min(timeout, started + read_timeout - now)
+            self.__wake.wait(max(0, timeout))
+
+    def interval_for(self, entry):
+        '''
+        Returns the poll interval for a device, given its registry.Entry.
+        '''
+        names = [entry.phy, entry.model]
+        for pattern, interval in self.__rules:
+            if any(fnmatch.fnmatchcase(name, pattern) for name in names):
+                return interval
+        return self.__interval
+
+    def __update_devices(self, now):
+        '''
+        Start polling new devices; stop polling removed ones.
+        '''
+        current = {entry.device: entry for entry in self.__collector.entries()}
+        for device in list(self.__state):
+            entry = current.get(device)
+            if entry is None or entry.t is not self.__state[device][0]:
+                del self.__state[device]
+        for device, entry in current.items():
+            if device not in self.__state:
+                interval = self.interval_for(entry)
+                self.__state[device] = [entry.t, interval, 0]
+                # Poll new devices right away, but spread them out a bit so
+                # that a coldplug scan doesn't produce a burst.
+                self.__push(now + random.uniform(0, self.__jitter * interval), device)
+
+    def __poll(self, when, device):
+        t, interval, failures = self.__state[device]
+        future = self.__collector.submit(device, t, interval * self.__stale_intervals)
+        self.__reading[device] = (when, time.monotonic(), future)
+        future.add_done_callback(lambda future: self.__wake.set())
+
+    def __reap(self, now, read_timeout):
+        '''
+        Schedule the next poll of each device whose read has finished (or
+        timed out).
+        '''
+        for device, (when, started, future) in list(self.__reading.items()):
+            if future.done():
+                ok = not future.cancelled() and future.exception() is None and future.result()
+            elif now - started >= read_timeout:
+                # The read carries on in the background; if it is still
+                # going when the device is next polled, the collector treats
+                # the device as having failed.
+                self.__collector.count_timeout(device)
+                ok = False
+            else:
+                continue
+            del self.__reading[device]
+            state = self.__state.get(device)
+            if state is None:
+                continue
+            t, interval, failures = state
+            if ok:
+                state[2] = 0
+                delay = interval
+            else:
+                state[2] = failures + 1
+                delay = min(interval * 2 ** state[2], max(interval, self.__max_backoff))
+            delay *= 1 + random.uniform(-self.__jitter, self.__jitter)
+            # Schedule from when the poll was due rather than from now, so
+            # that the time taken to read the device doesn't cause drift;
+            # unless we've fallen behind (maybe the system was suspended), in
+            # which case don't try to catch up.
+            self.__push(max(when + delay, time.monotonic()), device)
+
+    def __push(self, when, device):
+        heapq.heappush(self.__schedule, (when, next(self.__seq), device))
+
+    def healthy(self):
+        return self.is_alive() and self.heartbeat.healthy()
@@ -1,34 +1,313 @@
+import array
+import configparser
 import contextlib
+import fnmatch
+import functools
+import re
 import struct
+import sys
+import threading
+import time
 
 import pyudev
 
+from . import instrument
+
+# numpy takes a while to import, and is only needed for batch conversion,
+# so it isn't imported until it's needed; see load_numpy().
+not_loaded = object()
+numpy = not_loaded
+
+def load_numpy():
+    '''
+    Returns the numpy module, importing it the first time; or None if it is
+    not installed.
+    '''
+    global numpy
+    if numpy is not_loaded:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
 cmd_read_temper     = b'\x01\x80\x33\x01\x00\x00\x00\x00'
 cmd_get_calibration = b'\x01\x82\x77\x01\x00\x00\x00\x00'
 cmd_get_version     = b'\x01\x86\xff\x01\x00\x00\x00\x00'
 cmd_stop            = b'\x01\x88\x55\x00\x00\x00\x00\x00'
 cmd_read_sensor_id  = b'\x01\x89\x55\x00\x00\x00\x00\x00'
 
+# Label values for command_duration, keyed by the command's second byte
+command_labels = {
+    cmd_read_temper[1]:     ('read_temper',),
+    cmd_get_calibration[1]: ('get_calibration',),
+    cmd_get_version[1]:     ('get_version',),
+    cmd_stop[1]:            ('stop',),
+    cmd_read_sensor_id[1]:  ('read_sensor_id',),
+}
+
+command_duration = instrument.Histogram('temper_exporter_command_duration_seconds', 'Time taken for a device to respond to a command', ['command'])
+
+def observe_command(cmd, start):
+    '''
+    Record the time taken for a device to respond to cmd, which was sent at
+    time start (from time.perf_counter()).
+    '''
+    labels = command_labels.get(cmd[1]) or ('0x{:02x}'.format(cmd[1]),)
+    command_duration.observe(time.perf_counter() - start, labels)
+
+@functools.lru_cache()
+def compile_format(fmt):
+    '''
+    Returns a struct.Struct for a format string, compiling it only once.
+    '''
+    return struct.Struct(fmt)
+
+def decode_response(cmd, fmt, buf):
+    '''
+    Check and decode the response to a command. fmt may be a format string or
+    a struct.Struct; buf may be any bytes-like object.
+    '''
+    if isinstance(fmt, str):
+        fmt = compile_format(fmt)
+    if len(buf) < 2:
+        raise IOError('Very short response: {}'.format(repr(bytes(buf))))
+    elif buf[0] != cmd[1]:
+        raise IOError('Bad response cmd: {}'.format(repr(bytes(buf))))
+    elif buf[1] != fmt.size:
+        raise IOError('Short response: {}'.format(repr(bytes(buf))))
+    try:
+        return fmt.unpack_from(buf, 2)
+    except struct.error:
+        raise IOError('Bad response: {}'.format(repr(bytes(buf))))
+
+def unpack_words(buf):
+    '''
+    Returns the big-endian 16-bit signed words in buf (for instance, several
+    concatenated responses to cmd_read_temper, minus their two byte headers),
+    as a numpy array if numpy is available, otherwise as an array.array.
+    '''
+    numpy = load_numpy()
+    if numpy is not None:
+        return numpy.frombuffer(buf, dtype='>i2')
+    words = array.array('h', bytes(buf))
+    if sys.byteorder != 'big':
+        words.byteswap()
+    return words
+
+def decode_version(buf):
+    '''
+    Check and decode the two reports sent in response to cmd_get_version.
+    '''
+    if len(buf) != 16:
+        raise IOError('Short version response ({})'.format(len(buf)))
+    return bytes(buf).decode('ascii', errors='replace')
+
+# Calibration offsets read from devices, keyed by phy. Each value is a tuple
+# of (devnum, offsets): a device gets a new USB device number whenever it is
+# plugged in, so an entry is never used for a device that has been replaced
+# (or unplugged and plugged back in), even if the phy is the same.
+calibration_cache = {}
+calibration_cache_lock = threading.Lock()
+
+# Calibration offsets loaded by load_calibration(): a list of (pattern,
+# offsets) tuples.
+calibration_overrides = []
+
+def load_calibration(path):
+    '''
+    Load calibration offsets from an INI file. Each section's name is a
+    pattern, matched (with fnmatch) against a device's phy and the name of
+    its class (e.g., 'temper2hum'); the first matching section wins. Each
+    key is a sensor's type, optionally followed by a dot and the sensor's
+    name; the value is added to the sensor's readings, instead of the
+    offset reported by the device. For instance:
+
+        [usb-0000:00:14.0-1.4/input1]
+        temp.internal = -0.5
+
+        [temper2hum]
+        temp = 0.25
+        humid = 2
+    '''
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
+    with open(path) as f:
+        parser.read_file(f)
+    overrides = []
+    for section in parser.sections():
+        offsets = {}
+        for key, value in parser.items(section):
+            type_, sep, name = key.partition('.')
+            try:
+                offsets[type_, name] = float(value)
+            except ValueError:
+                raise ValueError('{}: [{}] {}: {!r} is not a number'.format(path, section, key, value))
+        overrides.append((section, offsets))
+    calibration_overrides[:] = overrides
+
+def cached_calibration(cls, udev_device, phy):
+    '''
+    Returns (devnum, offsets), where offsets are the calibration offsets
+    previously read from the device (see usb_temper.offsets()), or None if
+    they have to be read (in which case, pass devnum to cache_calibration()
+    once they have been). If the device doesn't report its calibration,
+    offsets is an empty dict.
+    '''
+    if cls.calibration_format is None:
+        return None, {}
+    usb = udev_device.find_parent(subsystem=b'usb', device_type=b'usb_device')
+    devnum = usb.properties.get('DEVNUM') if usb is not None else None
+    with calibration_cache_lock:
+        cached = calibration_cache.get(phy)
+    if cached is not None and cached[0] == devnum:
+        return devnum, dict(cached[1])
+    return devnum, None
+
+def cache_calibration(phy, devnum, offsets):
+    with calibration_cache_lock:
+        calibration_cache[phy] = (devnum, dict(offsets))
+
+def override_calibration(cls, phy, offsets):
+    '''
+    Applies the first matching override loaded by load_calibration() to a
+    dict of calibration offsets, and drops any that are zero.
+    '''
+    for pattern, overrides in calibration_overrides:
+        if fnmatch.fnmatchcase(phy or '', pattern) or fnmatch.fnmatchcase(cls.__name__, pattern):
+            offsets.update(overrides)
+            break
+    return {sensor: offset for sensor, offset in offsets.items() if offset}
+
+# A devcache.DeviceCache, if the static information about devices (version
+# and calibration) should be remembered across restarts.
+device_cache = None
+
+# An aiotemper.Reactor, if commands should be sent to devices through its
+# event loop, giving up on a device that doesn't respond within
+# reactor.timeout seconds, rather than with blocking reads that could hang
+# forever.
+reactor = None
+
+def calibrate(readings, offsets):
+    '''
+    Add calibration offsets (as returned by override_calibration()) to an
+    iterable of (type, name, value) tuples.
+    '''
+    if not offsets:
+        return readings
+    return ((type_, name, value + offsets.get((type_, name), 0)) for type_, name, value in readings)
+
+modalias_re = re.compile(r'usb:v([0-9A-F]{4})p([0-9A-F]{4}).*in([0-9A-F]{2})$', re.IGNORECASE)
+
+def parse_modalias(modalias):
+    '''
+    Returns (vendor, product, interface number) from a USB interface's
+    modalias, as integers; or None if it isn't a USB interface modalias.
+    '''
+    if not isinstance(modalias, str):
+        return None
+    m = modalias_re.match(modalias)
+    if m is None:
+        return None
+    return tuple(int(x, 16) for x in m.groups())
+
 class matcher(type):
+    '''
+    Metaclass that registers each class that uses it, so that devices can be
+    matched to the class that handles them, by the (vendor, product,
+    interface number) parsed from the class's modalias attribute.
+    '''
     matchers = []
+    __index = None
 
     def __new__(mcs, name, bases, class_dict):
         cls = super().__new__(mcs, name, bases, class_dict)
         mcs.matchers.append(cls)
+        matcher.__index = None
         return cls
 
+    @classmethod
+    def index(cls):
+        '''
+        Returns a dict mapping (vendor, product, interface number) to a class.
+        If two classes have the same key, the one registered last wins, so
+        that models loaded by load_models() can replace the built-in ones.
+        '''
+        index = matcher.__index
+        if index is None:
+            index = {}
+            for m in cls.matchers:
+                key = parse_modalias(m.modalias)
+                if key is not None:
+                    index[key] = m
+            matcher.__index = index
+        return index
+
     @classmethod
     def match(cls, device):
         '''
         Returns a class to handle the provided device, if one exists;
         otherwise returns None.
         '''
-        for m in cls.matchers:
-            if m.match(device):
-                return m
-        return None
+        intf = device.find_parent(subsystem=b'usb', device_type=b'usb_interface')
+        if intf is None:
+            return None
+        key = parse_modalias(intf.get(b'MODALIAS'))
+        if key is None:
+            return None
+        return cls.index().get(key)
+
+def register_model(name, vendor, product, interface, protocol):
+    '''
+    Register a new class named name, to handle devices with the given USB
+    vendor, product and interface number (integers) in the same way as the
+    existing class named protocol (e.g., 'temper2').
+    '''
+    bases = [m for m in matcher.matchers if m.__name__ == protocol]
+    if not bases:
+        raise ValueError('Unknown protocol {!r}'.format(protocol))
+    modalias = 'usb:v{:04X}p{:04X}in{:02X}'.format(vendor, product, interface)
+    return matcher(name, (bases[0],), {'modalias': modalias, '__module__': __name__})
+
+def load_models(path):
+    '''
+    Register models from an INI file. Each section's name is the name of a
+    model; its keys are vendor and product (hexadecimal USB IDs), interface
+    (the number of the HID interface used to talk to the device; default 1)
+    and protocol (the model that the device behaves like). For instance:
+
+        [temper2_v2]
+        vendor = 0c45
+        product = 7401
+        interface = 1
+        protocol = temper2
+    '''
+    parser = configparser.ConfigParser()
+    with open(path) as f:
+        parser.read_file(f)
+    for name in parser.sections():
+        section = parser[name]
+        try:
+            register_model(name, int(section['vendor'], 16), int(section['product'], 16), int(section.get('interface', '1'), 16), section['protocol'])
+        except KeyError as e:
+            raise ValueError('{}: [{}]: missing {}'.format(path, name, e))
+        except ValueError as e:
+            raise ValueError('{}: [{}]: {}'.format(path, name, e))
 
 class usb_temper:
+    # The modalias of the USB interface of the devices handled by the class
+    modalias = None
+
+    @classmethod
+    def match(cls, udev_device):
+        '''
+        Returns True if the class handles udev_device.
+        '''
+        key = parse_modalias(cls.modalias)
+        return key is not None and cls.match_interface(udev_device, lambda i: parse_modalias(i.get(b'MODALIAS')) == key)
+
     @classmethod
     def match_interface(cls, udev_device, fn):
         '''
@@ -42,8 +321,30 @@ class usb_temper:
 
     def __init__(self, udev_device):
         self.__udev_device = udev_device
-        self.__device = open(udev_device.device_node, 'r+b', buffering=0)
-        self.version = self.read_version()
+        # Responses are read into this buffer, rather than allocating a new
+        # bytes object for every report. It grows to fit the largest batch
+        # passed to send_many().
+        self.__rbuf = bytearray(16)
+        self.__reactor = reactor
+        if self.__reactor is not None:
+            # An aiotemper.async_usb_temper, which every command goes through
+            self.__aio = self.__reactor.open(udev_device, self.__class__)
+            self.__device = None
+        else:
+            self.__aio = None
+            self.__device = open(udev_device.device_node, 'r+b', buffering=0)
+        cached = device_cache.get(udev_device) if device_cache is not None else None
+        phy = self.phy()
+        if cached is not None and cached[1] == phy:
+            self.version = cached[0]
+            self.calibration = override_calibration(self.__class__, phy, cached[2])
+        else:
+            self.version, offsets = self.read_version_and_offsets()
+            self.calibration = override_calibration(self.__class__, phy, offsets)
+            # Unless the calibration couldn't be read, in which case it
+            # should be tried again next time
+            if device_cache is not None and cached_calibration(self.__class__, udev_device, phy)[1] is not None:
+                device_cache.put(udev_device, self.version, phy, offsets)
 
     def __del__(self):
         with contextlib.suppress(Exception):
@@ -60,23 +361,59 @@ class usb_temper:
         # to do here except read from the device.
         return self.__device.read(8)
 
+    def readinto8(self, view):
+        '''
+        Like read8, but reads into view (which must be at least 8 bytes long),
+        returning the number of bytes read.
+        '''
+        return self.__device.readinto(view[:8])
+
     def send(self, cmd, fmt):
         '''
         Issue a command, check and decode the response.
         '''
         assert len(cmd) == 8
+        if self.__aio is not None:
+            return self.__reactor.call(self.__aio.send(cmd, fmt))
+        view = memoryview(self.__rbuf)
+        start = time.perf_counter()
         self.write(cmd)
-        buf = self.read8()
-        if len(buf) < 2:
-            raise IOError('Very short response: {}'.format(repr(buf)))
-        elif buf[0] != cmd[1]:
-            raise IOError('Bad response cmd: {}'.format(repr(buf)))
-        elif buf[1] != struct.calcsize(fmt):
-            raise IOError('Short response: {}'.format(repr(buf)))
-        try:
-            return struct.unpack_from(fmt, buf, 2)
-        except struct.error:
-            raise IOError('Bad response: {}'.format(repr(buf)))
+        n = self.readinto8(view)
+        observe_command(cmd, start)
+        return decode_response(cmd, fmt, view[:n])
+
+    def send_many(self, commands):
+        '''
+        Issue several commands, given as a list of (cmd, fmt) tuples; returns
+        a list of their decoded responses. The response to cmd_get_version
+        (whose fmt is ignored) is decoded as by read_version().
+
+        All the commands are written before any responses are read, so the
+        device can respond to one while the next is in flight.
+
+        If any response is bad, raises IOError after reading the rest, so
+        that they are not mistaken for responses to later commands.
+        '''
+        if self.__aio is not None:
+            return self.__reactor.call(self.__aio.send_many(commands))
+        # cmd_get_version is answered with two reports
+        reports = [2 if cmd == cmd_get_version else 1 for cmd, fmt in commands]
+        if len(self.__rbuf) < 8 * sum(reports):
+            self.__rbuf = bytearray(8 * sum(reports))
+        view = memoryview(self.__rbuf)
+        start = time.perf_counter()
+        for cmd, fmt in commands:
+            assert len(cmd) == 8
+            self.write(cmd)
+        bounds = []
+        n = 0
+        for (cmd, fmt), count in zip(commands, reports):
+            begin = n
+            for i in range(count):
+                n += self.readinto8(view[n:])
+            observe_command(cmd, start)
+            bounds.append((begin, n))
+        return [decode_version(view[begin:end]) if cmd == cmd_get_version else decode_response(cmd, fmt, view[begin:end]) for (cmd, fmt), (begin, end) in zip(commands, bounds)]
 
     def write(self, data):
         # First byte is report number, or 0 if the device does not use numbered reports
@@ -86,21 +423,119 @@ class usb_temper:
             raise IOError('Short write ({}/{})'.format(nbytes, len(buf)))
 
     def read_version(self):
+        if self.__aio is not None:
+            return self.__reactor.call(self.__aio.read_version())
+        view = memoryview(self.__rbuf)
+        start = time.perf_counter()
         self.write(cmd_get_version)
-        version = self.read8() + self.read8()
-        if len(version) != 16:
-            raise IOError('Short version response ({})'.format(len(version)))
-        return version.decode('ascii', errors='replace')
+        n = self.readinto8(view)
+        n += self.readinto8(view[n:])
+        observe_command(cmd_get_version, start)
+        return decode_version(view[:n])
+
+    # struct format of the response to cmd_read_temper, or None if the device
+    # is not supported.
+    sensor_format = None
+
+    @staticmethod
+    def convert(raw):
+        '''
+        Given the decoded response to cmd_read_temper, returns an iterator
+        yielding a tuple of (type, name, value), where type is 'temp' or
+        'humid' and name may be an empty string.
+        '''
+        raise NotImplementedError
+
+    # The (type, name) of each value yielded by convert(), in order
+    sensors = ()
+
+    @classmethod
+    def convert_many(cls, words):
+        '''
+        Batch version of convert(), for converting many readings at once.
+        words is a flat sequence (a list, an array.array or a numpy array) of
+        the integers in the decoded responses to cmd_read_temper, one
+        response after another; see unpack_words().
+
+        Returns a list of (type, name, values) tuples, one for each of the
+        sensors, where values is a numpy array of floats if numpy is
+        available, otherwise an array.array('d').
+        '''
+        raise NotImplementedError
+
+    # struct format of the response to cmd_get_calibration, or None if the
+    # device does not report its calibration.
+    calibration_format = None
+
+    @staticmethod
+    def offsets(raw):
+        '''
+        Given the decoded response to cmd_get_calibration, returns a dict
+        mapping (type, name) to an offset to be added to that sensor's
+        readings.
+        '''
+        raise NotImplementedError
+
+    def read_calibration_offsets(self):
+        '''
+        Returns the offsets to be added to the device's readings: the device's
+        own calibration (see read_device_offsets()), overridden by anything
+        loaded by load_calibration().
+        '''
+        return override_calibration(self.__class__, self.phy(), self.read_device_offsets())
+
+    def read_version_and_offsets(self):
+        '''
+        Returns the device's version string and its own calibration offsets
+        (see read_device_offsets()). If the offsets have to be read from the
+        device, both are asked for at once.
+        '''
+        phy = self.phy()
+        devnum, offsets = cached_calibration(self.__class__, self.__udev_device, phy)
+        if offsets is not None:
+            return self.read_version(), offsets
+        try:
+            version, raw = self.send_many([(cmd_get_version, None), (cmd_get_calibration, self.calibration_format)])
+            offsets = self.offsets(raw)
+        except IOError:
+            # Perhaps only the calibration couldn't be read, which isn't
+            # fatal; ask again one at a time to find out.
+            return self.read_version(), self.read_device_offsets()
+        cache_calibration(phy, devnum, offsets)
+        return version, offsets
+
+    def read_device_offsets(self):
+        '''
+        Returns the device's own calibration offsets, read from the device
+        only the first time it is plugged in. If they can't be read, they are
+        treated as zero.
+        '''
+        phy = self.phy()
+        devnum, offsets = cached_calibration(self.__class__, self.__udev_device, phy)
+        if offsets is None:
+            try:
+                offsets = self.offsets(self.send(cmd_get_calibration, self.calibration_format))
+            except IOError as e:
+                print('Error reading calibration from {}: {}'.format(phy, e), file=sys.stderr)
+                offsets = {}
+            else:
+                cache_calibration(phy, devnum, offsets)
+        return offsets
 
     def read_sensor(self):
         '''
-        Returns an iterator yielding a tuple of (type, name, value), where type
-        is 'temp' or 'humid' and name may be an empty string.
+        Returns an iterator yielding a tuple of (type, name, value), as
+        described in convert(), with the device's calibration applied.
         '''
-        raise IOError('Not implemented')
+        if self.sensor_format is None:
+            raise IOError('Not implemented')
+        return calibrate(self.convert(self.send(cmd_read_temper, self.sensor_format)), self.calibration)
 
     def close(self):
-        self.__device.close()
+        if self.__aio is not None:
+            self.__reactor.close(self.__aio)
+        else:
+            self.__device.close()
 
     def phy(self):
         '''
@@ -110,18 +545,14 @@ class usb_temper:
         return hid.properties.get('HID_PHYS')
 
 class temper(usb_temper, metaclass=matcher):
-    @classmethod
-    def match(cls, udev_device):
-        return cls.match_interface(udev_device, lambda i: i.get(b'MODALIAS') == 'usb:v1130p660Cd0150dc00dsc00dp00ic03isc00ip00in01')
+    modalias = 'usb:v1130p660Cd0150dc00dsc00dp00ic03isc00ip00in01'
 
     #def read_sensor(self):
         #self.write(b'\x54\x00\x00\x00\x00\x00\x00\x00')
         #print(self.read8()
 
 class temper2(usb_temper, metaclass=matcher):
-    @classmethod
-    def match(cls, udev_device):
-        return cls.match_interface(udev_device, lambda i: i.get(b'MODALIAS') == 'usb:v0C45p7401d0001dc00dsc00dp00ic03isc01ip02in01')
+    modalias = 'usb:v0C45p7401d0001dc00dsc00dp00ic03isc01ip02in01'
 
     def read_calibration(self):
         correction, wtf = self.send(cmd_get_calibration, '>bb')
@@ -131,28 +562,76 @@ class temper2(usb_temper, metaclass=matcher):
         id_ = self.send(cmd_read_sensor_id, '>b')
         return id_ & 0xf >> 1
 
-    def read_sensor(self):
-        tempi, tempe = self.send(cmd_read_temper, '>hh')
+    calibration_format = compile_format('>bb')
+
+    @staticmethod
+    def offsets(raw):
+        correction, wtf = raw
+        return {('temp', 'internal'): correction/16}
+
+    sensor_format = compile_format('>hh')
+
+    @staticmethod
+    def convert(raw):
+        tempi, tempe = raw
         yield 'temp', 'internal', tempi * 125 / 32000
         yield 'temp', 'external', tempe * 125 / 32000
 
-class temper2hum(usb_temper, metaclass=matcher):
+    sensors = (('temp', 'internal'), ('temp', 'external'))
+
     @classmethod
-    def match(cls, udev_device):
-        return cls.match_interface(udev_device, lambda i: i.get(b'MODALIAS') == 'usb:v0C45p7402d0001dc00dsc00dp00ic03isc01ip02in01')
+    def convert_many(cls, words):
+        numpy = load_numpy()
+        if numpy is not None:
+            columns = numpy.asarray(words, dtype=numpy.float64).reshape(-1, 2).T * (125 / 32000)
+        else:
+            columns = [array.array('d', (w * 125 / 32000 for w in words[i::2])) for i in range(2)]
+        return [(type_, name, column) for (type_, name), column in zip(cls.sensors, columns)]
+
+class temper2hum(usb_temper, metaclass=matcher):
+    modalias = 'usb:v0C45p7402d0001dc00dsc00dp00ic03isc01ip02in01'
 
     def read_calibration(self):
         correction, wtf, correction2, wtf2 = self.send(cmd_get_calibration, '>bbbb')
         return correction/16, correction2/16
 
-    def read_sensor(self):
-        temp, rh = self.send(cmd_read_temper, '>hh')
+    calibration_format = compile_format('>bbbb')
+
+    @staticmethod
+    def offsets(raw):
+        correction, wtf, correction2, wtf2 = raw
+        return {('temp', ''): correction/16, ('humid', ''): correction2/16}
+
+    sensor_format = compile_format('>hh')
+
+    @staticmethod
+    def convert(raw):
+        temp, rh = raw
         temp_c = temp/100 - 39.7
         rh_pc = -2.0468 + 0.0367 * rh - 1.5955e-6 * rh * rh
         rh_pc += (temp_c - 25) * (0.01 + 0.00008 * rh)
         yield 'temp', '', temp_c
         yield 'humid', '', min(max(rh_pc, 0.0), 100.0)
 
+    sensors = (('temp', ''), ('humid', ''))
+
+    @classmethod
+    def convert_many(cls, words):
+        numpy = load_numpy()
+        if numpy is not None:
+            temp, rh = numpy.asarray(words, dtype=numpy.float64).reshape(-1, 2).T
+            temp_c = temp / 100 - 39.7
+            rh_pc = -2.0468 + 0.0367 * rh - 1.5955e-6 * rh * rh
+            rh_pc += (temp_c - 25) * (0.01 + 0.00008 * rh)
+            numpy.clip(rh_pc, 0.0, 100.0, out=rh_pc)
+        else:
+            temp_c = array.array('d', (t / 100 - 39.7 for t in words[0::2]))
+            rh_pc = array.array('d', (
+                min(max(-2.0468 + 0.0367 * rh - 1.5955e-6 * rh * rh + (t - 25) * (0.01 + 0.00008 * rh), 0.0), 100.0)
+                for t, rh in zip(temp_c, words[1::2])
+            ))
+        return [(type_, name, column) for (type_, name), column in zip(cls.sensors, (temp_c, rh_pc))]
+
 def monitor(ctx):
     m = pyudev.Monitor.from_netlink(ctx)
     m.filter_by(subsystem=b'hidraw')
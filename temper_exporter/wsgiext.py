@@ -1,13 +1,24 @@
 import concurrent.futures
 from contextlib import suppress
 import http
-import http.client
 import ipaddress
 import socket
 import socketserver
 import sys
 import wsgiref.simple_server
 
+from . import deadline
+from . import health
+from . import instrument
+
+# Differences between these give the thread pool's queue depth and number of
+# active workers. Each is only ever incremented, so no locking is needed.
+requests_submitted = instrument.Counter('temper_exporter_http_requests_submitted', 'Number of connections queued for the HTTP thread pool', registry=None)
+requests_started = instrument.Counter('temper_exporter_http_requests_started', 'Number of connections picked up by HTTP thread pool workers', registry=None)
+requests_finished = instrument.Counter('temper_exporter_http_requests_finished', 'Number of connections finished by HTTP thread pool workers', registry=None)
+instrument.CallbackGauge('temper_exporter_http_queue_depth', 'Number of connections waiting for an HTTP thread pool worker', lambda: requests_submitted.value() - requests_started.value())
+instrument.CallbackGauge('temper_exporter_http_active_workers', 'Number of HTTP thread pool workers handling a connection', lambda: requests_started.value() - requests_finished.value())
+
 class ThreadPoolServer(socketserver.TCPServer):
     def __init__(self, *args, max_threads=None, **kwargs):
         if sys.version_info.major <= 3 and sys.version_info.minor < 5:
@@ -17,18 +28,22 @@ class ThreadPoolServer(socketserver.TCPServer):
         super().__init__(*args, **kwargs)
 
     def process_request(self, request, client_address):
+        requests_submitted.inc()
         self.__ex.submit(self.__process_request_thread, request, client_address)
 
     def __process_request_thread(self, request, client_address):
         '''
         Taken from socketserver.ThreadingMixIn
         '''
+        requests_started.inc()
         try:
             self.finish_request(request, client_address)
             self.shutdown_request(request)
         except Exception:
             self.handle_error(request, client_address)
             self.shutdown_request(request)
+        finally:
+            requests_finished.inc()
 
     def server_close(self):
         super().server_close()
@@ -50,30 +65,77 @@ class InstantShutdownServer(socketserver.TCPServer):
             with suppress(BlockingIOError):
                 s.connect(self.socket.getsockname())
 
+def address_family(address):
+    '''
+    Returns the socket family needed to bind to an IPv6 or IPv4 address.
+    '''
+    ip = ipaddress.ip_address(address)
+    return socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+
+def prepare_listening_socket(sock, bind_v6only):
+    '''
+    Set options on a socket before it is bound.
+    '''
+    sock.setsockopt(socket.IPPROTO_IP, 15, 1) # IP_FREEBIND
+    if bind_v6only is not None and sock.family == socket.AF_INET6:
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, bind_v6only)
+
 class IPv64Server(socketserver.TCPServer):
     def __init__(self, server_address, *args, bind_v6only, **kwargs):
-        ip = ipaddress.ip_address(server_address[0])
-        self.address_family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+        self.address_family = address_family(server_address[0])
         self.__bind_v6only = bind_v6only
         super().__init__(server_address, *args, **kwargs)
 
     def server_bind(self):
-        self.socket.setsockopt(socket.IPPROTO_IP, 15, 1) # IP_FREEBIND
-        if self.__bind_v6only is not None and self.address_family == socket.AF_INET6:
-            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, self.__bind_v6only)
+        prepare_listening_socket(self.socket, self.__bind_v6only)
         super().server_bind()
 
-class HealthCheckServer(wsgiref.simple_server.WSGIServer):
-    def healthy(self):
-        c = http.client.HTTPConnection(self.server_address[0], self.server_address[1], timeout=5)
+def dispatch(routes, default):
+    '''
+    Returns a WSGI app that passes each request to the app in the routes dict
+    whose key is the request's path, or to default if there is none.
+    '''
+    def app(environ, start_response):
+        return routes.get(environ.get('PATH_INFO'), default)(environ, start_response)
+    return app
+
+def scrape_timeout(app, margin=0.5):
+    '''
+    Returns a WSGI app that passes each request to app, with a deadline (see
+    the deadline module) taken from the X-Prometheus-Scrape-Timeout-Seconds
+    header that Prometheus sends, less margin seconds to leave time for the
+    response to be rendered and sent.
+    '''
+    def wrapper(environ, start_response):
         try:
-            c.request('GET', '/')
-        except http.client.HTTPException:
-            return False
-        with c.getresponse() as r:
-            if r.status != http.HTTPStatus.OK:
-                return False
-        return True
+            timeout = float(environ['HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS'])
+        except (KeyError, ValueError):
+            return app(environ, start_response)
+        with deadline.within(max(0, timeout - margin)):
+            return app(environ, start_response)
+    return wrapper
+
+class HealthCheck:
+    '''
+    Mixin for servers. The server is healthy if its loop has woken up within
+    the last few heartbeat_intervals; pass heartbeat_interval to
+    serve_forever() as its poll_interval.
+    '''
+    heartbeat_interval = 5
+
+    def __init__(self, *args, **kwargs):
+        self.heartbeat = health.Heartbeat(6 * self.heartbeat_interval)
+        super().__init__(*args, **kwargs)
+
+    def service_actions(self):
+        self.heartbeat.beat()
+        super().service_actions()
+
+    def healthy(self):
+        return self.heartbeat.healthy()
+
+class HealthCheckServer(HealthCheck, wsgiref.simple_server.WSGIServer):
+    pass
 
 class SilentRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
     def log_request(self, code='-', message='-'):
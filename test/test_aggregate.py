@@ -0,0 +1,46 @@
+import pytest
+
+from temper_exporter import aggregate
+
+def samples(aggregator):
+    return {s.name: s.value for fam in aggregator.collect() for s in fam.samples}
+
+def test_aggregate(mocker):
+    a = aggregate.Aggregator(10)
+    a.record(100, ':phy:', 'V', [('temp', '', 20), ('humid', '', 40)])
+    a.record(102, ':phy:', 'V', [('temp', '', 25), ('humid', '', 41)])
+    a.record(105, ':phy:', 'V', [('temp', '', 18), ('humid', '', 42)])
+    a.record(111, ':phy:', 'V', [('temp', '', 99), ('humid', '', 99)])
+
+    mocker.patch('time.time', return_value=112)
+    assert samples(a) == {
+        'temper_temperature_celsius_min': 18,
+        'temper_temperature_celsius_max': 25,
+        'temper_temperature_celsius_avg': 21,
+        'temper_temperature_celsius_samples': 3,
+        'temper_humidity_rh_min': 40,
+        'temper_humidity_rh_max': 42,
+        'temper_humidity_rh_avg': 41,
+        'temper_humidity_rh_samples': 3,
+    }
+
+def test_window_completed_without_further_readings(mocker):
+    a = aggregate.Aggregator(10)
+    a.record(100, ':phy:', 'V', [('temp', '', 20)])
+
+    mocker.patch('time.time', return_value=105)
+    assert samples(a) == {}
+
+    mocker.patch('time.time', return_value=115)
+    assert samples(a)['temper_temperature_celsius_avg'] == 20
+
+    # The sensor has not been read for a whole window
+    mocker.patch('time.time', return_value=125)
+    assert samples(a) == {}
+
+def test_labels(mocker):
+    a = aggregate.Aggregator(10)
+    a.record(100, ':phy:', 'V', [('temp', 'internal', 20)])
+    mocker.patch('time.time', return_value=110)
+    fam = next(f for f in a.collect() if f.name == 'temper_temperature_celsius_max')
+    assert fam.samples[0][1] == {'name': 'internal', 'phy': ':phy:', 'version': 'V'}
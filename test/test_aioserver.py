@@ -0,0 +1,130 @@
+import functools
+import http.client
+import socket
+import threading
+import time
+
+import pytest
+
+from temper_exporter import aioserver
+
+def app(status, environ, start_response):
+    start_response(status, [('content-type', 'text/plain')])
+    return [environ['PATH_INFO'].encode('ascii'), b'\r\n']
+
+@pytest.fixture
+def server():
+    s = aioserver.AsyncServer(('127.0.0.1', 0))
+    s.set_app(functools.partial(app, '200 OK'))
+    t = threading.Thread(target=s.serve_forever, daemon=True)
+    t.start()
+    yield s
+    s.send_stop()
+    t.join(5)
+    assert not t.is_alive()
+    s.server_close()
+
+def test_keepalive(server):
+    c = http.client.HTTPConnection(*server.server_address, timeout=5)
+    for path in ['/one', '/two']:
+        c.request('GET', path)
+        r = c.getresponse()
+        assert r.status == 200
+        assert r.read() == path.encode('ascii') + b'\r\n'
+        assert r.getheader('Connection') == 'keep-alive'
+    c.close()
+
+def test_pipelining(server):
+    with socket.create_connection(server.server_address, timeout=5) as s:
+        s.sendall(b'GET /one HTTP/1.1\r\nHost: x\r\n\r\nGET /two HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        response = b''
+        while True:
+            buf = s.recv(4096)
+            if not buf:
+                break
+            response += buf
+    assert response.count(b'HTTP/1.1 200 OK') == 2
+    assert response.index(b'/one') < response.index(b'/two')
+
+def test_http10_closes(server):
+    with socket.create_connection(server.server_address, timeout=5) as s:
+        s.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            buf = s.recv(4096)
+            if not buf:
+                break
+            response += buf
+    assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert b'Connection: close\r\n' in response
+
+def test_stop_with_idle_connection(server):
+    # The fixture checks that the server stops promptly
+    c = http.client.HTTPConnection(*server.server_address, timeout=5)
+    c.request('GET', '/')
+    c.getresponse().read()
+
+def test_stop_before_serve():
+    s = aioserver.AsyncServer(('127.0.0.1', 0))
+    s.send_stop()
+    s.serve_forever()
+    s.server_close()
+
+def test_healthy(server):
+    assert server.healthy()
+    server.heartbeat.last -= 1000
+    assert not server.healthy()
+
+def test_heartbeat():
+    s = aioserver.AsyncServer(('127.0.0.1', 0))
+    s.heartbeat_interval = 0.05
+    s.heartbeat.last -= 1000
+    t = threading.Thread(target=s.serve_forever, daemon=True)
+    t.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not s.healthy():
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        s.send_stop()
+        t.join(5)
+        s.server_close()
+
+@pytest.mark.parametrize('status, logged', [
+    ('200 OK', False),
+    ('404 Not Found', True),
+])
+def test_logging(capsys, server, status, logged):
+    server.set_app(functools.partial(app, status))
+    c = http.client.HTTPConnection(*server.server_address, timeout=5)
+    c.request('GET', '/')
+    c.getresponse().read()
+    c.close()
+    out, err = capsys.readouterr()
+    if logged:
+        assert err.startswith('127.0.0.1 - - [')
+        assert err.endswith('] "GET / HTTP/1.1" 404 3\n')
+    else:
+        assert err == ''
+
+def test_bad_request(server):
+    with socket.create_connection(server.server_address, timeout=5) as s:
+        s.sendall(b'nonsense\r\n\r\n')
+        assert s.recv(4096).startswith(b'HTTP/1.1 400 Bad Request\r\n')
+
+@pytest.mark.parametrize('content_length, expected', [
+    ('-1', b'HTTP/1.1 400 Bad Request\r\n'),
+    ('x', b'HTTP/1.1 400 Bad Request\r\n'),
+    ('1000000', b'HTTP/1.1 413 Payload Too Large\r\n'),
+])
+def test_bad_content_length(server, content_length, expected):
+    with socket.create_connection(server.server_address, timeout=5) as s:
+        s.sendall('POST / HTTP/1.1\r\nHost: x\r\nContent-Length: {}\r\n\r\n'.format(content_length).encode('ascii'))
+        assert s.recv(4096).startswith(expected)
+
+def test_ipv6():
+    s = aioserver.AsyncServer(('::1', 0), bind_v6only=1)
+    assert s.socket.family == socket.AF_INET6
+    assert s.socket.getsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY) == 1
+    s.server_close()
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import socket
+import threading
+from unittest import mock
+
+import pytest
+import pyudev
+
+from temper_exporter import aiotemper
+from temper_exporter import temper
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.fixture
+def hidraw(mocker):
+    '''
+    A SOCK_SEQPACKET socket preserves message boundaries, just like a hidraw
+    node. Returns the end of the socket pair that plays the part of the
+    device.
+    '''
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    def _open(path, flags):
+        assert path == '/dev/hidrawX'
+        assert flags & os.O_NONBLOCK
+        fd = os.dup(ours.fileno())
+        os.set_blocking(fd, False)
+        return fd
+    mocker.patch('os.open', side_effect=_open)
+    yield theirs
+    ours.close()
+    theirs.close()
+
+@pytest.fixture
+def udev_device():
+    hid = mock.create_autospec(pyudev.Device)
+    hid.properties.get.return_value = 'fakephy'
+    dev = mock.create_autospec(pyudev.Device)
+    dev.device_node = '/dev/hidrawX'
+    dev.sys_path = '/sys/somewhere'
+    dev.find_parent.return_value = hid
+    return dev
+
+def respond(sock, cmd, reports):
+    assert sock.recv(16) == b'\x00' + cmd
+    for report in reports:
+        sock.send(report)
+
+@pytest.fixture(autouse=True)
+def calibration_cache(mocker):
+    mocker.patch.dict(temper.calibration_cache, clear=True)
+
+def test_open(loop, hidraw, udev_device):
+    async def go():
+        def version():
+            respond(hidraw, temper.cmd_get_version, [b'mock_tem', b'per_devi'])
+            loop.call_later(0.01, respond, hidraw, temper.cmd_get_calibration, [b'\x82\x02\x10\x00'])
+        loop.call_later(0.01, version)
+        return await aiotemper.async_usb_temper.open(udev_device, temper.temper2)
+    t = loop.run_until_complete(go())
+    assert t.version == 'mock_temper_devi'
+    assert t.phy() == 'fakephy'
+    assert t.calibration == {('temp', 'internal'): 1.0}
+    t.close()
+
+def test_read_sensor_calibrated(loop, hidraw, udev_device):
+    async def go():
+        t = aiotemper.async_usb_temper(udev_device, temper.temper2)
+        t.calibration = {('temp', 'external'): -1.0}
+        loop.call_later(0.01, respond, hidraw, temper.cmd_read_temper, [b'\x80\x04\x0a\x00\x0b\x00'])
+        try:
+            return await t.read_sensor()
+        finally:
+            t.close()
+    assert loop.run_until_complete(go()) == [('temp', 'internal', 10.0), ('temp', 'external', 10.0)]
+
+def test_read_sensor(loop, hidraw, udev_device):
+    async def go():
+        t = aiotemper.async_usb_temper(udev_device, temper.temper2)
+        loop.call_later(0.01, respond, hidraw, temper.cmd_read_temper, [b'\x80\x04\x0a\x00\x0b\x00'])
+        try:
+            return await aiotemper.read_sensors([t])
+        finally:
+            t.close()
+    assert loop.run_until_complete(go()) == [[('temp', 'internal', 10.0), ('temp', 'external', 11.0)]]
+
+def test_timeout(loop, hidraw, udev_device):
+    async def go():
+        t = aiotemper.async_usb_temper(udev_device, temper.temper2, timeout=0.01)
+        try:
+            return await aiotemper.read_sensors([t])
+        finally:
+            t.close()
+    result, = loop.run_until_complete(go())
+    assert isinstance(result, IOError)
+
+def test_stale_response_discarded(loop, hidraw, udev_device):
+    async def go():
+        t = aiotemper.async_usb_temper(udev_device, temper.temper2, timeout=0.05)
+        # A late response to an earlier command
+        hidraw.send(b'\x86\x04\x00\x00\x00\x00')
+        await asyncio.sleep(0.01)
+        loop.call_later(0.01, respond, hidraw, temper.cmd_read_temper, [b'\x80\x04\x0a\x00\x0b\x00'])
+        try:
+            return await t.send(temper.cmd_read_temper, '>hh')
+        finally:
+            t.close()
+    assert loop.run_until_complete(go()) == (2560, 2816)
+
+@pytest.fixture
+def reactor(mocker):
+    reactor = aiotemper.Reactor(timeout=1)
+    reactor.start()
+    mocker.patch.object(temper, 'reactor', reactor)
+    yield reactor
+    reactor.send_stop()
+    reactor.join()
+
+def test_reactor(reactor, hidraw, udev_device):
+    def device():
+        respond(hidraw, temper.cmd_get_version, [b'mock_tem', b'per_devi'])
+        respond(hidraw, temper.cmd_get_calibration, [b'\x82\x02\x10\x00'])
+        respond(hidraw, temper.cmd_read_temper, [b'\x80\x04\x0a\x00\x0b\x00'])
+    thread = threading.Thread(target=device)
+    thread.start()
+    try:
+        t = temper.temper2(udev_device)
+        assert t.version == 'mock_temper_devi'
+        assert t.calibration == {('temp', 'internal'): 1.0}
+        assert list(t.read_sensor()) == [('temp', 'internal', 11.0), ('temp', 'external', 11.0)]
+        assert reactor.healthy()
+    finally:
+        thread.join()
+    t.close()
+
+def test_reactor_timeout(reactor, hidraw, udev_device):
+    reactor.timeout = 0.05
+    def device():
+        respond(hidraw, temper.cmd_get_version, [b'mock_tem', b'per_devi'])
+        respond(hidraw, temper.cmd_get_calibration, [b'\x82\x02\x10\x00'])
+    thread = threading.Thread(target=device)
+    thread.start()
+    try:
+        t = temper.temper2(udev_device)
+    finally:
+        thread.join()
+    # The device never responds, but the thread reading from it isn't hung
+    with pytest.raises(IOError):
+        t.read_sensor()
+    t.close()
+
+def test_reactor_stopped(reactor, udev_device):
+    reactor.send_stop()
+    reactor.join()
+    # Rather than waiting forever for a loop that isn't running
+    with pytest.raises(IOError):
+        temper.temper2(udev_device)
@@ -0,0 +1,69 @@
+import json
+from unittest import mock
+
+import pytest
+
+from temper_exporter import devcache
+
+def udev_device(sys_path='/sys/a', serial='s1', devnum='5'):
+    usb = mock.Mock()
+    usb.properties = {'ID_SERIAL': serial, 'DEVNUM': devnum}
+    d = mock.Mock()
+    d.sys_path = sys_path
+    d.find_parent.side_effect = lambda subsystem, device_type=None: usb if device_type == b'usb_device' else None
+    return d
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('devices.json'))
+
+def test_roundtrip(path):
+    c = devcache.DeviceCache(path)
+    assert c.get(udev_device()) is None
+    c.put(udev_device(), 'VERSION', 'phy', {('temp', 'internal'): 0.5})
+
+    c = devcache.DeviceCache(path)
+    assert c.get(udev_device()) == ('VERSION', 'phy', {('temp', 'internal'): 0.5})
+    assert c.get(udev_device('/sys/b')) is None
+
+@pytest.mark.parametrize('other', [udev_device(serial='s2'), udev_device(devnum='6')])
+def test_different_device(path, other):
+    c = devcache.DeviceCache(path)
+    c.put(udev_device(), 'VERSION', 'phy', {})
+    assert c.get(other) is None
+
+def test_not_usb(path):
+    d = udev_device()
+    d.find_parent.side_effect = None
+    d.find_parent.return_value = None
+    c = devcache.DeviceCache(path)
+    c.put(d, 'VERSION', 'phy', {})
+    assert c.get(d) is None
+
+def test_unchanged_not_saved(path, mocker):
+    c = devcache.DeviceCache(path)
+    c.put(udev_device(), 'VERSION', 'phy', {})
+    replace = mocker.patch('os.replace')
+    c.put(udev_device(), 'VERSION', 'phy', {})
+    assert not replace.called
+
+@pytest.mark.parametrize('content', ['', 'nonsense', '[]', '{"format": 99, "devices": {}}'])
+def test_bad_file_ignored(path, content, capsys):
+    with open(path, 'w') as f:
+        f.write(content)
+    c = devcache.DeviceCache(path)
+    assert c.get(udev_device()) is None
+    assert 'Ignoring device cache' in capsys.readouterr().err
+    c.put(udev_device(), 'VERSION', 'phy', {})
+    with open(path) as f:
+        assert json.load(f)['format'] == devcache.FORMAT_VERSION
+
+def test_bad_entry_ignored(path):
+    c = devcache.DeviceCache(path)
+    c.put(udev_device(), 'VERSION', 'phy', {('temp', ''): 1})
+    with open(path) as f:
+        data = json.load(f)
+    data['devices']['/sys/a']['calibration'] = [['temp']]
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    assert devcache.DeviceCache(path).get(udev_device()) is None
@@ -1,8 +1,14 @@
+import threading
+import time
 from unittest import mock
 
+import prometheus_client
 import pytest
 import pyudev
 
+from temper_exporter import deadline
+from temper_exporter import exporter
+from temper_exporter import exposition
 from temper_exporter import temper
 from temper_exporter.exporter import Collector
 
@@ -25,22 +31,196 @@ def test_collection():
     ]
 
     c = Collector()
-    c._Collector__sensors = {d: t}
+    c._Collector__registry.add(d, t)
 
     fams = list(c.collect())
     assert fams[0].name == 'temper_temperature_celsius'
     assert fams[0].type == 'gauge'
-    assert fams[0].samples == [('temper_temperature_celsius', {'name': 'foo', 'phy': ':phy:', 'version': 'VERSIONSTRING___'}, 22)]
+    assert [s[:3] for s in fams[0].samples] == [('temper_temperature_celsius', {'name': 'foo', 'phy': ':phy:', 'version': 'VERSIONSTRING___'}, 22)]
     assert fams[1].name == 'temper_humidity_rh'
     assert fams[1].type == 'gauge'
-    assert fams[1].samples == [('temper_humidity_rh', {'name': 'bar', 'phy': ':phy:', 'version': 'VERSIONSTRING___'}, 45)]
+    assert [s[:3] for s in fams[1].samples] == [('temper_humidity_rh', {'name': 'bar', 'phy': ':phy:', 'version': 'VERSIONSTRING___'}, 45)]
 
     assert c.healthy()
 
+def test_collection_from_cache(mocker):
+    d = mock.create_autospec(pyudev.Device)
+
+    t = mock.create_autospec(temper.usb_temper)
+    t.phy.return_value = ':phy:'
+    t.version = 'VERSIONSTRING___'
+    t.read_sensor.return_value = [
+        ('temp', 'foo', 22),
+    ]
+
+    c = Collector(max_age=10)
+    c._Collector__registry.add(d, t)
+
+    # Nothing has been sampled yet, so the hardware is not touched
+    fams = list(c.collect())
+    assert fams[0].samples == []
+    assert not t.read_sensor.called
+
+    monotonic = mocker.patch('time.monotonic', return_value=100)
+    c.sample()
+    assert t.read_sensor.call_count == 1
+
+    monotonic.return_value = 110
+    fams = list(c.collect())
+    assert [s[:3] for s in fams[0].samples] == [('temper_temperature_celsius', {'name': 'foo', 'phy': ':phy:', 'version': 'VERSIONSTRING___'}, 22)]
+    assert t.read_sensor.call_count == 1
+
+def test_collection_drops_stale_readings(mocker):
+    d = mock.create_autospec(pyudev.Device)
+
+    t = mock.create_autospec(temper.usb_temper)
+    t.version = 'VERSIONSTRING___'
+    t.read_sensor.return_value = [
+        ('temp', 'foo', 22),
+    ]
+
+    c = Collector(max_age=10)
+    c._Collector__registry.add(d, t)
+
+    monotonic = mocker.patch('time.monotonic', return_value=100)
+    c.sample()
+
+    monotonic.return_value = 111
+    fams = list(c.collect())
+    assert fams[0].samples == []
+
+def test_slow_device_does_not_hold_up_others():
+    release = threading.Event()
+
+    d1 = mock.create_autospec(pyudev.Device, name='d1')
+    t1 = mock.create_autospec(temper.usb_temper, name='t1')
+    t1.phy.return_value = ':phy1:'
+    t1.version = 'VERSIONSTRING___'
+    def wedged():
+        release.wait(5)
+        return [('temp', '', 10)]
+    t1.read_sensor.side_effect = wedged
+
+    d2 = mock.create_autospec(pyudev.Device, name='d2')
+    t2 = mock.create_autospec(temper.usb_temper, name='t2')
+    t2.phy.return_value = ':phy2:'
+    t2.version = 'VERSIONSTRING___'
+    t2.read_sensor.return_value = [('temp', '', 20)]
+
+    c = Collector(read_timeout=0.1)
+    c._Collector__registry.add(d1, t1)
+    c._Collector__registry.add(d2, t2)
+
+    try:
+        fams = list(c.collect())
+    finally:
+        release.set()
+
+    assert [s.value for s in fams[0].samples] == [20]
+    assert [s[:3] for s in fams[2].samples] == [('temper_read_timeouts_total', {'phy': ':phy1:', 'version': 'VERSIONSTRING___'}, 1)]
+    assert c.healthy()
+
+def test_sample_subset():
+    d1 = mock.create_autospec(pyudev.Device, name='d1')
+    t1 = mock.create_autospec(temper.usb_temper, name='t1')
+    t1.version = 'VERSIONSTRING___'
+    t1.read_sensor.return_value = [('temp', '', 10)]
+    d2 = mock.create_autospec(pyudev.Device, name='d2')
+    t2 = mock.create_autospec(temper.usb_temper, name='t2')
+    t2.version = 'VERSIONSTRING___'
+
+    c = Collector(max_age=10)
+    c._Collector__registry.add(d1, t1)
+    c._Collector__registry.add(d2, t2)
+
+    assert c.sample([(d1, t1)]) == {d1: True}
+    assert not t2.read_sensor.called
+
+def test_submit():
+    d = mock.create_autospec(pyudev.Device)
+    t = mock.create_autospec(temper.usb_temper)
+    t.phy.return_value = ':phy:'
+    t.version = 'VERSIONSTRING___'
+    t.read_sensor.return_value = [('temp', '', 10)]
+
+    c = Collector(max_age=10)
+    c._Collector__registry.add(d, t)
+    assert c.submit(d, t).result(5)
+    assert [s.value for s in next(c.collect()).samples] == [10]
+
+    c.count_timeout(d)
+    fams = {f.name: f for f in c.collect()}
+    assert [s.value for s in fams['temper_read_timeouts'].samples] == [1]
+
+def test_wedged_device_not_queued():
+    d1 = mock.create_autospec(pyudev.Device)
+    t1 = mock.create_autospec(temper.usb_temper)
+    t1.version = 'VERSIONSTRING___'
+    release = threading.Event()
+    def wedged():
+        release.wait(5)
+        return []
+    t1.read_sensor.side_effect = wedged
+
+    d2 = mock.create_autospec(pyudev.Device)
+    t2 = mock.create_autospec(temper.usb_temper)
+    t2.version = 'VERSIONSTRING___'
+    t2.read_sensor.side_effect = wedged
+
+    c = Collector(read_threads=1, read_timeout=0.1)
+    c._Collector__registry.add(d1, t1)
+    c._Collector__registry.add(d2, t2)
+    try:
+        c.sample()
+        assert c.submit(d1, t1) is c.submit(d1, t1)
+        for i in range(2):
+            c.sample()
+        # Further reads of the wedged device weren't queued up behind it
+        assert t1.read_sensor.call_count == 1
+    finally:
+        release.set()
+    # The reads of the other device that were queued behind it were
+    # cancelled
+    c._Collector__reader.submit(lambda: None).result(5)
+    assert t2.read_sensor.call_count == 0
+
+def test_wedged_device_fails():
+    d = mock.create_autospec(pyudev.Device)
+    t1 = mock.create_autospec(temper.usb_temper)
+    t1.version = 'VERSIONSTRING___'
+    release = threading.Event()
+    def wedged():
+        release.wait(5)
+        return []
+    t1.read_sensor.side_effect = wedged
+    t2 = mock.create_autospec(temper.usb_temper)
+    t2.version = 'VERSIONSTRING___'
+    t2.read_sensor.return_value = [('temp', '', 20)]
+
+    c = Collector(read_timeout=0.1, retry_interval=0)
+    c.class_for_device = mock.Mock(return_value=mock.Mock(return_value=t2))
+    c._Collector__registry.add(d, t1)
+    try:
+        # The first scrape may give up before the read has been going for
+        # read_timeout seconds
+        for i in range(2):
+            c.sample()
+        assert c.devices() == []
+        assert not c.healthy()
+        c.recover()
+        wait_for(lambda: c.devices() == [(d, t2)])
+        assert c.sample() == {d: True}
+        assert not t1.close.called
+    finally:
+        release.set()
+    # Closed once the read gives up
+    wait_for(lambda: t1.close.called)
+
 def test_coldplug_scan():
     d = mock.create_autospec(pyudev.Device, action=None)
 
     t = mock.create_autospec(temper.usb_temper)
+    t.version = 'VERSIONSTRING___'
     T = mock.create_autospec(temper.usb_temper, return_value=t)
 
     c = Collector()
@@ -48,7 +228,7 @@ def test_coldplug_scan():
 
     c.coldplug_scan([d])
 
-    assert c._Collector__sensors == {d: t}
+    assert c.devices() == [(d, t)]
     assert c.healthy()
 
 def test_open_failure():
@@ -66,6 +246,7 @@ def test_read_failure():
     d = mock.create_autospec(pyudev.Device)
 
     t = mock.create_autospec(temper.usb_temper)
+    t.version = 'VERSIONSTRING___'
     def simulate_read_failure():
         raise IOError
         yield
@@ -73,18 +254,121 @@ def test_read_failure():
     t.close.side_effect = IOError
 
     c = Collector()
-    c._Collector__sensors = {d: t}
+    c._Collector__registry.add(d, t)
 
     for fam in c.collect():
         pass
 
-    assert c._Collector__sensors == {}
+    assert c.devices() == []
+    assert not c.healthy()
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_recovery_after_read_failure():
+    d = mock.create_autospec(pyudev.Device)
+
+    t1 = mock.create_autospec(temper.usb_temper, name='t1')
+    t1.version = 'VERSIONSTRING___'
+    t1.phy.return_value = ':phy:'
+    t1.read_sensor.side_effect = IOError
+
+    t2 = mock.create_autospec(temper.usb_temper, name='t2')
+    t2.version = 'VERSIONSTRING___'
+    t2.phy.return_value = ':phy:'
+    t2.read_sensor.return_value = [('temp', '', 20)]
+
+    c = Collector(retry_interval=0, unhealthy_after=2)
+    c.class_for_device = mock.Mock(return_value=mock.Mock(return_value=t2))
+    c._Collector__registry.add(d, t1)
+
+    fams = {fam.name: fam for fam in c.collect()}
+    assert t1.close.called
+    assert [s[:3] for s in fams['temper_device_up'].samples] == [('temper_device_up', {'phy': ':phy:', 'version': 'VERSIONSTRING___'}, 0)]
+    assert [s[:3] for s in fams['temper_device_consecutive_failures'].samples] == [('temper_device_consecutive_failures', {'phy': ':phy:', 'version': 'VERSIONSTRING___'}, 1)]
+    assert c.healthy()
+
+    c.recover()
+    wait_for(lambda: c.devices() == [(d, t2)])
+
+    fams = {fam.name: fam for fam in c.collect()}
+    assert [s.value for s in fams['temper_temperature_celsius'].samples] == [20]
+    assert [s[:3] for s in fams['temper_device_up'].samples] == [('temper_device_up', {'phy': ':phy:', 'version': 'VERSIONSTRING___'}, 1)]
+    assert fams['temper_device_consecutive_failures'].samples == []
+    assert c.healthy()
+
+def test_unhealthy_after_repeated_failures():
+    d = mock.create_autospec(pyudev.Device, action=None)
+
+    c = Collector(retry_interval=0, unhealthy_after=3)
+    c.class_for_device = mock.Mock(return_value=mock.Mock(side_effect=IOError))
+
+    c.coldplug_scan([d])
+    for i in range(2):
+        assert c.healthy()
+        c.recover()
+        wait_for(lambda: not c._Collector__failed[d].retrying)
+    assert c._Collector__failed[d].count == 3
+    assert not c.healthy()
+
+def test_unhealthy_if_reopened_device_never_reads():
+    d = mock.create_autospec(pyudev.Device)
+
+    def T(device):
+        t = mock.create_autospec(temper.usb_temper)
+        t.version = 'VERSIONSTRING___'
+        t.phy.return_value = ':phy:'
+        t.read_sensor.side_effect = IOError
+        return t
+
+    c = Collector(retry_interval=0, unhealthy_after=3)
+    c.class_for_device = mock.Mock(return_value=T)
+    c._Collector__registry.add(d, T(d))
+
+    for i in range(3):
+        assert c.healthy()
+        fams = {fam.name: fam for fam in c.collect()}
+        assert [s.value for s in fams['temper_device_consecutive_failures'].samples] == [i + 1]
+        c.recover()
+        wait_for(lambda: len(c.devices()) == 1)
+    fams = {fam.name: fam for fam in c.collect()}
+    assert c._Collector__failed[d].count == 4
+    assert not c.healthy()
+
+def test_recovery_backs_off(mocker):
+    d = mock.create_autospec(pyudev.Device, action=None)
+
+    monotonic = mocker.patch('time.monotonic', return_value=100)
+    c = Collector(retry_interval=1, max_retry_interval=3, unhealthy_after=None)
+    c.class_for_device = mock.Mock(return_value=mock.Mock(side_effect=IOError))
+
+    c.coldplug_scan([d])
+    assert c._Collector__failed[d].retry_at == 101
+    c._Collector__failed[d].count = 5
+    c.coldplug_scan([d])
+    assert c._Collector__failed[d].retry_at == 103
+    assert c.healthy()
+
+def test_remove_failed_device():
+    d = mock.create_autospec(pyudev.Device, action=None)
+    c = Collector(retry_interval=0)
+    c.class_for_device = mock.Mock(return_value=mock.Mock(side_effect=IOError))
+    c.coldplug_scan([d])
     assert not c.healthy()
 
+    d.action = 'remove'
+    c.handle_device_event(d)
+    assert c._Collector__failed == {}
+    assert c.healthy()
+
 def test_add_device():
     d1 = mock.create_autospec(pyudev.Device, action='add')
 
     t = mock.create_autospec(temper.usb_temper)
+    t.version = 'VERSIONSTRING___'
 
     T = mock.Mock(return_value=t)
 
@@ -92,18 +376,20 @@ def test_add_device():
     c.class_for_device = mock.create_autospec(c.class_for_device, return_value=T)
 
     c.handle_device_event(d1)
-    assert c._Collector__sensors == {d1: t}
+    assert c.devices() == [(d1, t)]
 
 def test_add_duplicate_device():
     d1 = mock.create_autospec(pyudev.Device, name='d1', device_path='/sys/foo')
     d1.__hash__.return_value = hash(d1.device_path)
 
     t1 = mock.create_autospec(temper.usb_temper, name='t1')
+    t1.version = 'VERSIONSTRING___'
     t2 = mock.create_autospec(temper.usb_temper, name='t2')
+    t2.version = 'VERSIONSTRING___'
 
     c = Collector()
     c.class_for_device = mock.create_autospec(c.class_for_device)
-    c._Collector__sensors = {d1: t1}
+    c._Collector__registry.add(d1, t1)
 
     d2 = mock.create_autospec(pyudev.Device, name='d2', action='add', device_path='/sys/foo')
     d2.__hash__.return_value = hash(d2.device_path)
@@ -118,17 +404,18 @@ def test_add_duplicate_device():
     # The collector should not have tried to open d2
     assert not c.class_for_device.called
     # The original usb_temper should still be in the dict
-    assert len(c._Collector__sensors) == 1
-    assert c._Collector__sensors.popitem()[1] is t1
+    assert len(c.devices()) == 1
+    assert c.devices()[0][1] is t1
 
 def test_remove_device():
     d1 = mock.create_autospec(pyudev.Device, name='d1', device_path='/sys/foo')
     d1.__hash__.return_value = hash(d1.device_path)
 
     t = mock.create_autospec(temper.usb_temper, name='t1')
+    t.version = 'VERSIONSTRING___'
 
     c = Collector()
-    c._Collector__sensors = {d1: t}
+    c._Collector__registry.add(d1, t)
 
     d2 = mock.create_autospec(pyudev.Device, name='d2', action='remove', device_path='/sys/foo')
     d2.__hash__.return_value = hash(d2.device_path)
@@ -140,4 +427,290 @@ def test_remove_device():
 
     c.handle_device_event(d2)
 
-    assert c._Collector__sensors == {}
+    assert c.devices() == []
+    assert next(c.collect()).samples == []
+
+def test_listener(mocker):
+    d = mock.create_autospec(pyudev.Device)
+
+    t = mock.create_autospec(temper.usb_temper)
+    t.phy.return_value = ':phy:'
+    t.version = 'VERSIONSTRING___'
+    t.read_sensor.return_value = [('temp', '', 22)]
+
+    c = Collector(max_age=10)
+    c._Collector__registry.add(d, t)
+    listener = mock.Mock()
+    c.add_listener(listener)
+
+    mocker.patch('time.time', return_value=1000)
+    c.sample()
+    listener.assert_called_once_with(1000, ':phy:', 'VERSIONSTRING___', [('temp', '', 22)])
+
+def test_collect_does_not_look_up_labels():
+    d = mock.create_autospec(pyudev.Device)
+
+    t = mock.create_autospec(temper.usb_temper)
+    t.phy.return_value = ':phy:'
+    t.version = 'VERSIONSTRING___'
+    t.read_sensor.return_value = [('temp', 'foo', 22)]
+
+    c = Collector()
+    c._Collector__registry.add(d, t)
+    for i in range(3):
+        list(c.collect())
+    # Only when the device was added
+    assert t.phy.call_count == 1
+
+def test_exposition_prefixes():
+    d = mock.create_autospec(pyudev.Device)
+
+    t = mock.create_autospec(temper.usb_temper)
+    t.phy.return_value = ':phy:'
+    t.version = 'VERSIONSTRING___'
+    t.read_sensor.return_value = [('temp', 'foo', 22), ('humid', 'bar', 45)]
+
+    c = Collector()
+    c._Collector__registry.add(d, t)
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(c)
+    # The precomputed prefixes must give the same result as formatting the
+    # labels.
+    assert exposition.Writer().render(registry) == prometheus_client.generate_latest(registry)
+
+def test_time_to_first_reading(mocker):
+    d = mock.create_autospec(pyudev.Device, action='add')
+
+    t = mock.create_autospec(temper.usb_temper)
+    t.phy.return_value = ':phy:'
+    t.version = 'VERSIONSTRING___'
+    t.read_sensor.return_value = [('temp', '', 22)]
+
+    c = Collector()
+    c.class_for_device = mock.create_autospec(c.class_for_device, return_value=mock.Mock(return_value=t))
+    c.handle_device_event(d, since=100)
+
+    mocker.patch('time.monotonic', return_value=107)
+    c.sample()
+    mocker.patch('time.monotonic', return_value=200)
+    c.sample()
+    fam = [f for f in c.collect() if f.name == 'temper_device_time_to_first_reading_seconds'][0]
+    assert [s[1:3] for s in fam.samples] == [({'phy': ':phy:', 'version': 'VERSIONSTRING___'}, 7)]
+
+def test_coldplug_parallel():
+    devices = [mock.create_autospec(pyudev.Device, action=None) for i in range(4)]
+    barrier = threading.Barrier(len(devices), timeout=5)
+
+    def T(device):
+        # Fails unless all the devices are opened at once
+        barrier.wait()
+        t = mock.create_autospec(temper.usb_temper)
+        t.version = 'VERSIONSTRING___'
+        return t
+
+    c = Collector(read_threads=4)
+    c.class_for_device = mock.Mock(return_value=T)
+    c.coldplug_scan(devices)
+    assert {d for d, t in c.devices()} == set(devices)
+
+def test_coldplug_timeout():
+    release = threading.Event()
+    d1 = mock.create_autospec(pyudev.Device, action=None, name='d1')
+    d2 = mock.create_autospec(pyudev.Device, action=None, name='d2')
+    t2 = mock.create_autospec(temper.usb_temper)
+    t2.phy.return_value = ':phy2:'
+    t2.version = 'VERSIONSTRING___'
+
+    def T(device):
+        if device is d1:
+            release.wait(5)
+        return t2
+
+    c = Collector()
+    c.class_for_device = mock.Mock(return_value=T)
+    start = time.monotonic()
+    try:
+        c.coldplug_scan([d1, d2], timeout=0.1)
+        assert time.monotonic() - start < 1
+        assert c.devices() == [(d2, t2)]
+    finally:
+        release.set()
+
+def test_add_race():
+    d = mock.create_autospec(pyudev.Device, action='add')
+    t1 = mock.create_autospec(temper.usb_temper)
+    t1.version = 'VERSIONSTRING___'
+    t2 = mock.create_autospec(temper.usb_temper)
+    t2.version = 'VERSIONSTRING___'
+
+    c = Collector()
+    def T(device):
+        if device is d and not c.devices():
+            # Another thread adds the device while we're opening it
+            c.class_for_device = mock.Mock(return_value=mock.Mock(return_value=t2))
+            c.handle_device_event(d)
+        return t1
+    c.class_for_device = mock.Mock(return_value=T)
+    c.handle_device_event(d)
+    assert c.devices() == [(d, t2)]
+    assert t1.close.called
+
+def test_open_failure_race():
+    d = mock.create_autospec(pyudev.Device, action='add')
+    t = mock.create_autospec(temper.usb_temper)
+    t.version = 'VERSIONSTRING___'
+
+    c = Collector()
+    def T(device):
+        # Another thread opens the device while our attempt is failing
+        c.class_for_device = mock.Mock(return_value=mock.Mock(return_value=t))
+        c.handle_device_event(d)
+        raise IOError
+    c.class_for_device = mock.Mock(return_value=T)
+    c.handle_device_event(d)
+    assert c.devices() == [(d, t)]
+    assert c._Collector__failed == {}
+    assert c.healthy()
+
+def test_reopen_race():
+    d = mock.create_autospec(pyudev.Device, action='add')
+    t1 = mock.create_autospec(temper.usb_temper)
+    t1.version = 'VERSIONSTRING___'
+    t2 = mock.create_autospec(temper.usb_temper)
+    t2.version = 'VERSIONSTRING___'
+
+    c = Collector(retry_interval=0)
+    c.class_for_device = mock.Mock(return_value=mock.Mock(side_effect=IOError))
+    c.handle_device_event(d)
+    # The device was opened by another thread after it failed
+    c._Collector__registry.add(d, t1)
+    c.class_for_device = mock.Mock(return_value=mock.Mock(return_value=t2))
+    c.recover()
+    wait_for(lambda: t2.close.called)
+    assert c.devices() == [(d, t1)]
+    assert not t1.close.called
+    assert c._Collector__failed == {}
+
+def test_concurrent_scrapes_coalesced():
+    d = mock.create_autospec(pyudev.Device)
+
+    started = threading.Event()
+    release = threading.Event()
+    def read_sensor():
+        started.set()
+        release.wait(5)
+        return [('temp', '', 22)]
+
+    t = mock.create_autospec(temper.usb_temper)
+    t.phy.return_value = ':phy:'
+    t.version = 'VERSIONSTRING___'
+    t.read_sensor.side_effect = read_sensor
+
+    c = Collector()
+    c._Collector__registry.add(d, t)
+    coalesced = exporter.scrapes_coalesced.value()
+
+    results = []
+    def scrape():
+        results.append(list(c.collect())[0].samples)
+    scrapers = [threading.Thread(target=scrape) for i in range(3)]
+    scrapers[0].start()
+    assert started.wait(5)
+    for s in scrapers[1:]:
+        s.start()
+    while exporter.scrapes_coalesced.value() < coalesced + 2:
+        time.sleep(0.01)
+    release.set()
+    for s in scrapers:
+        s.join()
+
+    assert t.read_sensor.call_count == 1
+    assert [[s.value for s in samples] for samples in results] == [[22]] * 3
+
+def test_coalesce_window(mocker):
+    d = mock.create_autospec(pyudev.Device)
+    t = mock.create_autospec(temper.usb_temper)
+    t.phy.return_value = ':phy:'
+    t.version = 'VERSIONSTRING___'
+    t.read_sensor.return_value = [('temp', '', 22)]
+
+    c = Collector(coalesce_window=10)
+    c._Collector__registry.add(d, t)
+    monotonic = mocker.patch('time.monotonic', return_value=100)
+    list(c.collect())
+    monotonic.return_value = 109
+    list(c.collect())
+    assert t.read_sensor.call_count == 1
+    monotonic.return_value = 111
+    list(c.collect())
+    assert t.read_sensor.call_count == 2
+
+def test_scrape_deadline():
+    release = threading.Event()
+
+    d1 = mock.create_autospec(pyudev.Device, name='d1')
+    t1 = mock.create_autospec(temper.usb_temper, name='t1')
+    t1.phy.return_value = ':phy1:'
+    t1.version = 'VERSIONSTRING___'
+    t1.read_sensor.return_value = [('temp', '', 10)]
+
+    d2 = mock.create_autospec(pyudev.Device, name='d2')
+    t2 = mock.create_autospec(temper.usb_temper, name='t2')
+    t2.phy.return_value = ':phy2:'
+    t2.version = 'VERSIONSTRING___'
+    t2.read_sensor.return_value = [('temp', '', 20)]
+
+    c = Collector(read_timeout=5)
+    c._Collector__registry.add(d1, t1)
+    c._Collector__registry.add(d2, t2)
+    # Both devices have been read before...
+    list(c.collect())
+
+    # ... but now one of them is slow
+    def wedged():
+        release.wait(5)
+        return [('temp', '', 11)]
+    t1.read_sensor.side_effect = wedged
+    start = time.monotonic()
+    try:
+        with deadline.within(0.1):
+            fams = {f.name: f for f in c.collect()}
+    finally:
+        release.set()
+
+    assert time.monotonic() - start < 1
+    assert [s.value for s in fams['temper_temperature_celsius'].samples] == [20]
+    assert {s.labels['phy']: s.value for s in fams['temper_device_stale'].samples} == {':phy1:': 1, ':phy2:': 0}
+
+def test_coalesced_scrape_deadline():
+    started = threading.Event()
+    release = threading.Event()
+
+    d = mock.create_autospec(pyudev.Device)
+    t = mock.create_autospec(temper.usb_temper)
+    t.phy.return_value = ':phy:'
+    t.version = 'VERSIONSTRING___'
+    t.read_sensor.return_value = [('temp', '', 10)]
+
+    c = Collector(read_timeout=5)
+    c._Collector__registry.add(d, t)
+    list(c.collect())
+
+    def wedged():
+        started.set()
+        release.wait(5)
+        return [('temp', '', 11)]
+    t.read_sensor.side_effect = wedged
+    leader = threading.Thread(target=lambda: list(c.collect()))
+    leader.start()
+    try:
+        assert started.wait(5)
+        with deadline.within(0.1):
+            fams = {f.name: f for f in c.collect()}
+    finally:
+        release.set()
+        leader.join()
+
+    # The previous reading must not be passed off as current
+    assert fams['temper_temperature_celsius'].samples == []
+    assert [s.value for s in fams['temper_device_stale'].samples] == [1]
@@ -0,0 +1,138 @@
+import gzip
+from unittest import mock
+from wsgiref import util
+
+import prometheus_client
+import prometheus_client.core as core
+import pytest
+
+from temper_exporter import exposition
+
+class CountingCollector:
+    def __init__(self):
+        self.count = 0
+        self.gen = 0
+
+    def generation(self):
+        return self.gen
+
+    def collect(self):
+        self.count += 1
+        g = core.GaugeMetricFamily('test_gauge', 'Help', labels=['l'])
+        g.add_metric(['x'], self.gen)
+        yield g
+
+@pytest.fixture
+def collector():
+    return CountingCollector()
+
+@pytest.fixture
+def app(collector):
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(collector)
+    return exposition.CachedExposition(collector, registry)
+
+def request(app, **headers):
+    environ = {'HTTP_' + k.upper(): v for k, v in headers.items()}
+    util.setup_testing_defaults(environ)
+    start_response = mock.Mock()
+    body = b''.join(app(environ, start_response))
+    status, response_headers = start_response.call_args[0]
+    return status, dict(response_headers), body
+
+def test_rendered_once_per_generation(app, collector):
+    status, headers, body = request(app)
+    assert status == '200 OK'
+    assert b'test_gauge{l="x"} 0.0' in body
+    count = collector.count
+    assert request(app)[2] == body
+    assert collector.count == count
+
+    collector.gen += 1
+    status, headers, body = request(app)
+    assert b'test_gauge{l="x"} 1.0' in body
+    assert collector.count == count + 1
+
+def test_gzip(app):
+    status, headers, body = request(app, accept_encoding='gzip')
+    assert headers['Content-Encoding'] == 'gzip'
+    assert b'test_gauge' in gzip.decompress(body)
+    assert headers['Content-Length'] == str(len(body))
+
+def test_not_modified(app, collector):
+    status, headers, body = request(app)
+    etag = headers['ETag']
+
+    status, headers, body = request(app, if_none_match=etag)
+    assert status == '304 Not Modified'
+    assert body == b''
+
+    collector.gen += 1
+    status, headers, body = request(app, if_none_match=etag)
+    assert status == '200 OK'
+    assert headers['ETag'] != etag
+
+class FamiliesCollector:
+    def __init__(self):
+        self.families = []
+
+    def collect(self):
+        return self.families
+
+@pytest.fixture
+def families():
+    registry = prometheus_client.CollectorRegistry()
+    c = FamiliesCollector()
+    registry.register(c)
+
+    g = exposition.GaugeMetricFamily('test_gauge', 'Help with \\ and\nnewline', labels=['b', 'a'])
+    g.add_metric(['x', 'y'], 1.5)
+    g.add_metric(['quote "', 'back\\slash\nnewline'], float('inf'))
+    g.add_metric(['p', 'q'], 2, prefix=exposition.sample_prefix('test_gauge', [('a', 'q'), ('b', 'p')]))
+    c.families.append(g)
+
+    counter = exposition.CounterMetricFamily('test_counter', 'Help', labels=['l'])
+    counter.add_metric(['x'], 3, created=1234.5, prefix=exposition.sample_prefix('test_counter_total', [('l', 'x')]))
+    counter.add_metric(['y'], 4, timestamp=1234.5)
+    c.families.append(counter)
+
+    c.families.append(core.HistogramMetricFamily('test_histogram', 'Help', buckets=[('1', 1), ('+Inf', 2)], sum_value=3))
+    c.families.append(core.InfoMetricFamily('test_info', 'Help', value={'a': 'b'}))
+    c.families.append(core.UnknownMetricFamily('test_unknown', 'Help', value=1e20))
+    return registry, c
+
+def test_writer_matches_generate_latest(families):
+    registry, c = families
+    assert exposition.Writer().render(registry) == prometheus_client.generate_latest(registry)
+
+def test_writer_reuses_buffer(families):
+    registry, c = families
+    w = exposition.Writer()
+    w.render(registry)
+    del c.families[1:]
+    assert w.render(registry) == prometheus_client.generate_latest(registry)
+
+def test_writer_uses_prefix():
+    registry = prometheus_client.CollectorRegistry()
+    c = FamiliesCollector()
+    registry.register(c)
+    g = exposition.GaugeMetricFamily('test_gauge', 'Help', labels=['l'])
+    g.add_metric(['x'], 1, prefix=b'precomputed ')
+    c.families.append(g)
+    assert b'\nprecomputed 1.0\n' in exposition.Writer().render(registry)
+
+def test_writer_prefix_cache_bounded(families):
+    registry, c = families
+    w = exposition.Writer(max_prefixes=2)
+    assert w.render(registry) == w.render(registry) == prometheus_client.generate_latest(registry)
+
+def test_exposition(families):
+    registry, c = families
+    app = exposition.Exposition(registry)
+    status, headers, body = request(app)
+    assert status == '200 OK'
+    assert body == prometheus_client.generate_latest(registry)
+    assert headers['Content-Length'] == str(len(body))
+
+    status, headers, body = request(app, accept_encoding='gzip')
+    assert gzip.decompress(body) == prometheus_client.generate_latest(registry)
@@ -0,0 +1,189 @@
+import asyncio
+import gzip
+import http.server
+import socket
+import socketserver
+import threading
+import time
+
+import prometheus_client
+import pytest
+
+from temper_exporter import gateway
+
+def read_response(data):
+    loop = asyncio.new_event_loop()
+    try:
+        async def go():
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return await gateway.read_response(reader)
+        return loop.run_until_complete(go())
+    finally:
+        loop.close()
+
+def test_read_response_content_length():
+    assert read_response(b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\nX-Foo: bar\r\n\r\nhelloextra') == (200, {'content-length': '5', 'x-foo': 'bar'}, b'hello', True)
+
+def test_read_response_chunked():
+    status, headers, body, keep_alive = read_response(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n6;x=y\r\n world\r\n0\r\n\r\n')
+    assert body == b'hello world'
+    assert keep_alive
+
+def test_read_response_until_eof():
+    assert read_response(b'HTTP/1.0 200 OK\r\n\r\nhello') == (200, {}, b'hello', False)
+
+def test_read_response_not_modified():
+    assert read_response(b'HTTP/1.1 304 Not Modified\r\nETag: "x"\r\n\r\n')[2] == b''
+
+def test_upstream():
+    u = gateway.upstream('http://pi1:9204/metrics')
+    assert (u.host, u.port, u.path, u.instance) == ('pi1', 9204, '/metrics', 'pi1:9204')
+    u = gateway.upstream('site-a=http://192.0.2.1')
+    assert (u.host, u.port, u.path, u.instance) == ('192.0.2.1', 80, '/', 'site-a')
+    with pytest.raises(ValueError):
+        gateway.upstream('https://pi1/')
+
+class Exporter(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, body):
+        super().__init__(('127.0.0.1', 0), ExporterHandler)
+        self.body = body
+        self.encode = gzip.compress
+        self.requests = []
+        self.connections = set()
+
+    def url(self):
+        return 'http://127.0.0.1:{}/metrics'.format(self.server_address[1])
+
+class ExporterHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        self.server.connections.add(self.client_address)
+        if self.headers.get('If-None-Match') == '"1"':
+            self.send_response(304)
+            self.send_header('ETag', '"1"')
+            self.end_headers()
+            return
+        body = self.server.encode(self.server.body)
+        self.send_response(200)
+        self.send_header('ETag', '"1"')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def exporters():
+    servers = []
+    def make(body):
+        server = Exporter(body)
+        threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.1}, daemon=True).start()
+        servers.append(server)
+        return server
+    yield make
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+BODY = b'''# HELP temper_temperature_celsius Temperature reading
+# TYPE temper_temperature_celsius gauge
+temper_temperature_celsius{name="",phy="p",version="v"} 21.5
+# HELP temper_read_timeouts_total Number of times a device failed to respond in time
+# TYPE temper_read_timeouts_total counter
+temper_read_timeouts_total{phy="p",version="v"} 2.0
+'''
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_generation(g, n):
+    deadline = time.monotonic() + 5
+    while g.generation() < n:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_gateway(exporters):
+    a = exporters(BODY)
+    b = exporters(BODY.replace(b'21.5', b'19.0'))
+    dead = gateway.Upstream('http://127.0.0.1:{}/'.format(unused_port()), 'dead')
+    g = gateway.Gateway([gateway.Upstream(a.url(), 'a'), gateway.Upstream(b.url(), 'b'), dead], interval=0.05, timeout=1)
+    g.start()
+    try:
+        wait_for_generation(g, 3)
+    finally:
+        g.send_stop()
+        g.join()
+
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(g)
+    assert registry.get_sample_value('temper_temperature_celsius', {'name': '', 'phy': 'p', 'version': 'v', 'instance': 'a'}) == 21.5
+    assert registry.get_sample_value('temper_temperature_celsius', {'name': '', 'phy': 'p', 'version': 'v', 'instance': 'b'}) == 19.0
+    assert registry.get_sample_value('temper_read_timeouts_total', {'phy': 'p', 'version': 'v', 'instance': 'a'}) == 2.0
+    assert registry.get_sample_value('temper_gateway_upstream_up', {'instance': 'a'}) == 1
+    assert registry.get_sample_value('temper_gateway_upstream_up', {'instance': 'dead'}) == 0
+
+    # Each family appears once
+    text = prometheus_client.generate_latest(registry).decode()
+    assert text.count('# TYPE temper_temperature_celsius gauge') == 1
+
+    # Unchanged metrics weren't sent again, and the connection was reused
+    assert len(a.requests) >= 2
+    assert a.requests[1]['If-None-Match'] == '"1"'
+    assert len(a.connections) == 1
+
+def test_corrupt_upstream(exporters):
+    a = exporters(BODY)
+    truncated = exporters(BODY)
+    truncated.encode = lambda body: gzip.compress(body)[:20]
+    corrupt = exporters(BODY)
+    corrupt.encode = lambda body: gzip.compress(body)[:10] + b'\xff' * 20
+    g = gateway.Gateway([gateway.Upstream(a.url(), 'a'), gateway.Upstream(truncated.url(), 'truncated'), gateway.Upstream(corrupt.url(), 'corrupt')], interval=0.05, timeout=1)
+    g.start()
+    try:
+        # The thread keeps scraping
+        wait_for_generation(g, 3)
+    finally:
+        g.send_stop()
+        g.join()
+
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(g)
+    assert registry.get_sample_value('temper_gateway_upstream_up', {'instance': 'a'}) == 1
+    assert registry.get_sample_value('temper_gateway_upstream_up', {'instance': 'truncated'}) == 0
+    assert registry.get_sample_value('temper_gateway_upstream_up', {'instance': 'corrupt'}) == 0
+
+def test_stop_before_start():
+    g = gateway.Gateway([gateway.Upstream('http://127.0.0.1:{}/'.format(unused_port()), 'dead')], interval=60)
+    g.send_stop()
+    g.start()
+    g.join(5)
+    assert not g.is_alive()
+    # Nor does stopping a thread that has exited block
+    g.send_stop()
+
+def test_stale_upstream_dropped(exporters, mocker):
+    a = exporters(BODY)
+    u = gateway.Upstream(a.url(), 'a')
+    g = gateway.Gateway([u], interval=60, timeout=1, max_age=10)
+    g.start()
+    try:
+        wait_for_generation(g, 1)
+    finally:
+        g.send_stop()
+        g.join()
+
+    mocker.patch('time.monotonic', return_value=u.fetched_at + 11)
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(g)
+    assert registry.get_sample_value('temper_temperature_celsius', {'name': '', 'phy': 'p', 'version': 'v', 'instance': 'a'}) is None
+    assert registry.get_sample_value('temper_gateway_upstream_age_seconds', {'instance': 'a'}) == 11
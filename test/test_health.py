@@ -0,0 +1,92 @@
+import os
+import socket
+import threading
+from unittest import mock
+
+import pytest
+
+from temper_exporter import health
+
+def test_heartbeat(mocker):
+    monotonic = mocker.patch('time.monotonic', return_value=100)
+    h = health.Heartbeat(10)
+    monotonic.return_value = 110
+    assert h.healthy()
+    monotonic.return_value = 111
+    assert not h.healthy()
+    h.beat()
+    assert h.age() == 0
+    assert h.healthy()
+
+def component(healthy):
+    c = mock.Mock()
+    c.healthy.return_value = healthy
+    return c
+
+def call(app, method='GET'):
+    start_response = mock.Mock()
+    body = b''.join(app({'REQUEST_METHOD': method}, start_response))
+    status, headers = start_response.call_args[0]
+    return status, body
+
+def test_app_healthy():
+    app = health.HealthApp({'a': component(True), 'b': component(True)})
+    assert call(app) == ('200 OK', b'a: ok\nb: ok\n')
+
+def test_app_unhealthy():
+    broken = mock.Mock()
+    broken.healthy.side_effect = Exception
+    app = health.HealthApp({'a': component(True), 'b': component(False), 'c': broken})
+    assert call(app) == ('503 Service Unavailable', b'a: ok\nb: unhealthy\nc: unhealthy\n')
+
+def test_app_head():
+    app = health.HealthApp({'a': component(True)})
+    assert call(app, 'HEAD') == ('200 OK', b'')
+
+def test_app_ready():
+    ready = threading.Event()
+    app = health.HealthApp({'a': component(True)}, ready)
+    assert call(app) == ('503 Service Unavailable', b'starting\na: ok\n')
+    ready.set()
+    assert call(app) == ('200 OK', b'a: ok\n')
+
+@pytest.fixture
+def notify_socket(tmpdir, mocker):
+    path = str(tmpdir.join('notify'))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+        s.bind(path)
+        s.settimeout(5)
+        mocker.patch.dict('os.environ', {'NOTIFY_SOCKET': path})
+        yield s
+
+def test_sd_notify(notify_socket):
+    assert health.sd_notify('READY=1')
+    assert notify_socket.recv(4096) == b'READY=1'
+
+def test_sd_notify_abstract(mocker):
+    name = 'temper-exporter-test-{}'.format(os.getpid())
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+        s.bind('\0' + name)
+        s.settimeout(5)
+        mocker.patch.dict('os.environ', {'NOTIFY_SOCKET': '@' + name})
+        assert health.sd_notify('WATCHDOG=1')
+        assert s.recv(4096) == b'WATCHDOG=1'
+
+def test_sd_notify_unset(mocker):
+    mocker.patch.dict('os.environ', clear=True)
+    assert not health.sd_notify('READY=1')
+
+def test_sd_notify_error(tmpdir, mocker):
+    mocker.patch.dict('os.environ', {'NOTIFY_SOCKET': str(tmpdir.join('missing'))})
+    assert not health.sd_notify('READY=1')
+
+@pytest.mark.parametrize('environ, expected', [
+    ({}, None),
+    ({'WATCHDOG_USEC': '60000000'}, 30),
+    ({'WATCHDOG_USEC': '60000000', 'WATCHDOG_PID': str(os.getpid())}, 30),
+    ({'WATCHDOG_USEC': '60000000', 'WATCHDOG_PID': '1'}, None),
+    ({'WATCHDOG_USEC': 'x'}, None),
+])
+def test_watchdog_interval(mocker, environ, expected):
+    mocker.patch.dict('os.environ', environ, clear=True)
+    assert health.watchdog_interval() == expected
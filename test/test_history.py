@@ -0,0 +1,79 @@
+import struct
+from unittest import mock
+from wsgiref import util
+
+import pytest
+
+from temper_exporter import history
+
+def test_ring_buffer():
+    r = history.RingBuffer(3)
+    assert len(r) == 0
+    assert list(r.range()) == []
+
+    r.append(1, 10)
+    r.append(2, 20)
+    assert list(r.range()) == [1, 10, 2, 20]
+
+def test_ring_buffer_wraps():
+    r = history.RingBuffer(3)
+    for i in range(1, 6):
+        r.append(i, i * 10)
+    assert len(r) == 3
+    assert list(r.range()) == [3, 30, 4, 40, 5, 50]
+
+def test_ring_buffer_range():
+    r = history.RingBuffer(4)
+    for i in range(1, 7):
+        r.append(i, i * 10)
+    assert list(r.range(4, 5)) == [4, 40, 5, 50]
+    assert list(r.range(4.5)) == [5, 50, 6, 60]
+    assert list(r.range(end=3.5)) == [3, 30]
+    assert list(r.range(7)) == []
+
+def test_history():
+    h = history.History(10)
+    h.record(1, ':phy:', 'V', [('temp', 'internal', 20), ('temp', 'external', 5)])
+    h.record(2, ':phy:', 'V', [('temp', 'internal', 21), ('temp', 'external', 6)])
+    assert sorted(h.sensors()) == [(':phy:', 'temp', 'external'), (':phy:', 'temp', 'internal')]
+    assert list(h.query(':phy:', 'temp', 'internal')) == [1, 20, 2, 21]
+    assert h.query(':phy:', 'humid', '') is None
+
+@pytest.fixture
+def app():
+    h = history.History(10)
+    h.record(1, ':phy:', 'V', [('temp', '', 20.5), ('humid', '', 40)])
+    h.record(2, ':phy:', 'V', [('temp', '', 21), ('humid', '', 41)])
+    return history.HistoryApp(h)
+
+def request(app, query):
+    environ = {'QUERY_STRING': query}
+    util.setup_testing_defaults(environ)
+    start_response = mock.Mock()
+    body = b''.join(app(environ, start_response))
+    status, headers = start_response.call_args[0]
+    return status, dict(headers), body
+
+def test_app_csv(app):
+    status, headers, body = request(app, 'phy=:phy:')
+    assert status == '200 OK'
+    assert headers['Content-Type'].startswith('text/csv')
+    assert body == b'1.0,20.5\n2.0,21.0\n'
+
+def test_app_range(app):
+    status, headers, body = request(app, 'phy=:phy:&type=humid&start=1.5&end=2')
+    assert body == b'2.0,41.0\n'
+
+def test_app_binary(app):
+    status, headers, body = request(app, 'phy=:phy:&format=binary')
+    assert headers['Content-Type'] == 'application/octet-stream'
+    assert struct.unpack('<4d', body) == (1, 20.5, 2, 21)
+
+@pytest.mark.parametrize('query,status', [
+    ('', '400 Bad Request'),
+    ('phy=:phy:&format=xml', '400 Bad Request'),
+    ('phy=:phy:&start=yesterday', '400 Bad Request'),
+    ('phy=:other:', '404 Not Found'),
+])
+def test_app_errors(app, query, status):
+    assert request(app, query)[0] == status
@@ -0,0 +1,144 @@
+import threading
+import time
+from unittest import mock
+
+import prometheus_client
+import pytest
+
+from temper_exporter import hotplug
+
+class Device:
+    def __init__(self, sys_path, action):
+        self.sys_path = sys_path
+        self.action = action
+
+    def __repr__(self):
+        return '<Device({!r}, {!r})>'.format(self.sys_path, self.action)
+
+class RecordingCollector:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.events = []
+        self.active = 0
+        self.max_active = 0
+
+    def handle_device_event(self, device, since=None):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+            self.events.append((device.sys_path, device.action, since))
+
+@pytest.fixture
+def run():
+    threads = []
+    def run(collector, **kwargs):
+        h = hotplug.Hotplug(collector, registry=prometheus_client.CollectorRegistry(), **kwargs)
+        h.start()
+        threads.append(h)
+        return h
+    yield run
+    for h in threads:
+        h.send_stop()
+        h.join()
+
+def wait_for(collector, n):
+    deadline = time.monotonic() + 5
+    while len(collector.events) < n:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    time.sleep(0.05)
+
+def test_storm_coalesced(run):
+    c = RecordingCollector()
+    h = run(c, debounce=0.05)
+    for i in range(5):
+        h.enqueue(Device('/sys/a', 'add'))
+        h.enqueue(Device('/sys/a', 'remove'))
+    h.enqueue(Device('/sys/b', 'add'))
+    h.enqueue(Device('/sys/b', 'add'))
+    wait_for(c, 2)
+    assert sorted(e[:2] for e in c.events) == [('/sys/a', 'remove'), ('/sys/b', 'add')]
+
+def test_remove_then_add(run):
+    c = RecordingCollector()
+    h = run(c, debounce=0.05)
+    h.enqueue(Device('/sys/a', 'remove'))
+    h.enqueue(Device('/sys/a', 'add'))
+    wait_for(c, 2)
+    assert [e[:2] for e in c.events] == [('/sys/a', 'remove'), ('/sys/a', 'add')]
+    # The time for the first reading is measured from the add event
+    assert c.events[0][2] is None
+    assert c.events[1][2] is not None
+
+def test_debounce(run, mocker):
+    c = RecordingCollector()
+    h = run(c, debounce=0.2, max_delay=10)
+    h.enqueue(Device('/sys/a', 'add'))
+    time.sleep(0.1)
+    h.enqueue(Device('/sys/a', 'add'))
+    time.sleep(0.15)
+    # Still within debounce seconds of the second event
+    assert c.events == []
+    wait_for(c, 1)
+    assert len(c.events) == 1
+
+def test_max_delay(run):
+    c = RecordingCollector()
+    h = run(c, debounce=0.2, max_delay=0.3)
+    start = time.monotonic()
+    while not c.events:
+        assert time.monotonic() - start < 2
+        h.enqueue(Device('/sys/a', 'add'))
+        time.sleep(0.05)
+
+def test_parallel(run):
+    c = RecordingCollector(delay=0.2)
+    h = run(c, debounce=0, workers=4)
+    for i in range(4):
+        h.enqueue(Device('/sys/{}'.format(i), 'add'))
+    wait_for(c, 4)
+    assert c.max_active == 4
+
+def test_events_for_busy_device_wait(run):
+    c = RecordingCollector(delay=0.2)
+    h = run(c, debounce=0, workers=4)
+    h.enqueue(Device('/sys/a', 'add'))
+    time.sleep(0.05)
+    h.enqueue(Device('/sys/a', 'remove'))
+    wait_for(c, 2)
+    assert c.max_active == 1
+    assert [e[:2] for e in c.events] == [('/sys/a', 'add'), ('/sys/a', 'remove')]
+
+def test_error(run):
+    c = mock.Mock()
+    c.handle_device_event.side_effect = [ValueError, None]
+    h = run(c, debounce=0)
+    h.enqueue(Device('/sys/a', 'add'))
+    h.enqueue(Device('/sys/b', 'add'))
+    deadline = time.monotonic() + 5
+    while c.handle_device_event.call_count < 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert h.healthy()
+
+def test_monitor():
+    device = Device('/sys/a', 'add')
+    mon = mock.Mock()
+    mon.poll.side_effect = lambda timeout: device if mon.poll.call_count == 1 else None
+    callback = mock.Mock()
+    m = hotplug.Monitor(mon, callback, interval=0.01)
+    m.start()
+    deadline = time.monotonic() + 5
+    while mon.poll.call_count < 3:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert m.healthy()
+    m.send_stop()
+    m.join()
+    mon.start.assert_called_once_with()
+    callback.assert_called_once_with(device)
+    assert not m.healthy()
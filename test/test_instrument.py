@@ -0,0 +1,44 @@
+import threading
+
+import prometheus_client
+
+from temper_exporter import instrument
+
+def test_counter_sums_across_threads():
+    c = instrument.Counter('test_things', 'Help', ['l'], registry=None)
+    def work():
+        for i in range(1000):
+            c.inc(('a',))
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    c.inc(('b',), 5)
+
+    assert c.value(('a',)) == 4000
+    family, = c.collect()
+    assert sorted((s.labels['l'], s.value) for s in family.samples if s.name == 'test_things_total') == [('a', 4000), ('b', 5)]
+
+def test_histogram():
+    h = instrument.Histogram('test_seconds', 'Help', buckets=(1, 2, float('inf')), registry=None)
+    for value in [0.5, 1, 1.5, 3]:
+        h.observe(value)
+    t = threading.Thread(target=h.observe, args=(10,))
+    t.start()
+    t.join()
+
+    family, = h.collect()
+    samples = {(s.name, s.labels.get('le')): s.value for s in family.samples}
+    assert samples[('test_seconds_bucket', '1.0')] == 2
+    assert samples[('test_seconds_bucket', '2.0')] == 3
+    assert samples[('test_seconds_bucket', '+Inf')] == 5
+    assert samples[('test_seconds_count', None)] == 5
+    assert samples[('test_seconds_sum', None)] == 16
+
+def test_registration():
+    registry = prometheus_client.CollectorRegistry()
+    instrument.Gauge('test_gauge', 'Help', registry=registry).set(3)
+    instrument.CallbackGauge('test_callback', 'Help', lambda: 4, registry=registry)
+    assert registry.get_sample_value('test_gauge') == 3
+    assert registry.get_sample_value('test_callback') == 4
@@ -0,0 +1,111 @@
+import io
+
+import pytest
+
+from temper_exporter import journal
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('journal'))
+
+def test_record(path):
+    j = journal.Journal(path, 10)
+    j.record(1, ':phy:', 'V', [('temp', 'internal', 20), ('temp', 'external', 5)])
+    j.record(2, ':phy2:', 'V', [('humid', '', 40)])
+    assert list(j) == [
+        (1, ':phy:', 'V', 'temp', 'internal', 20),
+        (1, ':phy:', 'V', 'temp', 'external', 5),
+        (2, ':phy2:', 'V', 'humid', '', 40),
+    ]
+
+def test_wraps(path):
+    j = journal.Journal(path, 3)
+    for i in range(5):
+        j.record(i, ':phy:', 'V', [('temp', '', i * 10)])
+    assert len(j) == 3
+    assert [row[0] for row in j] == [2, 3, 4]
+
+def test_reopen(path):
+    j = journal.Journal(path, 10)
+    j.record(1, ':phy:', 'V\x00\x00', [('temp', '', 20)])
+    j.close()
+
+    j = journal.Journal(path, 10)
+    j.record(2, ':phy:', 'V\x00\x00', [('temp', '', 21)])
+    j.record(3, ':phy2:', 'V', [('temp', '', 22)])
+    assert list(j) == [
+        (1, ':phy:', 'V\x00\x00', 'temp', '', 20),
+        (2, ':phy:', 'V\x00\x00', 'temp', '', 21),
+        (3, ':phy2:', 'V', 'temp', '', 22),
+    ]
+    j.close()
+
+    j = journal.Journal(path)
+    assert len(j) == 3
+
+def test_reopen_with_different_size(path):
+    j = journal.Journal(path, 10)
+    j.record(1, ':phy:', 'V', [('temp', '', 20)])
+    j.close()
+
+    assert list(journal.Journal(path, 20)) == []
+
+def test_not_a_journal(path):
+    with open(path, 'wb') as f:
+        f.write(b'hello')
+    with pytest.raises(ValueError):
+        journal.Journal(path)
+
+def test_not_a_journal_not_overwritten(path):
+    with open(path, 'wb') as f:
+        f.write(b'hello')
+    with pytest.raises(ValueError):
+        journal.Journal(path, 10)
+    with open(path, 'rb') as f:
+        assert f.read() == b'hello'
+
+def test_incomplete_journal_discarded(path):
+    j = journal.Journal(path, 10)
+    j.record(1, ':phy:', 'V', [('temp', '', 20)])
+    j.close()
+    with open(path, 'r+b') as f:
+        f.truncate(100)
+    assert list(journal.Journal(path, 10)) == []
+
+def test_empty_file(path):
+    open(path, 'wb').close()
+    assert list(journal.Journal(path, 10)) == []
+
+def test_dictionary_full(path):
+    j = journal.Journal(path, 10, dictionary_size=20)
+    j.record(1, ':phy:', 'V', [('temp', '', 20)])
+    j.record(2, ':a-much-longer-phy:', 'V', [('temp', '', 21)])
+    assert len(j) == 1
+
+def test_replay(path):
+    j = journal.Journal(path, 10)
+    j.record(1, ':phy:', 'V', [('temp', '', 20), ('humid', '', 40)])
+    rows = []
+    j.replay(lambda *args: rows.append(args))
+    assert rows == [(1, ':phy:', 'V', [('temp', '', 20)]), (1, ':phy:', 'V', [('humid', '', 40)])]
+
+def test_openmetrics(path):
+    j = journal.Journal(path, 10)
+    j.record(1.5, ':phy:', 'V"', [('temp', '', 20), ('humid', '', 40)])
+    j.record(2.5, ':phy:', 'V"', [('temp', '', 21), ('humid', '', 41)])
+    assert ''.join(journal.openmetrics(j)) == (
+        '# TYPE temper_humidity_rh gauge\n'
+        'temper_humidity_rh{name="",phy=":phy:",version="V\\""} 40.0 1.5\n'
+        'temper_humidity_rh{name="",phy=":phy:",version="V\\""} 41.0 2.5\n'
+        '# TYPE temper_temperature_celsius gauge\n'
+        'temper_temperature_celsius{name="",phy=":phy:",version="V\\""} 20.0 1.5\n'
+        'temper_temperature_celsius{name="",phy=":phy:",version="V\\""} 21.0 2.5\n'
+        '# EOF\n'
+    )
+
+def test_main_dump(path, capsys):
+    j = journal.Journal(path, 10)
+    j.record(1, ':phy:', 'V', [('temp', '', 20)])
+    j.close()
+    journal.main(['dump', path])
+    assert capsys.readouterr().out == '1.0\t:phy:\tV\ttemp\t\t20.0\n'
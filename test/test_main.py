@@ -1,3 +1,4 @@
+import argparse
 import signal
 from subprocess import *
 import sys
@@ -34,6 +35,8 @@ def test_main(process):
 def test_main_exits_with_nonzero_status_on_bad_health(mocker):
     # Otherwise argparse will interpret pytest's arguments and will system.exit(2)
     mocker.patch('sys.argv', ['temper_exporter'])
+    # main() sets this; restore it afterwards
+    mocker.patch('temper_exporter.temper.reactor', None)
 
     class Unhealth(temper_exporter.Health):
         def __init__(self, components, interval):
@@ -67,3 +70,45 @@ def test_health_bad_if_any_component_health_raises():
     c2 = mock.MagicMock()
     c2.healthy.side_effect = Exception
     assert not temper_exporter.Health([c1, c2], 1)._Health__healthy()
+
+def test_poll_rule():
+    assert temper_exporter.poll_rule('usb-*=2.5') == ('usb-*', 2.5)
+    assert temper_exporter.poll_rule('a=b=3') == ('a=b', 3)
+
+@pytest.mark.parametrize('value', ['temper2', '=3', 'temper2=x'])
+def test_poll_rule_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        temper_exporter.poll_rule(value)
+
+def test_health_checked_every_time():
+    c = mock.MagicMock()
+    c.healthy.return_value = True
+    h = temper_exporter.Health([c], 1)
+    assert h._Health__healthy()
+    assert h._Health__healthy()
+    assert c.healthy.call_count == 2
+
+def test_health_interval_follows_watchdog(mocker):
+    mocker.patch.dict('os.environ', {'WATCHDOG_USEC': '10000000'})
+    assert temper_exporter.Health([], 30)._Health__interval == 5
+
+@pytest.mark.parametrize('path', ['/healthz', '/readyz'])
+def test_main_health_endpoints(process, path):
+    with urllib.request.urlopen('http://[::1]:9204' + path) as r:
+        assert r.status == 200
+        assert b'server: ok\n' in r.read()
+
+def test_main_rejects_duplicate_gateway_instances(mocker):
+    mocker.patch('sys.argv', ['temper_exporter', '--gateway-upstream', 'a=http://pi1:9204/', '--gateway-upstream', 'a=http://pi2:9204/'])
+    with pytest.raises(SystemExit) as excinfo:
+        temper_exporter.main()
+    assert excinfo.value.code == 2
+
+def test_main_rejects_non_journal(mocker, tmpdir):
+    f = tmpdir.join('important.txt')
+    f.write('hello')
+    mocker.patch('sys.argv', ['temper_exporter', '--journal', str(f)])
+    with pytest.raises(SystemExit) as excinfo:
+        temper_exporter.main()
+    assert excinfo.value.code == 2
+    assert f.read() == 'hello'
@@ -0,0 +1,142 @@
+import http.client
+import http.server
+import socketserver
+import threading
+import time
+
+import prometheus_client
+import pytest
+
+from temper_exporter import push
+
+def test_varint():
+    assert push.varint(1) == b'\x01'
+    assert push.varint(300) == b'\xac\x02'
+
+def test_encode_write_request():
+    assert push.encode_write_request([([('__name__', 'm'), ('a', 'b')], [(1.0, 1000)])]) == (
+        b'\x0a\x25'                                     # timeseries, length 37
+        b'\x0a\x0d\x0a\x08__name__\x12\x01m'           # label
+        b'\x0a\x06\x0a\x01a\x12\x01b'                  # label
+        b'\x12\x0c\x09\x00\x00\x00\x00\x00\x00\xf0\x3f\x10\xe8\x07' # sample
+    )
+
+def test_snappy_literals(mocker):
+    mocker.patch.object(push, 'snappy', None)
+    assert push.snappy_compress(b'hello') == b'\x05\x10hello'
+    data = bytes(range(256)) * 2
+    assert push.snappy_compress(data) == b'\x80\x04' + bytes([61 << 2]) + b'\xff\x01' + data
+
+class Receiver(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, statuses):
+        super().__init__(('127.0.0.1', 0), ReceiverHandler)
+        self.statuses = list(statuses)
+        self.requests = []
+        self.connections = set()
+        self.received = threading.Event()
+
+class ReceiverHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.server.requests.append((dict(self.headers), body, status))
+        self.server.connections.add(self.client_address)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.server.received.set()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def receiver():
+    statuses = []
+    def make(*s):
+        statuses.extend(s)
+        return server
+    server = Receiver(statuses)
+    server.statuses = statuses
+    t = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.1}, daemon=True)
+    t.start()
+    yield make
+    server.shutdown()
+    server.server_close()
+
+def pusher(server, **kwargs):
+    url = 'http://127.0.0.1:{}/write'.format(server.server_address[1])
+    return push.Pusher(url, registry=prometheus_client.CollectorRegistry(), **kwargs)
+
+def test_push_openmetrics(receiver):
+    server = receiver()
+    p = pusher(server, format='openmetrics', batch_size=2, interval=60)
+    p.start()
+    try:
+        p.record(1.5, ':phy:', 'V', [('temp', '', 20), ('humid', '', 40)])
+        assert server.received.wait(5)
+    finally:
+        p.send_stop()
+        p.join()
+
+    headers, body, status = server.requests[0]
+    assert headers['Content-Type'].startswith('application/openmetrics-text')
+    assert b'temper_temperature_celsius{name="",phy=":phy:",version="V"} 20 1.5\n' in body
+    assert body.endswith(b'# EOF\n')
+
+def test_push_remote_write(receiver):
+    server = receiver()
+    p = pusher(server, batch_size=1, interval=60)
+    p.start()
+    try:
+        p.record(1, ':phy:', 'V', [('temp', '', 20)])
+        assert server.received.wait(5)
+        server.received.clear()
+        p.record(2, ':phy:', 'V', [('temp', '', 21)])
+        assert server.received.wait(5)
+    finally:
+        p.send_stop()
+        p.join()
+
+    headers, body, status = server.requests[0]
+    assert headers['Content-Encoding'] == 'snappy'
+    assert headers['X-Prometheus-Remote-Write-Version'] == '0.1.0'
+    assert b'temper_temperature_celsius' in body
+    # The connection was reused
+    assert len(server.connections) == 1
+
+def test_retry(receiver):
+    server = receiver(503)
+    p = pusher(server, format='openmetrics', batch_size=1, interval=60, max_backoff=0.1)
+    p.start()
+    try:
+        p.record(1, ':phy:', 'V', [('temp', '', 20)])
+        for i in range(50):
+            if len(server.requests) >= 2:
+                break
+            time.sleep(0.1)
+    finally:
+        p.send_stop()
+        p.join()
+
+    assert [status for headers, body, status in server.requests[:2]] == [503, 200]
+    assert server.requests[0][1] == server.requests[1][1]
+
+def test_queue_bounded():
+    p = push.Pusher('http://127.0.0.1:1/', max_queue=2, registry=prometheus_client.CollectorRegistry())
+    before = push.samples_dropped.value(('queue_full',))
+    p.record(1, ':phy:', 'V', [('temp', '', 20), ('temp', '', 21), ('temp', '', 22)])
+    assert push.samples_dropped.value(('queue_full',)) == before + 1
+
+@pytest.mark.parametrize('url', ['ftp://example.com/', 'http://example.com:notaport/', 'http:///'])
+def test_bad_url(url):
+    with pytest.raises(ValueError):
+        push.Pusher(url, registry=None)
+
+def test_connection_error(mocker):
+    mocker.patch('http.client.HTTPConnection', side_effect=http.client.InvalidURL)
+    p = push.Pusher('http://127.0.0.1:1/', registry=prometheus_client.CollectorRegistry())
+    assert not p._Pusher__push([(1, ':phy:', 'V', 'temp', '', 20)])
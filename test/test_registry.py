@@ -0,0 +1,60 @@
+from unittest import mock
+
+import pyudev
+
+from temper_exporter import registry
+from temper_exporter import temper
+
+def device(sys_path):
+    d = mock.create_autospec(pyudev.Device, name=sys_path)
+    d.sys_path = sys_path
+    return d
+
+def sensor(cls, phy):
+    t = mock.create_autospec(cls, name=phy)
+    t.phy.return_value = phy
+    t.version = 'VERSIONSTRING___'
+    return t
+
+def test_add_remove():
+    r = registry.Registry()
+    d = device('/sys/a')
+    t = sensor(temper.temper2, ':a:')
+
+    entry = r.add(d, t)
+    assert r.get(d) is entry
+    assert list(r) == [entry]
+    assert (entry.device, entry.t, entry.phy, entry.version, entry.model, entry.sys_path) == (d, t, ':a:', 'VERSIONSTRING___', 'temper2', '/sys/a')
+
+    assert r.remove(d) is entry
+    assert r.get(d) is None
+    assert len(r) == 0
+    assert r.remove(d) is None
+
+def test_snapshot_unaffected_by_changes():
+    r = registry.Registry()
+    d1 = device('/sys/a')
+    r.add(d1, sensor(temper.temper2, ':a:'))
+    snapshot = r.snapshot()
+    r.add(device('/sys/b'), sensor(temper.temper2, ':b:'))
+    r.remove(d1)
+    assert [e.phy for e in snapshot.entries.values()] == [':a:']
+
+def test_labels_cached():
+    t = sensor(temper.temper2, ':a:')
+    entry = registry.Entry(device('/sys/a'), t)
+    assert entry.labels('internal') == ('internal', ':a:', 'VERSIONSTRING___')
+    assert entry.labels('internal') is entry.labels('internal')
+    assert t.phy.call_count == 1
+
+def test_phy_error():
+    t = sensor(temper.temper2, ':a:')
+    t.phy.side_effect = AttributeError
+    assert registry.Entry(device('/sys/a'), t).phy == ''
+
+def test_prefix():
+    r = registry.Registry()
+    entry = r.add(device('/sys/a'), sensor(temper.temper2, ':a:'))
+    assert entry.prefix('temper_temperature_celsius', 'in"ternal') == b'temper_temperature_celsius{name="in\\"ternal",phy=":a:",version="VERSIONSTRING___"} '
+    assert entry.prefix('temper_temperature_celsius', 'in"ternal') is entry.prefix('temper_temperature_celsius', 'in"ternal')
+    assert entry.prefix('temper_device_up') == b'temper_device_up{phy=":a:",version="VERSIONSTRING___"} '
@@ -0,0 +1,141 @@
+import concurrent.futures
+from unittest import mock
+import threading
+import time
+
+import pytest
+import pyudev
+
+from temper_exporter import registry
+from temper_exporter import temper
+from temper_exporter.exporter import Collector
+from temper_exporter.sampler import Sampler
+
+def device(phy, cls=temper.temper2):
+    d = mock.create_autospec(pyudev.Device)
+    t = mock.create_autospec(cls)
+    t.phy.return_value = phy
+    t.version = 'VERSIONSTRING___'
+    t.__class__ = cls
+    return d, t
+
+def done(result):
+    f = concurrent.futures.Future()
+    f.set_result(result)
+    return f
+
+def collector(devices):
+    c = mock.create_autospec(Collector)
+    c.entries.return_value = [registry.Entry(d, t) for d, t in devices]
+    c.read_timeout.return_value = 5
+    return c
+
+def test_sampler_polls_each_device_at_its_own_interval():
+    fast = device('fast')
+    slow = device('slow')
+    c = collector([fast, slow])
+    polls = {fast[0]: 0, slow[0]: 0}
+    def submit(d, t, max_age):
+        polls[d] += 1
+        return done(True)
+    c.submit.side_effect = submit
+
+    s = Sampler(c, 60, rules=[('fast', 0.02)], jitter=0)
+    s.start()
+    time.sleep(0.3)
+    s.send_stop()
+    s.join(5)
+    assert not s.is_alive()
+
+    assert polls[fast[0]] >= 5
+    assert polls[slow[0]] == 1
+
+def test_sampler_stops_polling_removed_device():
+    d = device('x')
+    c = collector([d])
+    c.submit.side_effect = lambda device, t, max_age: (c.entries.return_value.clear(), done(True))[1]
+
+    s = Sampler(c, 0.01, jitter=0)
+    s.start()
+    time.sleep(0.1)
+    s.send_stop()
+    s.join(5)
+    assert c.submit.call_count == 1
+
+def test_sampler_backs_off_failing_device():
+    d = device('x')
+    c = collector([d])
+    c.submit.side_effect = lambda device, t, max_age: done(False)
+
+    s = Sampler(c, 0.02, jitter=0, max_backoff=60)
+    s.start()
+    time.sleep(0.3)
+    s.send_stop()
+    s.join(5)
+    # Without backoff, 15 polls; with backoff at 0, .04, .12, .28: 4
+    assert c.submit.call_count <= 5
+
+def test_sampler_passes_max_age():
+    d = device('x')
+    c = collector([d])
+    polled = threading.Event()
+    c.submit.side_effect = lambda device, t, max_age: polled.set() or done(False)
+
+    s = Sampler(c, 10, stale_intervals=3, jitter=0)
+    s.start()
+    assert polled.wait(5)
+    s.send_stop()
+    s.join(5)
+    c.submit.assert_called_with(d[0], d[1], 30)
+
+def test_sampler_slow_device_does_not_hold_up_others():
+    fast = device('fast')
+    slow = device('slow')
+    c = collector([fast, slow])
+    c.read_timeout.return_value = 0.1
+    polls = {fast[0]: 0, slow[0]: 0}
+    def submit(d, t, max_age):
+        polls[d] += 1
+        # The slow device never responds
+        return done(True) if d is fast[0] else concurrent.futures.Future()
+    c.submit.side_effect = submit
+
+    s = Sampler(c, 0.02, jitter=0, max_backoff=60)
+    s.start()
+    time.sleep(0.3)
+    s.send_stop()
+    s.join(5)
+
+    assert polls[fast[0]] >= 10
+    assert polls[slow[0]] <= 3
+    c.count_timeout.assert_called_with(slow[0])
+
+@pytest.mark.parametrize('rules, expected', [
+    ([], 60),
+    ([('usb-*-1.4/*', 2)], 2),
+    ([('temper2hum', 30)], 60),
+    ([('temper2', 30), ('usb-*', 2)], 30),
+])
+def test_interval_for(rules, expected):
+    entry = registry.Entry(*device('usb-3f980000.usb-1.4/input1'))
+    assert Sampler(mock.Mock(), 60, rules).interval_for(entry) == expected
+
+def test_sampler_healthy():
+    c = collector([])
+    s = Sampler(c, 1)
+    assert not s.healthy()
+    s.start()
+    assert s.healthy()
+    s.send_stop()
+    s.join(5)
+
+def test_sampler_unhealthy_if_stuck():
+    c = collector([])
+    s = Sampler(c, 1)
+    s.start()
+    try:
+        s.heartbeat.last -= 1000
+        assert not s.healthy()
+    finally:
+        s.send_stop()
+        s.join(5)
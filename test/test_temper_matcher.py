@@ -39,3 +39,63 @@ def test_matcher_matches_device_with_recognized_parent_usb_interface(modalias):
     assert issubclass(temper.matcher.match(dh), temper.usb_temper)
     di.get.assert_called_with(b'MODALIAS')
 
+
+def interface_device(modalias):
+    di = mock.create_autospec(pyudev.Device)
+    di.get.return_value = modalias
+    dh = mock.create_autospec(pyudev.Device)
+    dh.find_parent.return_value = di
+    return dh
+
+@pytest.fixture
+def matchers(mocker):
+    '''
+    Restore the list of matchers after a test registers new models.
+    '''
+    mocker.patch.object(temper.matcher, 'matchers', list(temper.matcher.matchers))
+    yield
+    temper.matcher._matcher__index = None
+
+def test_parse_modalias():
+    assert temper.parse_modalias('usb:v0C45p7401d0001dc00dsc00dp00ic03isc01ip02in01') == (0x0c45, 0x7401, 1)
+    assert temper.parse_modalias('hid:b0003g0001v00000C45p00007401') is None
+    assert temper.parse_modalias(None) is None
+
+def test_matcher_looks_up_parent_once():
+    dh = interface_device('usb:v0C45p7402d0001dc00dsc00dp00ic03isc01ip02in01')
+    assert temper.matcher.match(dh) is temper.temper2hum
+    assert dh.find_parent.call_count == 1
+
+def test_matcher_ignores_device_revision():
+    assert temper.matcher.match(interface_device('usb:v0C45p7401d0002dc00dsc00dp00ic03isc01ip02in01')) is temper.temper2
+
+def test_matcher_ignores_other_interfaces():
+    assert temper.matcher.match(interface_device('usb:v0C45p7401d0001dc00dsc00dp00ic03isc01ip01in00')) is None
+
+def test_class_match():
+    dh = interface_device('usb:v0C45p7401d0001dc00dsc00dp00ic03isc01ip02in01')
+    assert temper.temper2.match(dh)
+    assert not temper.temper2hum.match(dh)
+
+def test_register_model(matchers):
+    cls = temper.register_model('temper_clone', 0x1234, 0x5678, 1, 'temper2hum')
+    assert issubclass(cls, temper.temper2hum)
+    assert temper.matcher.match(interface_device('usb:v1234p5678d0001dc00dsc00dp00ic03isc01ip02in01')) is cls
+
+def test_register_model_unknown_protocol(matchers):
+    with pytest.raises(ValueError):
+        temper.register_model('temper_clone', 0x1234, 0x5678, 1, 'temper9')
+
+def test_load_models(matchers, tmpdir):
+    f = tmpdir.join('models.ini')
+    f.write('[temper2_as_hum]\nvendor = 0c45\nproduct = 7401\nprotocol = temper2hum\n')
+    temper.load_models(str(f))
+    cls = temper.matcher.match(interface_device('usb:v0C45p7401d0001dc00dsc00dp00ic03isc01ip02in01'))
+    assert cls.__name__ == 'temper2_as_hum'
+    assert issubclass(cls, temper.temper2hum)
+
+def test_load_models_missing_key(matchers, tmpdir):
+    f = tmpdir.join('models.ini')
+    f.write('[clone]\nvendor = 0c45\nprotocol = temper2hum\n')
+    with pytest.raises(ValueError):
+        temper.load_models(str(f))
@@ -1,8 +1,10 @@
+import struct
 from unittest import mock
 
 import pytest
 import pyudev
 
+from temper_exporter import devcache
 from temper_exporter import temper
 
 class hidraw_device:
@@ -34,6 +36,11 @@ class hidraw_device:
         assert self.__response, 'No report received from device - would block'
         return self.__response.pop(0)
 
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
     close = mock.MagicMock()
 
 @pytest.fixture
@@ -103,3 +110,159 @@ def test_send_response_short(utemper):
 def test_send_response_ok(utemper):
     utemper._usb_temper__device.cmd_response(b'\xff\x79\x00\x00\x00\x00\x00\x04', [b'\x79\x04\x54\x16\x54\x16'])
     assert utemper.send(b'\xff\x79\x00\x00\x00\x00\x00\x04', '>bbh') == (84, 22, 21526)
+
+def test_send_many(utemper):
+    utemper._usb_temper__device.cmd_response(b'\xff\x79\x00\x00\x00\x00\x00\x04', [b'\x79\x04\x54\x16\x54\x16'])
+    utemper._usb_temper__device.cmd_response(b'\xff\x7a\x00\x00\x00\x00\x00\x04', [b'\x7a\x02\x01\x02'])
+    assert utemper.send_many([
+        (b'\xff\x79\x00\x00\x00\x00\x00\x04', '>bbh'),
+        (b'\xff\x7a\x00\x00\x00\x00\x00\x04', '>bb'),
+    ]) == [(84, 22, 21526), (1, 2)]
+
+def test_send_many_bad_response_reads_all(utemper):
+    utemper._usb_temper__device.cmd_response(b'\xff\x79\x00\x00\x00\x00\x00\x04', [b'\xff\x04\x54\x16\x54\x16'])
+    utemper._usb_temper__device.cmd_response(b'\xff\x7a\x00\x00\x00\x00\x00\x04', [b'\x7a\x02\x01\x02'])
+    with pytest.raises(IOError):
+        utemper.send_many([
+            (b'\xff\x79\x00\x00\x00\x00\x00\x04', '>bbh'),
+            (b'\xff\x7a\x00\x00\x00\x00\x00\x04', '>bb'),
+        ])
+    # Both responses were consumed
+    assert utemper._usb_temper__device._hidraw_device__response == []
+
+@pytest.fixture(params=['numpy', 'array'])
+def conversion(request, mocker):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        mocker.patch.object(temper, 'numpy', None)
+
+@pytest.mark.parametrize('cls', [temper.temper2, temper.temper2hum])
+def test_convert_many(conversion, cls):
+    raw = [(5000, -1200), (8000, 1500), (-500, 3000), (32767, -32768)]
+    words = temper.unpack_words(b''.join(struct.pack('>hh', *r) for r in raw))
+    result = cls.convert_many(words)
+
+    assert [(type_, name) for type_, name, values in result] == list(cls.sensors)
+    for i, r in enumerate(raw):
+        assert [(type_, name, pytest.approx(values[i])) for type_, name, values in result] == list(cls.convert(r))
+
+@pytest.fixture(autouse=True)
+def calibration(mocker):
+    mocker.patch.dict(temper.calibration_cache, clear=True)
+    mocker.patch.object(temper, 'calibration_overrides', [])
+
+@pytest.fixture
+def open_temper2(mocker):
+    '''
+    Returns a function that opens a temper2, whose USB device number is
+    devnum, and which reports a calibration offset of calibration/16.
+    '''
+    devices = []
+    def _open(devnum, calibration=16, version=True):
+        hid = mock.Mock()
+        hid.properties = {'HID_PHYS': 'fakephy'}
+        usb = mock.Mock()
+        usb.properties = {'DEVNUM': devnum, 'ID_SERIAL': 'serial'}
+        dev = mock.create_autospec(pyudev.Device)
+        dev.device_node = '/dev/hidrawX'
+        dev.sys_path = '/sys/somewhere'
+        dev.find_parent.side_effect = lambda subsystem, device_type=None: usb if device_type == b'usb_device' else hid
+
+        hidraw = hidraw_device()
+        if not version:
+            hidraw.cmd_response(temper.cmd_get_version, [b'\xff'])
+        if calibration is not None:
+            hidraw.cmd_response(temper.cmd_get_calibration, [bytes([0x82, 0x02, calibration, 0])])
+        hidraw.cmd_response(temper.cmd_read_temper, [b'\x80\x04\x0a\x00\x0b\x00'])
+        mocker.patch('temper_exporter.temper.open', return_value=hidraw)
+        return temper.temper2(dev)
+    return _open
+
+def test_calibration_applied(open_temper2):
+    t = open_temper2('5')
+    assert t.calibration == {('temp', 'internal'): 1.0}
+    assert list(t.read_sensor()) == [('temp', 'internal', 11.0), ('temp', 'external', 11.0)]
+
+def test_calibration_cached_until_replugged(open_temper2):
+    open_temper2('5')
+    # The calibration isn't read again...
+    assert open_temper2('5', calibration=None).calibration == {('temp', 'internal'): 1.0}
+    # ... unless the device has been plugged in again
+    assert open_temper2('6', calibration=32).calibration == {('temp', 'internal'): 2.0}
+
+def test_calibration_read_error(open_temper2, mocker):
+    mocker.patch.object(temper.temper2, 'offsets', side_effect=IOError)
+    t = open_temper2('5')
+    assert t.calibration == {}
+    assert temper.calibration_cache == {}
+
+def test_calibration_override(open_temper2, tmpdir):
+    f = tmpdir.join('calibration.ini')
+    f.write('[other]\ntemp.internal = 5\n[fake*]\ntemp.internal = 0\ntemp.external = -0.5\n')
+    temper.load_calibration(str(f))
+    t = open_temper2('5')
+    assert t.calibration == {('temp', 'external'): -0.5}
+
+def test_device_cache(open_temper2, tmpdir, mocker):
+    mocker.patch.object(temper, 'device_cache', devcache.DeviceCache(str(tmpdir.join('devices.json'))))
+    open_temper2('5')
+    mocker.patch.dict(temper.calibration_cache, clear=True)
+    temper.device_cache = devcache.DeviceCache(str(tmpdir.join('devices.json')))
+    # Neither the version nor the calibration is read again...
+    t = open_temper2('5', calibration=None, version=False)
+    assert (t.version, t.calibration) == ('mock_temper_devi', {('temp', 'internal'): 1.0})
+    # ... unless the device has been plugged in again
+    t = open_temper2('6', calibration=32)
+    assert t.calibration == {('temp', 'internal'): 2.0}
+
+def test_device_cache_calibration_read_error(open_temper2, tmpdir, mocker):
+    mocker.patch.object(temper, 'device_cache', devcache.DeviceCache(str(tmpdir.join('devices.json'))))
+    mocker.patch.object(temper.temper2, 'offsets', side_effect=IOError)
+    open_temper2('5')
+    assert not tmpdir.join('devices.json').exists()
+
+def test_init_batched(open_temper2, mocker):
+    # How many reports were waiting to be read when each command was sent
+    pending = []
+    write = hidraw_device.write
+    def _write(self, data):
+        pending.append(len(self._hidraw_device__response))
+        return write(self, data)
+    mocker.patch.object(hidraw_device, 'write', _write)
+    t = open_temper2('5')
+    # The calibration was asked for before the response to the version
+    # command was read
+    assert pending == [0, 2]
+    assert (t.version, t.calibration) == ('mock_temper_devi', {('temp', 'internal'): 1.0})
+
+def test_send_many_version(utemper):
+    utemper._usb_temper__device.cmd_response(b'\xff\x7a\x00\x00\x00\x00\x00\x04', [b'\x7a\x02\x01\x02'])
+    assert utemper.send_many([
+        (temper.cmd_get_version, None),
+        (b'\xff\x7a\x00\x00\x00\x00\x00\x04', '>bb'),
+    ]) == ['mock_temper_devi', (1, 2)]
+
+def test_reactor(open_temper2, mocker):
+    reactor = mocker.patch.object(temper, 'reactor')
+    reactor.call.side_effect = [['reactor_version_', (48, 0)], (2560, 2816)]
+    # The device isn't opened for blocking reads; every command goes through
+    # the reactor instead
+    t = open_temper2('5', calibration=None, version=False)
+    assert not temper.open.called
+    assert (t.version, t.calibration) == ('reactor_version_', {('temp', 'internal'): 3.0})
+    assert list(t.read_sensor()) == [('temp', 'internal', 13.0), ('temp', 'external', 11.0)]
+    t.close()
+    reactor.close.assert_called_once_with(reactor.open.return_value)
+
+def test_reactor_timeout(open_temper2, mocker):
+    reactor = mocker.patch.object(temper, 'reactor')
+    reactor.call.side_effect = IOError
+    with pytest.raises(IOError):
+        open_temper2('5')
+
+def test_calibration_override_bad_value(tmpdir):
+    f = tmpdir.join('calibration.ini')
+    f.write('[temper2]\ntemp = hot\n')
+    with pytest.raises(ValueError):
+        temper.load_calibration(str(f))
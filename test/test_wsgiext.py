@@ -1,15 +1,16 @@
 import errno
 import functools
-import http.client
 import socket
 import socketserver
 import threading
+import time
 from unittest import mock
 from urllib import error, request
 from wsgiref import simple_server
 
 import pytest
 
+from temper_exporter import deadline
 from temper_exporter import wsgiext
 
 def app(status, environ, start_response):
@@ -66,34 +67,28 @@ def test_IPv64Server(address, v6only, expected_family, expected_v6only):
         else:
             raise
 
-@pytest.mark.parametrize('status, expected', [
-    ('200 OK', True),
-    ('500 Not OK', False),
-])
-def test_HealthCheckServer_health(status, expected):
+def test_HealthCheckServer_healthy():
     s = wsgiext.HealthCheckServer(('', 0), simple_server.WSGIRequestHandler)
-    s.set_app(functools.partial(app, status))
-    t = threading.Thread(target=functools.partial(s.serve_forever, poll_interval=0.1), daemon=True)
-    t.start()
-    assert s.healthy() == expected
-    s.shutdown()
-    t.join()
+    assert s.healthy()
+    s.heartbeat.last -= 1000
+    assert not s.healthy()
     s.server_close()
 
-def test_HealthCheckServer_unhealthy_on_client_error(mocker):
-    con = mock.create_autospec(http.client.HTTPConnection)
-    con.request.side_effect = http.client.HTTPException
-    mocker.patch('http.client.HTTPConnection', mock.create_autospec(http.client.HTTPConnection, return_value=con))
-
+def test_HealthCheckServer_heartbeat():
     s = wsgiext.HealthCheckServer(('', 0), simple_server.WSGIRequestHandler)
     s.set_app(functools.partial(app, '200 OK'))
+    s.heartbeat.last -= 1000
     t = threading.Thread(target=functools.partial(s.serve_forever, poll_interval=0.1), daemon=True)
     t.start()
-    assert not s.healthy()
-    assert not con.getresponse.called # because con.request raised HTTPException
-    s.shutdown()
-    t.join()
-    s.server_close()
+    try:
+        deadline = time.monotonic() + 5
+        while not s.healthy():
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        s.shutdown()
+        t.join()
+        s.server_close()
 
 class SRH(wsgiext.SilentRequestHandler):
     def log_date_time_string(self):
@@ -121,3 +116,25 @@ def test_SilentRequestHandler(capsys, status, expected):
 
     out, err = capsys.readouterr()
     assert err == expected
+
+def test_dispatch():
+    a = mock.Mock(return_value=[b'a'])
+    default = mock.Mock(return_value=[b'default'])
+    dispatch = wsgiext.dispatch({'/a': a}, default)
+    assert dispatch({'PATH_INFO': '/a'}, None) == [b'a']
+    assert dispatch({'PATH_INFO': '/'}, None) == [b'default']
+
+def test_scrape_timeout():
+    remaining = []
+    def app(environ, start_response):
+        remaining.append(deadline.remaining())
+        return []
+    wrapped = wsgiext.scrape_timeout(app, margin=0.5)
+    wrapped({'HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS': '10'}, None)
+    wrapped({'HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS': '0.1'}, None)
+    wrapped({'HTTP_X_PROMETHEUS_SCRAPE_TIMEOUT_SECONDS': 'soon'}, None)
+    wrapped({}, None)
+    assert 9 < remaining[0] <= 9.5
+    assert remaining[1] <= 0
+    assert remaining[2:] == [None, None]
+    assert deadline.remaining() is None